@@ -1,7 +1,7 @@
 # apps/citas/services/chat_processor.py
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
-from ..utils.date_time_extractor import DateTimeExtractor
+from ..utils.date_time_extractor import get_date_time_extractor
 
 class ChatProcessor:
     """
@@ -10,7 +10,7 @@ class ChatProcessor:
     """
     
     def __init__(self):
-        self.extractor = DateTimeExtractor()
+        self.extractor = get_date_time_extractor()
     
     def procesar_chat(self, chat_texto: str) -> Dict:
         """
@@ -1,4 +1,4 @@
 # apps/citas/utils/__init__.py
-from .date_time_extractor import DateTimeExtractor
+from .date_time_extractor import DateTimeExtractor, get_date_time_extractor
 
-__all__ = ['DateTimeExtractor']
\ No newline at end of file
+__all__ = ['DateTimeExtractor', 'get_date_time_extractor']
\ No newline at end of file
@@ -33,208 +33,170 @@ class DateTimeExtractor:
     MODIFICADORES_SEMANA = ['siguiente', 'próxima', 'proxima', 'que viene', 'entrante']
     MODIFICADORES_MES = ['siguiente', 'próximo', 'proximo', 'que viene', 'entrante']
     
-    def __init__(self):
-        self.ahora_mexico = datetime.now(self.TIMEZONE)
-    
+    _DIA = r'(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)'
+    _MES = r'(enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)'
+
+    # Patrones compilados una sola vez: (regex, tipo_patron, sobre_texto_original).
+    # El orden importa: es el orden en que se reportan las coincidencias.
+    PATRONES_FECHA = (
+        # "30 de junio de 2025", "20 de mayo"
+        (re.compile(r'(\d{1,2})\s+de\s+' + _MES + r'(?:\s+(?:de|del)\s+(\d{4}))?', re.IGNORECASE), 'dia_mes_año', False),
+        # "junio 30", "mayo 20"
+        (re.compile(_MES + r'\s+(\d{1,2})', re.IGNORECASE), 'mes_dia', False),
+        # "30/06/2025", "20-05-2025"
+        (re.compile(r'(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})'), 'dia_mes_año_slash', True),
+        # "30/06", "20-05"
+        (re.compile(r'(\d{1,2})[\/\-](\d{1,2})(?![\/\-\d])'), 'dia_mes_slash', True),
+        # "lunes 23", "martes 15"
+        (re.compile(_DIA + r'\s+(\d{1,2})', re.IGNORECASE), 'diasemana_numero', False),
+        # "el lunes 23"
+        (re.compile(r'el\s+' + _DIA + r'\s+(\d{1,2})', re.IGNORECASE), 'el_diasemana_numero', False),
+        # "este lunes", "próximo martes"
+        (re.compile(r'(este|esta|próximo|proximo|próxima|proxima|siguiente)\s+' + _DIA, re.IGNORECASE), 'modificador_diasemana', False),
+        # "mañana", "pasado mañana"
+        (re.compile(r'(mañana|pasado\s+mañana)', re.IGNORECASE), 'relativo', False),
+        # "hoy", "today"
+        (re.compile(r'\b(hoy|today)\b', re.IGNORECASE), 'hoy', False),
+        # "la siguiente semana", "la próxima semana", "semana que viene"
+        (re.compile(r'(?:la\s+)?(siguiente|próxima|proxima)\s+semana|semana\s+(?:que\s+viene|entrante)', re.IGNORECASE), 'semana_siguiente', False),
+        # "esta semana"
+        (re.compile(r'esta\s+semana', re.IGNORECASE), 'esta_semana', False),
+        # "el próximo mes", "mes que viene", "mes entrante"
+        (re.compile(r'(?:el\s+)?(siguiente|próximo|proximo)\s+mes|mes\s+(?:que\s+viene|entrante)', re.IGNORECASE), 'mes_siguiente', False),
+        # "este mes"
+        (re.compile(r'este\s+mes', re.IGNORECASE), 'este_mes', False),
+        # "fin de semana", "este fin de semana", "próximo fin de semana"
+        (re.compile(r'(?:(este|próximo|proximo|siguiente)\s+)?fin\s+de\s+semana', re.IGNORECASE), 'fin_de_semana', False),
+        # "el día 15", "día 23"
+        (re.compile(r'(?:el\s+)?día\s+(\d{1,2})', re.IGNORECASE), 'dia_numero', False),
+        # "dentro de 3 días", "en 5 días"
+        (re.compile(r'(?:dentro\s+de|en)\s+(\d+)\s+días?', re.IGNORECASE), 'dias_futuro', False),
+        # "dentro de 2 semanas", "en 3 semanas"
+        (re.compile(r'(?:dentro\s+de|en)\s+(\d+)\s+semanas?', re.IGNORECASE), 'semanas_futuro', False),
+        # "dentro de 2 meses", "en 3 meses"
+        (re.compile(r'(?:dentro\s+de|en)\s+(\d+)\s+meses?', re.IGNORECASE), 'meses_futuro', False),
+        # Solo días de la semana "lunes", "el martes" (si no se capturó ya con número)
+        (re.compile(r'\b(?:el\s+)?' + _DIA + r'\b', re.IGNORECASE), 'solo_diasemana', False),
+    )
+
+    PATRONES_HORARIO = (
+        # "10:30 pm", "14:30", "2:15 am"
+        (re.compile(r'(\d{1,2}):(\d{2})\s*(pm|am)?', re.IGNORECASE), 'hora_minutos', False),
+        # "10 pm", "2 am" (evitar años)
+        (re.compile(r'(?<!\d)(\d{1,2})\s+(pm|am)(?!\d)', re.IGNORECASE), 'hora_ampm', False),
+        # "de 10 a 11", "desde las 10 hasta las 11"
+        (re.compile(r'(?:de|desde)\s+(?:las?\s+)?(\d{1,2})(?::(\d{2}))?\s*(?:pm|am)?\s+(?:a|hasta)\s+(?:las?\s+)?(\d{1,2})(?::(\d{2}))?\s*(pm|am)?', re.IGNORECASE), 'rango', False),
+        # "a las 3", "a las 10:30"
+        (re.compile(r'a\s+las?\s+(\d{1,2})(?::(\d{2}))?(?!\d)', re.IGNORECASE), 'a_las', False),
+        # "las 3", "las 10:30" (evitar "de las"; si no se capturó ya)
+        (re.compile(r'(?<!de\s)las\s+(\d{1,2})(?::(\d{2}))?(?!\d)', re.IGNORECASE), 'las', False),
+        # "por la mañana/tarde/noche"
+        (re.compile(r'(por\s+la\s+mañana|por\s+la\s+tarde|por\s+la\s+noche|en\s+la\s+mañana|en\s+la\s+tarde|en\s+la\s+noche)', re.IGNORECASE), 'periodo_dia', False),
+        # "al mediodía", "a medianoche"
+        (re.compile(r'(al\s+mediodía|al\s+mediodia|a\s+medianoche|mediodía|mediodia|medianoche)', re.IGNORECASE), 'momento_especial', False),
+        # "misma hora", "a la misma hora"
+        (re.compile(r'(a\s+la\s+)?misma\s+hora', re.IGNORECASE), 'misma_hora', False),
+        # "temprano", "muy temprano"
+        (re.compile(r'(muy\s+)?temprano', re.IGNORECASE), 'temprano', False),
+        # "tarde", "más tarde"
+        (re.compile(r'(más|mas)\s+tarde\b', re.IGNORECASE), 'mas_tarde', False),
+        # "3 horas" (duración, no horario)
+        (re.compile(r'(\d+)\s+(horas?|hrs?|h)\b', re.IGNORECASE), 'duracion', False),
+    )
+
+    # Tipos que solo se agregan si su texto no está ya dentro de otra coincidencia
+    _SIN_DUPLICADOS = ('solo_diasemana', 'las')
+
+    # Filtros para evitar falsos positivos en horarios
+    _RE_PERSONAS = re.compile(r'\d+\s*(personas?|gente|asistentes?|invitados?|pax)', re.IGNORECASE)
+    _RE_AÑO = re.compile(r'\b(19|20)\d{2}\b')
+    _RE_AÑO_HORA = re.compile(r'\b(19|20)\d{2}:\d{2}\b')
+    _RE_MEDIDA = re.compile(r'\d+\s*(metros?|km|centímetros?|litros?|kilos?|gramos?)', re.IGNORECASE)
+    _RE_TELEFONO = re.compile(r'\d{3,4}[-\s]?\d{3,4}[-\s]?\d{3,4}')
+
+    @property
+    def ahora_mexico(self):
+        # Se calcula en cada uso para que una instancia compartida no se quede con una hora vieja
+        return datetime.now(self.TIMEZONE)
+
+    def _buscar(self, patrones, texto: str) -> List[Tuple[str, str]]:
+        encontrados = []
+        texto_lower = texto.lower()
+        for regex, tipo_patron, sobre_original in patrones:
+            for match in regex.finditer(texto if sobre_original else texto_lower):
+                texto_match = match.group(0)
+                if tipo_patron in self._SIN_DUPLICADOS and any(texto_match in f[0] for f in encontrados):
+                    continue
+                encontrados.append((texto_match, tipo_patron))
+        return encontrados
+
     def extraer_fechas(self, texto: str) -> List[Tuple[str, str]]:
         """
         Extrae todas las fechas mencionadas en el texto.
         Retorna lista de tuplas (texto_encontrado, tipo_patron)
         """
-        fechas = []
-        texto_lower = texto.lower()
-        
-        # Patrón: "30 de junio de 2025", "20 de mayo"
-        patron = r'(\d{1,2})\s+de\s+(enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)(?:\s+(?:de|del)\s+(\d{4}))?'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'dia_mes_año'))
-        
-        # Patrón: "junio 30", "mayo 20"
-        patron = r'(enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)\s+(\d{1,2})'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'mes_dia'))
-        
-        # Patrón: "30/06/2025", "20-05-2025"
-        patron = r'(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})'
-        for match in re.finditer(patron, texto):
-            fechas.append((match.group(0), 'dia_mes_año_slash'))
-        
-        # Patrón: "30/06", "20-05"
-        patron = r'(\d{1,2})[\/\-](\d{1,2})(?![\/\-\d])'
-        for match in re.finditer(patron, texto):
-            fechas.append((match.group(0), 'dia_mes_slash'))
-        
-        # Patrón: "lunes 23", "martes 15"
-        patron = r'(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)\s+(\d{1,2})'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'diasemana_numero'))
-        
-        # Patrón: "el lunes 23"
-        patron = r'el\s+(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)\s+(\d{1,2})'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'el_diasemana_numero'))
-        
-        # Patrón: "este lunes", "próximo martes"
-        patron = r'(este|esta|próximo|proximo|próxima|proxima|siguiente)\s+(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'modificador_diasemana'))
-        
-        # Patrón: "mañana", "pasado mañana"
-        patron = r'(mañana|pasado\s+mañana)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'relativo'))
-        
-        # Patrón: "hoy", "today"
-        patron = r'\b(hoy|today)\b'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'hoy'))
-        
-        # Patrón: "la siguiente semana", "la próxima semana", "semana que viene"
-        patron = r'(?:la\s+)?(siguiente|próxima|proxima)\s+semana|semana\s+(?:que\s+viene|entrante)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'semana_siguiente'))
-        
-        # Patrón: "esta semana"
-        patron = r'esta\s+semana'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'esta_semana'))
-        
-        # Patrón: "el próximo mes", "mes que viene", "mes entrante"
-        patron = r'(?:el\s+)?(siguiente|próximo|proximo)\s+mes|mes\s+(?:que\s+viene|entrante)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'mes_siguiente'))
-        
-        # Patrón: "este mes"
-        patron = r'este\s+mes'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'este_mes'))
-        
-        # Patrón: "fin de semana", "este fin de semana", "próximo fin de semana"
-        patron = r'(?:(este|próximo|proximo|siguiente)\s+)?fin\s+de\s+semana'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'fin_de_semana'))
-        
-        # Patrón: "el día 15", "día 23"
-        patron = r'(?:el\s+)?día\s+(\d{1,2})'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'dia_numero'))
-        
-        # Patrón: "dentro de 3 días", "en 5 días"
-        patron = r'(?:dentro\s+de|en)\s+(\d+)\s+días?'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'dias_futuro'))
-        
-        # Patrón: "dentro de 2 semanas", "en 3 semanas"
-        patron = r'(?:dentro\s+de|en)\s+(\d+)\s+semanas?'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'semanas_futuro'))
-        
-        # Patrón: "dentro de 2 meses", "en 3 meses"
-        patron = r'(?:dentro\s+de|en)\s+(\d+)\s+meses?'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            fechas.append((match.group(0), 'meses_futuro'))
-        
-        # Patrón: Solo días de la semana "lunes", "el martes"
-        patron = r'\b(?:el\s+)?(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)\b'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            # Evitar duplicados si ya fue capturado con número
-            texto_match = match.group(0)
-            if not any(texto_match in f[0] for f in fechas):
-                fechas.append((texto_match, 'solo_diasemana'))
-        
-        return fechas
+        return self._buscar(self.PATRONES_FECHA, texto)
     
     def extraer_horarios(self, texto: str) -> List[Tuple[str, str]]:
         """
         Extrae todos los horarios mencionados en el texto.
         Retorna lista de tuplas (texto_encontrado, tipo_patron)
         """
-        horarios = []
         texto_lower = texto.lower()
         
         # Filtros para evitar falsos positivos
         if self._es_numero_personas(texto_lower):
-            return horarios
+            return []
         if self._es_año_solo(texto):
-            return horarios
+            return []
         if self._es_medida(texto_lower):
-            return horarios
+            return []
         if self._es_telefono(texto):
-            return horarios
-        
-        # Patrón: "10:30 pm", "14:30", "2:15 am"
-        patron = r'(\d{1,2}):(\d{2})\s*(pm|am)?'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'hora_minutos'))
-        
-        # Patrón: "10 pm", "2 am" (evitar años)
-        patron = r'(?<!\d)(\d{1,2})\s+(pm|am)(?!\d)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'hora_ampm'))
-        
-        # Patrón: "de 10 a 11", "desde las 10 hasta las 11"
-        patron = r'(?:de|desde)\s+(?:las?\s+)?(\d{1,2})(?::(\d{2}))?\s*(?:pm|am)?\s+(?:a|hasta)\s+(?:las?\s+)?(\d{1,2})(?::(\d{2}))?\s*(pm|am)?'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'rango'))
-        
-        # Patrón: "a las 3", "a las 10:30"
-        patron = r'a\s+las?\s+(\d{1,2})(?::(\d{2}))?(?!\d)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'a_las'))
-        
-        # Patrón: "las 3", "las 10:30" (evitar "de las")
-        patron = r'(?<!de\s)las\s+(\d{1,2})(?::(\d{2}))?(?!\d)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            if not any(match.group(0) in h[0] for h in horarios):
-                horarios.append((match.group(0), 'las'))
-        
-        # Patrón: "por la mañana/tarde/noche"
-        patron = r'(por\s+la\s+mañana|por\s+la\s+tarde|por\s+la\s+noche|en\s+la\s+mañana|en\s+la\s+tarde|en\s+la\s+noche)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'periodo_dia'))
-        
-        # Patrón: "al mediodía", "a medianoche"
-        patron = r'(al\s+mediodía|al\s+mediodia|a\s+medianoche|mediodía|mediodia|medianoche)'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'momento_especial'))
-        
-        # Patrón: "misma hora", "a la misma hora"
-        patron = r'(a\s+la\s+)?misma\s+hora'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'misma_hora'))
-        
-        # Patrón: "temprano", "muy temprano"
-        patron = r'(muy\s+)?temprano'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'temprano'))
-        
-        # Patrón: "tarde", "más tarde"
-        patron = r'(más|mas)\s+tarde\b'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'mas_tarde'))
-        
-        # Patrón: "3 horas" (duración, no horario)
-        patron = r'(\d+)\s+(horas?|hrs?|h)\b'
-        for match in re.finditer(patron, texto_lower, re.IGNORECASE):
-            horarios.append((match.group(0), 'duracion'))
-        
-        return horarios
+            return []
+        
+        return self._buscar(self.PATRONES_HORARIO, texto)
     
     def _es_numero_personas(self, texto: str) -> bool:
         """Detecta si el texto habla de cantidad de personas"""
-        return bool(re.search(r'\d+\s*(personas?|gente|asistentes?|invitados?|pax)', texto, re.IGNORECASE))
+        return bool(self._RE_PERSONAS.search(texto))
     
     def _es_año_solo(self, texto: str) -> bool:
         """Detecta si hay años mencionados (1900-2099)"""
-        return bool(re.search(r'\b(19|20)\d{2}\b', texto)) and not bool(re.search(r'\b(19|20)\d{2}:\d{2}\b', texto))
+        return bool(self._RE_AÑO.search(texto)) and not bool(self._RE_AÑO_HORA.search(texto))
     
     def _es_medida(self, texto: str) -> bool:
         """Detecta si el texto habla de medidas"""
-        return bool(re.search(r'\d+\s*(metros?|km|centímetros?|litros?|kilos?|gramos?)', texto, re.IGNORECASE))
+        return bool(self._RE_MEDIDA.search(texto))
     
     def _es_telefono(self, texto: str) -> bool:
         """Detecta si hay números de teléfono"""
-        return bool(re.search(r'\d{3,4}[-\s]?\d{3,4}[-\s]?\d{3,4}', texto))
+        return bool(self._RE_TELEFONO.search(texto))
+    
+    def extraer_fecha_hora(self, texto: str) -> Optional[datetime]:
+        """
+        Fecha (con la hora, si se menciona) de un texto suelto como
+        "mañana a las 5" o "30/06/2025". Igual que ChatProcessor toma la
+        última fecha y el último horario mencionados. None si no hay fecha.
+        """
+        fechas = self.extraer_fechas(texto)
+        if not fechas:
+            return None
+        texto_lower = texto.lower()
+        fecha_texto, tipo_fecha = sorted(fechas, key=lambda f: texto_lower.find(f[0]))[-1]
+        try:
+            fecha = self.convertir_fecha_a_datetime(fecha_texto, tipo_fecha)
+        except (ValueError, TypeError):
+            # Fechas imposibles como "31/02"
+            return None
+        
+        horarios = [h for h in self.extraer_horarios(texto) if h[1] != 'duracion']
+        if horarios:
+            hora, minutos = self.convertir_horario_a_time(*horarios[-1])
+            try:
+                fecha = fecha.replace(hour=hora, minute=minutos, second=0, microsecond=0)
+            except ValueError:
+                pass
+        return fecha
     
     def convertir_fecha_a_datetime(self, fecha_texto: str, tipo_patron: str, 
                                    fecha_anterior: Optional[datetime] = None) -> datetime:
@@ -551,4 +513,15 @@ class DateTimeExtractor:
     def detectar_cambio_contextual(self, mensaje: str) -> bool:
         """Detecta si el mensaje indica un cambio contextual"""
         mensaje_lower = mensaje.lower()
-        return any(palabra in mensaje_lower for palabra in self.PALABRAS_CAMBIO)
\ No newline at end of file
+        return any(palabra in mensaje_lower for palabra in self.PALABRAS_CAMBIO)
+
+
+_compartido = None
+
+
+def get_date_time_extractor() -> DateTimeExtractor:
+    """Instancia compartida por todo el proceso (no guarda estado entre llamadas)"""
+    global _compartido
+    if _compartido is None:
+        _compartido = DateTimeExtractor()
+    return _compartido
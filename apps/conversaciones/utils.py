@@ -26,10 +26,13 @@ def add_message_to_conversation(
     metadata=None,
     external_id=None,
     sender_name='',
-    sender_user=None
+    sender_user=None,
+    save=True
 ):
     """
-    Agrega un mensaje a una conversación y actualiza timestamps
+    Agrega un mensaje a una conversación y actualiza timestamps.
+    Con save=False solo se asigna last_message_at y el guardado queda
+    a cargo del llamador.
     """
     message = Message.objects.create(
         conversacion=conversacion,
@@ -45,7 +48,8 @@ def add_message_to_conversation(
     
     # Actualizar last_message_at
     conversacion.last_message_at = timezone.now()
-    conversacion.save(update_fields=['last_message_at', 'updated_at'])
+    if save:
+        conversacion.save(update_fields=['last_message_at', 'updated_at'])
     
     return message
 
@@ -0,0 +1,106 @@
+# apps/flows/management/commands/bench_flows.py
+import timeit
+from django.core.management.base import BaseCommand
+from apps.flows.services.conditions import compile_condition, MessageView, _compile
+from apps.flows.services.entities import EntitySnapshot
+from apps.flows.services.scripts import CompiledScript
+
+
+class _BenchSession:
+    """Sesión en memoria: el benchmark mide solo el evaluador, sin base de datos"""
+
+    def __init__(self, values):
+        self.entities = EntitySnapshot(team_id=None, sender_id=None)
+        self.entities._rows = {
+            entity_id: {'slug': f'e{entity_id}', 'name': f'e{entity_id}', 'value': {'processed': value}, 'created_at': None}
+            for entity_id, value in values.items()
+        }
+
+    def _get_last_user_message(self):
+        return None
+
+
+def _condition(logic, *conditions):
+    return {"type": "conditions", "logic": logic, "conditions": list(conditions)}
+
+
+CONDITIONS = {
+    "message_equals": _condition("single", {"type": "message_equals", "value": " Sí "}),
+    "message_is_any_of (20)": _condition("single", {
+        "type": "message_is_any_of", "values": [f"opcion {i}" for i in range(20)],
+    }),
+    "message_matches_regex": _condition("single", {
+        "type": "message_matches_regex", "value": r"\b(cita|agendar|reservar)\b",
+    }),
+    "entity_greater": _condition("single", {"type": "entity_greater", "entity_id": 2, "value": 5000}),
+    "AND x4 (mixto)": _condition(
+        "single",
+        {"type": "entity_exists", "entity_id": 1},
+        {"type": "entity_equals", "entity_id": 1, "value": "Blanqueamiento dental"},
+        {"type": "entity_less", "entity_id": 2, "value": 10000},
+        {"type": "message_contains", "value": "quiero"},
+    ),
+    "OR x3 (corto circuito)": _condition(
+        "or",
+        {"type": "message_starts_with", "value": "quiero"},
+        {"type": "message_ends_with", "value": "cita"},
+        {"type": "entity_is_any_of", "entity_id": 1, "values": ["a", "b", "c"]},
+    ),
+}
+
+SCRIPTS = {
+    "precio * cantidad": "total = precio * cantidad",
+    "IVA + redondeo": "subtotal = precio * cantidad\ntotal = round(subtotal * 1.16, 2)",
+    "condicional": "plan = 'premium' if presupuesto > 5000 and servicio == 'Blanqueamiento dental' else 'basico'",
+    "fecha + días": "seguimiento = date_add(fecha_cita, 3)",
+    "texto": "saludo = concat('Hola ', upper(nombre), '!')",
+}
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark del motor de flujos (costo por evaluación de path)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=100000, help="Evaluaciones por caso")
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        self._bench_conditions(iterations)
+        self._bench_scripts(iterations)
+
+    def _bench_conditions(self, iterations):
+        session = _BenchSession({1: "Blanqueamiento dental", 2: "7500"})
+        text = "Quiero agendar una cita"
+
+        self.stdout.write(f"Condiciones de Path ({iterations} evaluaciones por caso)")
+        self.stdout.write(f"{'caso':<28}{'compilar (µs)':>16}{'evaluar (µs)':>16}")
+        for name, condition in CONDITIONS.items():
+            # Sin la memoización de compile_condition para medir el costo real
+            compile_cost = timeit.timeit(lambda: _compile(condition), number=1000) / 1000
+
+            evaluate = compile_condition(condition)
+            elapsed = timeit.timeit(
+                lambda: evaluate(session, MessageView(session, text)),
+                number=iterations,
+            )
+            self.stdout.write(
+                f"{name:<28}{compile_cost * 1e6:>16.2f}{elapsed / iterations * 1e6:>16.3f}"
+            )
+
+    def _bench_scripts(self, iterations):
+        variables = {
+            "precio": "1250.50", "cantidad": "3", "presupuesto": "7500",
+            "servicio": "Blanqueamiento dental", "fecha_cita": "2024-05-20", "nombre": "Juan",
+        }
+
+        self.stdout.write("")
+        self.stdout.write(f"Scripts de nodos SCRIPT ({iterations} evaluaciones por caso)")
+        self.stdout.write(f"{'caso':<28}{'compilar (µs)':>16}{'evaluar (µs)':>16}")
+        for name, source in SCRIPTS.items():
+            compile_cost = timeit.timeit(lambda: CompiledScript(source), number=1000) / 1000
+
+            script = CompiledScript(source)
+            elapsed = timeit.timeit(lambda: script.evaluate(variables), number=iterations)
+            self.stdout.write(
+                f"{name:<28}{compile_cost * 1e6:>16.2f}{elapsed / iterations * 1e6:>16.3f}"
+            )
@@ -0,0 +1,37 @@
+# apps/flows/management/commands/process_flow_queue.py
+import threading
+from django.core.management.base import BaseCommand
+from apps.flows.services.inbound import run_worker
+
+
+class Command(BaseCommand):
+    help = "Procesa los mensajes encolados por el webhook en modo asíncrono"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Hilos procesando la cola')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Segundos de espera con la cola vacía')
+        parser.add_argument('--once', action='store_true', help='Vaciar la cola y terminar')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        counts = []
+
+        def worker():
+            counts.append(run_worker(stop_event, options['poll_interval'], once=options['once']))
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, options['workers']))]
+        for t in threads:
+            t.start()
+        self.stdout.write(f"🚀 {len(threads)} workers procesando la cola de mensajes")
+
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stdout.write("⏹️ Deteniendo workers...")
+            stop_event.set()
+            for t in threads:
+                t.join()
+
+        self.stdout.write(self.style.SUCCESS(f"✅ Mensajes procesados: {sum(counts)}"))
@@ -0,0 +1,32 @@
+# apps/flows/management/commands/run_flow_timers.py
+import threading
+from django.core.management.base import BaseCommand
+from apps.flows.services.timers import TimerScheduler, stats
+
+
+class Command(BaseCommand):
+    help = "Reanuda las sesiones detenidas en nodos DELAY cuando vence su temporizador"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Temporizadores tomados por lote')
+        parser.add_argument('--horizon', type=float, default=60.0, help='Segundos hacia adelante que se mantienen en memoria')
+        parser.add_argument('--refresh', type=float, default=5.0, help='Segundos entre consultas de temporizadores nuevos')
+        parser.add_argument('--stats-interval', type=float, default=60.0, help='Segundos entre reportes de lag')
+        parser.add_argument('--once', action='store_true', help='Disparar los vencidos y terminar')
+
+    def handle(self, *args, **options):
+        scheduler = TimerScheduler(
+            batch_size=max(1, options['batch_size']),
+            horizon=options['horizon'],
+            refresh=options['refresh'],
+        )
+        stop_event = threading.Event()
+        self.stdout.write("🚀 Worker de temporizadores iniciado")
+
+        try:
+            scheduler.run(stop_event, once=options['once'], stats_interval=options['stats_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("⏹️ Deteniendo worker...")
+            stop_event.set()
+
+        self.stdout.write(self.style.SUCCESS(f"✅ Temporizadores: {stats.snapshot()}"))
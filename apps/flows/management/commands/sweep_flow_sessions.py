@@ -0,0 +1,73 @@
+# apps/flows/management/commands/sweep_flow_sessions.py
+from django.core.management.base import BaseCommand
+from apps.flows.services.sweeper import (
+    archive_finished_sessions,
+    default_archive_days,
+    default_delivery_retention_days,
+    default_inbound_retention_days,
+    finish_stale_sessions,
+    purge_inbound_messages,
+    purge_webhook_deliveries,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Finaliza las sesiones inactivas según el TTL de cada flujo, archiva las finalizadas antiguas "
+        "y borra los registros de reintentos del webhook y los mensajes de la cola asíncrona vencidos"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Sesiones por UPDATE / DELETE')
+        parser.add_argument(
+            '--archive-days', type=int, default=None,
+            help=f'Días sin actividad para archivar una sesión finalizada (por defecto {default_archive_days()}, 0 = no archivar)',
+        )
+        parser.add_argument(
+            '--delivery-days', type=int, default=None,
+            help=(
+                f'Días que se guardan los registros de reintentos del webhook '
+                f'(FLOWS_DEDUP_RETENTION_DAYS, por defecto {default_delivery_retention_days()}, 0 = siempre)'
+            ),
+        )
+        parser.add_argument(
+            '--queue-days', type=int, default=None,
+            help=(
+                f'Días que se guardan los mensajes procesados de la cola asíncrona '
+                f'(FLOWS_QUEUE_RETENTION_DAYS, por defecto {default_inbound_retention_days()}, 0 = siempre)'
+            ),
+        )
+        parser.add_argument('--flow', type=int, action='append', dest='flows', help='Solo este flujo (se puede repetir)')
+        parser.add_argument('--dry-run', action='store_true', help='Solo contar, sin modificar nada')
+
+    def handle(self, *args, **options):
+        chunk_size = max(1, options['chunk_size'])
+        dry_run = options['dry_run']
+        prefix = "🔍 [dry-run] " if dry_run else ""
+
+        finished = finish_stale_sessions(chunk_size=chunk_size, flow_ids=options['flows'], dry_run=dry_run)
+        self.stdout.write(f"{prefix}Sesiones finalizadas por inactividad: {sum(finished.values())} {finished or ''}")
+
+        archived = archive_finished_sessions(
+            older_than_days=options['archive_days'],
+            chunk_size=chunk_size,
+            flow_ids=options['flows'],
+            dry_run=dry_run,
+        )
+        self.stdout.write(f"{prefix}Sesiones archivadas: {archived}")
+
+        purged = purge_webhook_deliveries(
+            older_than_days=options['delivery_days'],
+            chunk_size=chunk_size,
+            flow_ids=options['flows'],
+            dry_run=dry_run,
+        )
+        self.stdout.write(f"{prefix}Registros de reintentos borrados: {purged}")
+
+        queued = purge_inbound_messages(
+            older_than_days=options['queue_days'],
+            chunk_size=chunk_size,
+            flow_ids=options['flows'],
+            dry_run=dry_run,
+        )
+        self.stdout.write(self.style.SUCCESS(f"{prefix}Mensajes de la cola borrados: {queued}"))
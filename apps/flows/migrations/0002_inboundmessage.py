@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-16 20:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0001_initial'),
+        ('teams', '0003_team_flow_commands'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboundMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender_id', models.CharField(max_length=150)),
+                ('payload', models.JSONField()),
+                ('callback_url', models.URLField(blank=True, max_length=500, null=True)),
+                ('status', models.CharField(choices=[('PENDING', 'Pendiente'), ('PROCESSING', 'Procesando'), ('DONE', 'Procesado'), ('FAILED', 'Fallido')], default='PENDING', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('callback_delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('flow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbound_messages', to='flows.flow')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbound_messages', to='teams.team')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='flows_inbou_status_c6e874_idx'), models.Index(fields=['team', 'sender_id', 'status'], name='flows_inbou_team_id_62877b_idx')],
+            },
+        ),
+    ]
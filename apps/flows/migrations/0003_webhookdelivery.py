@@ -0,0 +1,30 @@
+# Generated by Django 5.1.2 on 2026-10-16 20:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0002_inboundmessage'),
+        ('teams', '0003_team_flow_commands'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender_id', models.CharField(max_length=150)),
+                ('external_id', models.CharField(max_length=255)),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('flow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='webhook_deliveries', to='flows.flow')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='webhook_deliveries', to='teams.team')),
+            ],
+            options={
+                'unique_together': {('team', 'external_id')},
+            },
+        ),
+    ]
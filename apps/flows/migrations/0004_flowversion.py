@@ -0,0 +1,46 @@
+# Generated by Django 5.1.2 on 2026-10-16 20:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0003_webhookdelivery'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversationsession',
+            name='current_node',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='flows.node'),
+        ),
+        migrations.CreateModel(
+            name='FlowVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField()),
+                ('graph', models.JSONField(help_text='{nodes: [...], paths: [...], extra_paths: [...], entities: [...]}')),
+                ('published_at', models.DateTimeField(auto_now_add=True)),
+                ('flow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='flows.flow')),
+                ('published_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-version'],
+                'unique_together': {('flow', 'version')},
+            },
+        ),
+        migrations.AddField(
+            model_name='conversationsession',
+            name='flow_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sessions', to='flows.flowversion'),
+        ),
+        migrations.AddField(
+            model_name='flow',
+            name='published_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='flows.flowversion'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-16 20:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0004_flowversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='config',
+            field=models.JSONField(blank=True, help_text='Configuración del tipo de nodo (DELAY: {seconds, minutes, hours, days})', null=True),
+        ),
+        migrations.CreateModel(
+            name='FlowTimer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node_id', models.IntegerField()),
+                ('due_at', models.DateTimeField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pendiente'), ('FIRED', 'Disparado'), ('CANCELLED', 'Cancelado'), ('FAILED', 'Fallido')], default='PENDING', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('fired_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timers', to='flows.conversationsession')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'PENDING')), fields=['due_at'], name='flows_timer_pending_due'), models.Index(fields=['session', 'status'], name='flows_flowt_session_3ec86b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,124 @@
+# Generated by Django 5.1.2 on 2026-10-16 21:12
+
+import math
+import unicodedata
+from datetime import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+# Copia congelada de services.entities.typed_columns tal como estaba al
+# escribir esta migración: el código de la app puede cambiar, el backfill no
+
+TEXT_COLUMN_LENGTH = 255
+
+
+def _extract_value(raw_value):
+    if isinstance(raw_value, dict):
+        if 'processed' in raw_value:
+            return raw_value['processed']
+        if 'raw' in raw_value:
+            return raw_value['raw']
+        return str(raw_value)
+    return raw_value
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _date(raw_value, value):
+    candidates = []
+    if isinstance(raw_value, dict) and raw_value.get('iso'):
+        candidates.append(raw_value['iso'])
+    candidates.append(value)
+    for candidate in candidates:
+        if not isinstance(candidate, str):
+            continue
+        text = candidate.strip()
+        try:
+            parsed = parse_datetime(text)
+            if parsed is None:
+                day = parse_date(text)
+                parsed = datetime(day.year, day.month, day.day) if day else None
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            continue
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+    return None
+
+
+def _normalize_text(text):
+    text = ''.join(
+        c for c in unicodedata.normalize('NFD', str(text))
+        if unicodedata.category(c) != 'Mn'
+    )
+    return ' '.join(text.lower().split())
+
+
+def _typed_columns(raw_value):
+    value = _extract_value(raw_value)
+    if value is None:
+        return None, None, ''
+    return _number(value), _date(raw_value, value), _normalize_text(value)[:TEXT_COLUMN_LENGTH]
+
+
+def fill_typed_columns(apps, schema_editor):
+    EntityValue = apps.get_model('flows', 'EntityValue')
+    batch = []
+    for ev in EntityValue.objects.only('id', 'value').iterator(chunk_size=1000):
+        ev.value_num, ev.value_date, ev.value_text = _typed_columns(ev.value)
+        batch.append(ev)
+        if len(batch) >= 1000:
+            EntityValue.objects.bulk_update(batch, ['value_num', 'value_date', 'value_text'])
+            batch = []
+    if batch:
+        EntityValue.objects.bulk_update(batch, ['value_num', 'value_date', 'value_text'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0005_flowtimer_node_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entityvalue',
+            name='value_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='entityvalue',
+            name='value_num',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='entityvalue',
+            name='value_text',
+            field=models.CharField(blank=True, default='', help_text='Texto normalizado (minúsculas, sin acentos)', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='entityvalue',
+            index=models.Index(fields=['team', 'entity', 'value_num'], name='flows_entit_team_id_9ddeb0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entityvalue',
+            index=models.Index(fields=['team', 'entity', 'value_date'], name='flows_entit_team_id_44d8f6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entityvalue',
+            index=models.Index(fields=['team', 'entity', 'value_text'], name='flows_entit_team_id_84ef8b_idx'),
+        ),
+        migrations.RunPython(fill_typed_columns, migrations.RunPython.noop),
+    ]
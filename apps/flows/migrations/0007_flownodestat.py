@@ -0,0 +1,38 @@
+# Generated by Django 5.1.2 on 2026-10-16 21:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0006_entityvalue_typed_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsession',
+            name='node_entered_at',
+            field=models.DateTimeField(blank=True, help_text='Cuándo llegó la sesión a current_node', null=True),
+        ),
+        migrations.CreateModel(
+            name='FlowNodeStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField(default=0)),
+                ('node_id', models.IntegerField()),
+                ('path_id', models.IntegerField(default=0)),
+                ('dwell_bin', models.SmallIntegerField(default=-1)),
+                ('hour', models.DateTimeField()),
+                ('entered', models.IntegerField(default=0)),
+                ('exited', models.IntegerField(default=0)),
+                ('dwell_seconds', models.FloatField(default=0, help_text='Suma del tiempo en el nodo de las salidas')),
+                ('flow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='node_stats', to='flows.flow')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['flow', 'hour'], name='flows_flown_flow_id_7b65f5_idx')],
+                'unique_together': {('flow', 'version', 'node_id', 'path_id', 'dwell_bin', 'hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.2 on 2026-10-16 21:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0007_flownodestat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.IntegerField(help_text='Id original de la ConversationSession')),
+                ('sender_id', models.CharField(max_length=150)),
+                ('flow_id', models.IntegerField()),
+                ('team_id', models.IntegerField()),
+                ('lead_id', models.IntegerField(blank=True, null=True)),
+                ('conversacion_id', models.IntegerField(blank=True, null=True)),
+                ('flow_version_id', models.IntegerField(blank=True, null=True)),
+                ('last_node_id', models.IntegerField(blank=True, null=True)),
+                ('platform', models.CharField(blank=True, max_length=50)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('payload', models.BinaryField(help_text='JSON {context, platform_data} comprimido con zlib')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['team_id', 'sender_id'], name='flows_archi_team_id_937b83_idx'), models.Index(fields=['flow_id', 'finished_at'], name='flows_archi_flow_id_954001_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-16 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0008_archivedsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flowtimer',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='flowtimer',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pendiente'), ('PROCESSING', 'Procesando'), ('FIRED', 'Disparado'), ('CANCELLED', 'Cancelado'), ('FAILED', 'Fallido')], default='PENDING', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='flowtimer',
+            index=models.Index(condition=models.Q(('status', 'PROCESSING')), fields=['claimed_at'], name='flows_timer_processing'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0009_flowtimer_processing'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='entityvalue',
+            constraint=models.UniqueConstraint(fields=('team', 'entity', 'sender_id'), name='flows_entityvalue_sender_uniq'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='entityvalue',
+            unique_together=set(),
+        ),
+    ]
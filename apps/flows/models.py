@@ -66,9 +66,34 @@ class EntityValue(models.Model):
     sender_id = models.CharField(max_length=150, help_text="ID único del remitente (usuario/lead)")
     value = models.JSONField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Copias tipadas del valor procesado, calculadas al guardar, para filtrar en SQL
+    value_num = models.FloatField(null=True, blank=True)
+    value_date = models.DateTimeField(null=True, blank=True)
+    value_text = models.CharField(max_length=255, blank=True, default='', help_text="Texto normalizado (minúsculas, sin acentos)")
 
     class Meta:
-        unique_together = ('entity', 'team', 'sender_id')
+        constraints = [
+            # (team, entity, sender_id): además de la unicidad sirve a la
+            # paginación por clave de los segmentos (ORDER BY sender_id)
+            models.UniqueConstraint(fields=['team', 'entity', 'sender_id'], name='flows_entityvalue_sender_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['team', 'entity', 'value_num']),
+            models.Index(fields=['team', 'entity', 'value_date']),
+            models.Index(fields=['team', 'entity', 'value_text']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.fill_typed_columns()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'value' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'value_num', 'value_date', 'value_text'}
+        super().save(*args, **kwargs)
+
+    def fill_typed_columns(self):
+        """Calcula value_num, value_date y value_text a partir de value"""
+        from .services.entities import typed_columns
+        self.value_num, self.value_date, self.value_text = typed_columns(self.value)
 
     def __str__(self):
         return f"{self.sender_id} - {self.entity.name}: {self.value}"
@@ -84,6 +109,10 @@ class Flow(models.Model):
     version = models.IntegerField(default=1)
     metadata = models.JSONField(blank=True, null=True)
     team = models.ForeignKey(Team, on_delete=models.CASCADE, related_name='flows')
+    # Versión que usa el webhook; sin publicar se usa el grafo vivo (Node/Path/Entity)
+    published_version = models.ForeignKey(
+        'FlowVersion', null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -109,6 +138,25 @@ class Flow(models.Model):
     def __str__(self):
         return self.name
 
+class FlowVersion(models.Model):
+    """
+    Snapshot inmutable del grafo de un flujo publicado (nodos, paths y
+    entidades en un solo JSON). Las sesiones quedan fijadas a la versión
+    con la que empezaron.
+    """
+    flow = models.ForeignKey(Flow, on_delete=models.CASCADE, related_name='versions')
+    version = models.IntegerField()
+    graph = models.JSONField(help_text="{nodes: [...], paths: [...], extra_paths: [...], entities: [...]}")
+    published_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    published_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('flow', 'version')
+        ordering = ['-version']
+
+    def __str__(self):
+        return f"{self.flow_id} v{self.version}"
+
 class Node(models.Model):
     flow = models.ForeignKey(Flow, related_name="nodes", on_delete=models.CASCADE)
     type = models.CharField(max_length=20, choices=NodeType.choices)
@@ -118,6 +166,7 @@ class Node(models.Model):
     collect_entity_mode = models.CharField(max_length=20, choices=CollectMode.choices, default=CollectMode.NONE)
     position = models.JSONField(default=dict, help_text="Coordenadas {x, y}")
     ui_settings = models.JSONField(blank=True, null=True)
+    config = models.JSONField(blank=True, null=True, help_text="Configuración del tipo de nodo (DELAY: {seconds, minutes, hours, days})")
     default_path = models.ForeignKey("Path", null=True, blank=True, on_delete=models.SET_NULL, related_name="+") 
 
     def __str__(self):
@@ -127,8 +176,11 @@ class ConversationSession(models.Model):
     """Sesión de conversación mejorada con referencia a Lead y Conversación"""
     sender_id = models.CharField(max_length=150)
     flow = models.ForeignKey(Flow, on_delete=models.CASCADE)
-    current_node = models.ForeignKey(Node, on_delete=models.SET_NULL, null=True, blank=True)
+    # Sin constraint: una sesión fijada a una versión publicada puede apuntar
+    # a un nodo que ya se borró del grafo vivo
+    current_node = models.ForeignKey(Node, on_delete=models.DO_NOTHING, null=True, blank=True, db_constraint=False)
     team = models.ForeignKey(Team, on_delete=models.CASCADE, related_name="sessions")
+    flow_version = models.ForeignKey(FlowVersion, on_delete=models.SET_NULL, null=True, blank=True, related_name="sessions")
     
     # Nueva conexión con Lead y Conversación
     lead = models.ForeignKey('leads.Lead', on_delete=models.CASCADE, null=True, blank=True, related_name="flow_sessions")
@@ -145,23 +197,57 @@ class ConversationSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     finished_at = models.DateTimeField(null=True, blank=True)
+    node_entered_at = models.DateTimeField(null=True, blank=True, help_text="Cuándo llegó la sesión a current_node")
 
     class Meta:
         unique_together = ('sender_id', 'flow', 'team')
 
     def __str__(self):
-        return f"{self.sender_id} in {self.flow.name} at {self.current_node}"
+        return f"{self.sender_id} in {self.flow.name} at node {self.current_node_id}"
 
-    def finish_session(self):
-        """Finaliza la sesión del flujo"""
+    def finish_session(self, save=True):
+        """Finaliza la sesión del flujo (save=False deja el guardado al llamador)"""
         from django.utils import timezone
         self.status = FlowStatus.FINISHED
         self.finished_at = timezone.now()
-        self.save()
+        if save:
+            self.save()
+
+    def reactivate(self):
+        """Vuelve a ACTIVE una sesión finalizada que reinicia el flujo (el llamador guarda)"""
+        self.status = FlowStatus.ACTIVE
+        self.finished_at = None
+
+    @property
+    def flow_graph(self):
+        """
+        Grafo compilado del flujo de la sesión: la versión publicada a la que
+        está fijada (o la publicada actual / el grafo vivo si no lo está).
+        Se resuelve una vez por instancia.
+        """
+        graph = getattr(self, '_flow_graph', None)
+        if graph is None:
+            from .services.graph import get_flow_graph
+            graph = self._flow_graph = get_flow_graph(self.flow, version_id=self.flow_version_id)
+        return graph
+
+    def pin_flow_version(self):
+        """Fija la sesión a la versión publicada actual del flujo (al reiniciar)"""
+        self.flow_version_id = self.flow.published_version_id
+        self._flow_graph = None
+
+    def set_current_node(self, node):
+        """Asigna el nodo actual a partir de un Node o de un CompiledNode"""
+        node_id = node.id if node else None
+        if node_id != self.current_node_id:
+            from .services.analytics import record_transition
+            record_transition(self, self.current_node_id, node_id)
+        self.current_node_id = node_id
 
     def get_next_node(self, user_message=None):
         """
         Determina el siguiente nodo basado en los paths y condiciones.
+        Recorre el grafo compilado del flujo, sin consultas por nodo o path.
         
         Prioridad:
         1. Paths con condición cumplida (independiente de 'enabled')
@@ -169,14 +255,27 @@ class ConversationSession(models.Model):
         3. Default path habilitado
         4. Permanecer en el nodo actual si es de tipo QUESTION y no hay paths válidos
         5. END node si no hay alternativas
+
+        Retorna un CompiledNode o None.
         """
 
-        if not self.current_node:
+        # (nodo, path) por el que sale la sesión, para las métricas del embudo
+        self._last_path = None
+
+        if not self.current_node_id:
             print("No hay nodo actual.")
             return None
 
-        paths = self.current_node.paths.all().order_by("order")
-        print(f"Evaluando {len(paths)} paths para el nodo {self.current_node.id}")
+        current_node = self.flow_graph.node(self.current_node_id)
+        if current_node is None:
+            print(f"❌ El nodo {self.current_node_id} no pertenece al flujo {self.flow_id}")
+            return None
+
+        from .services.conditions import MessageView
+        message = MessageView(self, user_message)
+
+        paths = current_node.paths
+        print(f"Evaluando {len(paths)} paths para el nodo {current_node.id}")
 
         # Debug: Mostrar entidades recolectadas
         collected_entities = self.get_collected_entities_debug()
@@ -188,10 +287,11 @@ class ConversationSession(models.Model):
         
         for path in conditional_paths:
             try:
-                result = self.evaluate_condition(path.condition, message_text=user_message)  # ✅ Pasa el mensaje
-                print(f"Path condicional {path.id} ('{path.label}') -> {getattr(path.target_node, 'id', None)}: {result}")
+                result = path.predicate(self, message)  # ✅ Condición precompilada
+                print(f"Path condicional {path.id} ('{path.label}') -> {path.target_node_id}: {result}")
                 if result and path.target_node:
-                    print(f"✅ Siguiendo path condicional {path.id} -> {path.target_node.id}")
+                    print(f"✅ Siguiendo path condicional {path.id} -> {path.target_node_id}")
+                    self._last_path = (current_node.id, path.id)
                     return path.target_node
             except Exception as e:
                 print(f"❌ Error evaluando path condicional {path.id}: {e}")
@@ -203,312 +303,39 @@ class ConversationSession(models.Model):
         
         for path in unconditional_paths:
             if path.target_node:
-                print(f"✅ Siguiendo path sin condición {path.id} -> {path.target_node.id}")
+                print(f"✅ Siguiendo path sin condición {path.id} -> {path.target_node_id}")
+                self._last_path = (current_node.id, path.id)
                 return path.target_node
 
         # --- 3. Default path ---
-        default_path = getattr(self.current_node, "default_path", None)
-        if default_path and getattr(default_path, "enabled", True) and default_path.target_node:
-            print(f"✅ Siguiendo default path {default_path.id} -> {default_path.target_node.id}")
+        default_path = current_node.default_path
+        if default_path and default_path.enabled and default_path.target_node:
+            print(f"✅ Siguiendo default path {default_path.id} -> {default_path.target_node_id}")
+            self._last_path = (current_node.id, default_path.id)
             return default_path.target_node
 
         # --- 4. Si es nodo QUESTION sin paths válidos, permanecer ---
-        if self.current_node.type == "QUESTION":
-            print(f"⚠️  Nodo QUESTION {self.current_node.id} sin paths válidos - permaneciendo en el nodo")
-            return self.current_node
+        if current_node.type == "QUESTION":
+            print(f"⚠️  Nodo QUESTION {current_node.id} sin paths válidos - permaneciendo en el nodo")
+            return current_node
 
         # --- 5. Nodo END ---
-        if self.current_node.type == "END":
-            print(f"🏁 Se llegó al nodo END {self.current_node.id}")
+        if current_node.type == "END":
+            print(f"🏁 Se llegó al nodo END {current_node.id}")
             return None
 
         # --- Si no hay paths válidos ---
-        print(f"❌ No se encontró path válido desde el nodo {self.current_node.id}")
+        print(f"❌ No se encontró path válido desde el nodo {current_node.id}")
         return None
 
     def evaluate_condition(self, condition, message_text=None):
         """
         Evalúa un objeto de condición tipo JSON.
         Soporta múltiples tipos de condiciones tanto basadas en entidades como en respuestas directas.
+        La condición se compila una vez (ver services.conditions) y se reutiliza.
         """
-        print(f"🔍 Evaluando condición: {condition}")
-        
-        if not isinstance(condition, dict):
-            print(f"❌ Condición no es un diccionario válido")
-            return False
-            
-        if condition.get("type") != "conditions":
-            print(f"❌ Tipo de condición no soportado: {condition.get('type')}")
-            return False
-            
-        conditions_list = condition.get("conditions", [])
-        if not conditions_list:
-            print(f"❌ No hay condiciones en la lista")
-            return False
-            
-        # Obtener la lógica de evaluación (AND/OR)
-        logic = condition.get("logic", "single")
-        print(f"📋 Lógica de evaluación: {logic}")
-        
-        results = []
-        
-        for i, c in enumerate(conditions_list):
-            print(f"📝 Evaluando condición {i+1}/{len(conditions_list)}: {c}")
-            
-            condition_type = c.get("type")
-            result = self._evaluate_single_condition(c, message_text=message_text)
-            results.append(result)
-            
-            print(f"{'✅' if result else '❌'} Resultado de condición {i+1}: {result}")
-            
-            # Si la lógica es AND y encontramos un false, retornamos false inmediatamente
-            if logic == "single" and not result:
-                print(f"❌ Lógica AND: condición falló, retornando False")
-                return False
-                
-        # Evaluar resultado final basado en la lógica
-        if logic == "single":  # AND logic
-            final_result = all(results)
-        else:  # OR logic (si se implementa en el futuro)
-            final_result = any(results)
-            
-        print(f"{'✅' if final_result else '❌'} Resultado final de todas las condiciones: {final_result}")
-        return final_result
-
-    def _evaluate_single_condition(self, c, message_text=None):  # ✅ Agregar parámetro
-        """
-        Evalúa una condición individual.
-        Retorna True si la condición se cumple, False en caso contrario.
-        """
-        condition_type = c.get("type")
-        
-        # ========== CONDICIONES BASADAS EN ENTIDADES ==========
-        if condition_type in ["entity_exists", "entity_equals", "entity_contains", 
-                            "entity_greater", "entity_less", "entity_is_any_of"]:
-            return self._evaluate_entity_condition(c)
-        
-        # ========== CONDICIONES BASADAS EN RESPUESTA DIRECTA ==========
-        elif condition_type in ["message_equals", "message_contains", "message_starts_with",
-                            "message_ends_with", "message_is_any_of", "message_matches_regex"]:
-            return self._evaluate_message_condition(c, message_text=message_text)  # ✅ Pasar message_text
-        
-        else:
-            print(f"❌ Tipo de condición no soportado: {condition_type}")
-            return False
-
-    def _evaluate_entity_condition(self, c):
-        """
-        Evalúa condiciones basadas en entidades recolectadas.
-        """
-        condition_type = c.get("type")
-        entity_id = c.get("entity_id")
-        
-        if not entity_id:
-            print(f"❌ Condición de entidad sin entity_id")
-            return False
-        
-        # ENTITY_EXISTS: Verifica si la entidad fue recolectada
-        if condition_type == "entity_exists":
-            collected_ids = self.get_collected_entity_ids()
-            print(f"🔎 Buscando entity_id {entity_id} en collected_ids: {collected_ids}")
-            exists = entity_id in collected_ids
-            print(f"{'✅' if exists else '❌'} Entity {entity_id} {'encontrada' if exists else 'NO encontrada'}")
-            return exists
-        
-        # Para el resto de condiciones, necesitamos el valor de la entidad
-        entity_value = self.get_entity_value(entity_id)
-        
-        if entity_value is None:
-            print(f"❌ Entity {entity_id} no tiene valor")
-            return False
-        
-        # Normalizar el valor de la entidad
-        entity_value_str = str(entity_value).strip()
-        
-        # ENTITY_EQUALS: Verifica si la entidad es igual a un valor específico
-        if condition_type == "entity_equals":
-            expected_value = c.get("value")
-            if expected_value is None:
-                print(f"❌ Condición entity_equals sin valor esperado")
-                return False
-            
-            entity_value_clean = entity_value_str.lower()
-            expected_value_clean = str(expected_value).strip().lower()
-            
-            match = entity_value_clean == expected_value_clean
-            print(f"{'✅' if match else '❌'} Entity {entity_id}: '{entity_value_clean}' {'==' if match else '!='} '{expected_value_clean}'")
-            return match
-        
-        # ENTITY_CONTAINS: Verifica si la entidad contiene un texto
-        if condition_type == "entity_contains":
-            search_value = c.get("value")
-            if search_value is None:
-                print(f"❌ Condición entity_contains sin valor de búsqueda")
-                return False
-            
-            entity_value_clean = entity_value_str.lower()
-            search_value_clean = str(search_value).strip().lower()
-            
-            contains = search_value_clean in entity_value_clean
-            print(f"{'✅' if contains else '❌'} Entity {entity_id}: '{entity_value_clean}' {'contiene' if contains else 'no contiene'} '{search_value_clean}'")
-            return contains
-        
-        # ENTITY_GREATER: Verifica si la entidad es mayor que un valor
-        if condition_type == "entity_greater":
-            try:
-                expected_value = c.get("value")
-                if expected_value is None:
-                    print(f"❌ Condición entity_greater sin valor esperado")
-                    return False
-                
-                # Intentar convertir a número
-                entity_num = float(entity_value_str)
-                expected_num = float(expected_value)
-                
-                is_greater = entity_num > expected_num
-                print(f"{'✅' if is_greater else '❌'} Entity {entity_id}: {entity_num} {'>' if is_greater else '<='} {expected_num}")
-                return is_greater
-            except (ValueError, TypeError) as e:
-                print(f"❌ Error convirtiendo a número para entity_greater: {e}")
-                return False
-        
-        # ENTITY_LESS: Verifica si la entidad es menor que un valor
-        if condition_type == "entity_less":
-            try:
-                expected_value = c.get("value")
-                if expected_value is None:
-                    print(f"❌ Condición entity_less sin valor esperado")
-                    return False
-                
-                # Intentar convertir a número
-                entity_num = float(entity_value_str)
-                expected_num = float(expected_value)
-                
-                is_less = entity_num < expected_num
-                print(f"{'✅' if is_less else '❌'} Entity {entity_id}: {entity_num} {'<' if is_less else '>='} {expected_num}")
-                return is_less
-            except (ValueError, TypeError) as e:
-                print(f"❌ Error convirtiendo a número para entity_less: {e}")
-                return False
-        
-        # ENTITY_IS_ANY_OF: Verifica si la entidad es alguno de los valores en una lista
-        if condition_type == "entity_is_any_of":
-            values_list = c.get("values", [])
-            if not values_list:
-                print(f"❌ Condición entity_is_any_of sin lista de valores")
-                return False
-            
-            entity_value_clean = entity_value_str.lower()
-            # Normalizar todos los valores de la lista
-            normalized_values = [str(v).strip().lower() for v in values_list]
-            
-            is_any_of = entity_value_clean in normalized_values
-            print(f"{'✅' if is_any_of else '❌'} Entity {entity_id}: '{entity_value_clean}' {'está en' if is_any_of else 'no está en'} {normalized_values}")
-            return is_any_of
-        
-        return False
-
-    def _evaluate_message_condition(self, c, message_text=None):
-        """
-        Evalúa condiciones basadas en el mensaje recibido del usuario.
-        - Usa message_text si se pasa directamente.
-        - Si no se pasa, cae al último mensaje en DB como fallback.
-        """
-        condition_type = c.get("type")
-
-        if message_text is None:
-            # fallback: DB
-            last_message = self._get_last_user_message()
-            if not last_message:
-                print(f"❌ No hay mensaje del usuario para evaluar")
-                return False
-            message_clean = str(last_message).strip()
-        else:
-            message_clean = str(message_text).strip()
-
-        message_lower = message_clean.lower()
-        print(f"📨 Evaluando mensaje: '{message_clean}'")
-        
-        # MESSAGE_EQUALS: El mensaje es exactamente igual a un valor
-        if condition_type == "message_equals":
-            expected_value = c.get("value")
-            if expected_value is None:
-                print(f"❌ Condición message_equals sin valor esperado")
-                return False
-            
-            expected_clean = str(expected_value).strip().lower()
-            match = message_lower == expected_clean
-            print(f"{'✅' if match else '❌'} Mensaje: '{message_lower}' {'==' if match else '!='} '{expected_clean}'")
-            return match
-        
-        # MESSAGE_CONTAINS: El mensaje contiene un texto específico
-        if condition_type == "message_contains":
-            search_value = c.get("value")
-            if search_value is None:
-                print(f"❌ Condición message_contains sin valor de búsqueda")
-                return False
-            
-            search_clean = str(search_value).strip().lower()
-            contains = search_clean in message_lower
-            print(f"{'✅' if contains else '❌'} Mensaje {'contiene' if contains else 'no contiene'} '{search_clean}'")
-            return contains
-        
-        # MESSAGE_STARTS_WITH: El mensaje comienza con un texto específico
-        if condition_type == "message_starts_with":
-            prefix = c.get("value")
-            if prefix is None:
-                print(f"❌ Condición message_starts_with sin valor esperado")
-                return False
-            
-            prefix_clean = str(prefix).strip().lower()
-            starts = message_lower.startswith(prefix_clean)
-            print(f"{'✅' if starts else '❌'} Mensaje {'comienza con' if starts else 'no comienza con'} '{prefix_clean}'")
-            return starts
-        
-        # MESSAGE_ENDS_WITH: El mensaje termina con un texto específico
-        if condition_type == "message_ends_with":
-            suffix = c.get("value")
-            if suffix is None:
-                print(f"❌ Condición message_ends_with sin valor esperado")
-                return False
-            
-            suffix_clean = str(suffix).strip().lower()
-            ends = message_lower.endswith(suffix_clean)
-            print(f"{'✅' if ends else '❌'} Mensaje {'termina con' if ends else 'no termina con'} '{suffix_clean}'")
-            return ends
-        
-        # MESSAGE_IS_ANY_OF: El mensaje es alguno de los valores en una lista
-        if condition_type == "message_is_any_of":
-            values_list = c.get("values", [])
-            if not values_list:
-                print(f"❌ Condición message_is_any_of sin lista de valores")
-                return False
-            
-            # Normalizar todos los valores de la lista
-            normalized_values = [str(v).strip().lower() for v in values_list]
-            
-            is_any_of = message_lower in normalized_values
-            print(f"{'✅' if is_any_of else '❌'} Mensaje: '{message_lower}' {'está en' if is_any_of else 'no está en'} {normalized_values}")
-            return is_any_of
-        
-        # MESSAGE_MATCHES_REGEX: El mensaje coincide con una expresión regular
-        if condition_type == "message_matches_regex":
-            import re
-            pattern = c.get("value")
-            if pattern is None:
-                print(f"❌ Condición message_matches_regex sin patrón")
-                return False
-            
-            try:
-                regex = re.compile(str(pattern), re.IGNORECASE)
-                matches = bool(regex.search(message_clean))
-                print(f"{'✅' if matches else '❌'} Mensaje {'coincide con' if matches else 'no coincide con'} regex '{pattern}'")
-                return matches
-            except re.error as e:
-                print(f"❌ Error en expresión regular '{pattern}': {e}")
-                return False
-        
-        return False
+        from .services.conditions import compile_condition
+        return compile_condition(condition)(self, message_text)
 
     def _get_last_user_message(self):
         """
@@ -547,18 +374,21 @@ class ConversationSession(models.Model):
         print("❌ No se encontró ningún mensaje del usuario")
         return None
                     
+    @property
+    def entities(self):
+        """Snapshot de los EntityValue del sender, cargado una vez por instancia"""
+        snapshot = getattr(self, '_entity_snapshot', None)
+        if snapshot is None:
+            from .services.entities import EntitySnapshot
+            snapshot = self._entity_snapshot = EntitySnapshot(self.team_id, self.sender_id)
+        return snapshot
+
     def get_collected_entity_ids(self):
         """
         Retorna la lista de IDs de entidades recolectadas en esta sesión.
         """
         try:
-            # Obtener los EntityValues para este sender_id y team
-            entity_values = EntityValue.objects.filter(
-                sender_id=self.sender_id,
-                team=self.team
-            ).values_list('entity_id', flat=True)
-            
-            collected_ids = list(entity_values)
+            collected_ids = self.entities.ids()
             print(f"📊 Entidades recolectadas para sender_id {self.sender_id}: {collected_ids}")
             return collected_ids
         except Exception as e:
@@ -568,37 +398,13 @@ class ConversationSession(models.Model):
     def get_entity_value(self, entity_id):
         """
         Obtiene el valor de una entidad específica para esta sesión.
+        Si el valor es un diccionario {'raw': ..., 'processed': ...} se extrae 'processed' o 'raw'.
         """
         try:
-            entity_value = EntityValue.objects.get(
-                entity_id=entity_id,
-                sender_id=self.sender_id,
-                team=self.team
-            )
-            raw_value = entity_value.value
-            print(f"🔍 Valor raw encontrado para entity {entity_id}: '{raw_value}'")
-            
-            # Si el valor es un diccionario con estructura {'raw': 'valor', 'processed': 'valor'...}
-            if isinstance(raw_value, dict):
-                if 'processed' in raw_value:
-                    processed_value = raw_value['processed']
-                    print(f"✅ Extrayendo valor 'processed' para entity {entity_id}: '{processed_value}'")
-                    return processed_value
-                elif 'raw' in raw_value:
-                    raw_text = raw_value['raw']
-                    print(f"✅ Extrayendo valor 'raw' para entity {entity_id}: '{raw_text}'")
-                    return raw_text
-                else:
-                    print(f"⚠️  Diccionario sin 'processed' ni 'raw', usando el diccionario completo")
-                    return str(raw_value)
-            
-            # Si el valor ya es un string simple, lo devolvemos directamente
-            print(f"✅ Valor simple encontrado para entity {entity_id}: '{raw_value}'")
-            return raw_value
-            
-        except EntityValue.DoesNotExist:
-            print(f"❌ No se encontró valor para entity {entity_id}")
-            return None
+            value = self.entities.value(entity_id)
+            if value is None:
+                print(f"❌ No se encontró valor para entity {entity_id}")
+            return value
         except Exception as e:
             print(f"❌ Error obteniendo valor de entity {entity_id}: {e}")
             return None
@@ -608,42 +414,20 @@ class ConversationSession(models.Model):
         Función de debug para mostrar todas las entidades recolectadas con sus valores.
         """
         try:
-            entity_values = EntityValue.objects.filter(
-                sender_id=self.sender_id,
-                team=self.team
-            ).select_related('entity')
-            
-            result = {}
-            for ev in entity_values:
-                raw_value = ev.value
-                processed_value = None
-                
-                # Extraer valor procesado si es un diccionario
-                if isinstance(raw_value, dict):
-                    processed_value = raw_value.get('processed', raw_value.get('raw', str(raw_value)))
-                else:
-                    processed_value = raw_value
-                    
-                result[ev.entity_id] = {
-                    'raw_value': raw_value,
-                    'processed_value': processed_value,
-                    'entity_name': getattr(ev.entity, 'name', f'Entity {ev.entity_id}'),
-                    'created_at': ev.created_at
-                }
-            
-            return result
+            return self.entities.debug()
         except Exception as e:
             print(f"❌ Error en debug de entidades: {e}")
             return {}
 
 """
     def finish_session(self):
+    def flow_graph(self):
+    def pin_flow_version(self):
+    def set_current_node(self, node):
     def get_next_node(self, user_message=None):
     def evaluate_condition(self, condition, message_text=None):
-    def _evaluate_single_condition(self, c, message_text=None):  
-    def _evaluate_entity_condition(self, c):
-    def _evaluate_message_condition(self, c, message_text=None):
     def _get_last_user_message(self):
+    def entities(self):
     def get_collected_entity_ids(self):
     def get_entity_value(self, entity_id):
     def get_collected_entities_debug(self):
@@ -659,4 +443,164 @@ class Path(models.Model):
     temporary_hide_on_message = models.BooleanField(default=False)
 
     def __str__(self):
-        return f"{self.label} -> {self.target_node_id or 'END'}"
\ No newline at end of file
+        return f"{self.label} -> {self.target_node_id or 'END'}"
+
+class InboundStatus(models.TextChoices):
+    PENDING = "PENDING", "Pendiente"
+    PROCESSING = "PROCESSING", "Procesando"
+    DONE = "DONE", "Procesado"
+    FAILED = "FAILED", "Fallido"
+
+class InboundMessage(models.Model):
+    """
+    Payload del webhook encolado en modo asíncrono. Los workers
+    (manage.py process_flow_queue) lo procesan en orden por remitente y
+    guardan la respuesta para el callback o el endpoint de consulta.
+    """
+    flow = models.ForeignKey(Flow, on_delete=models.CASCADE, related_name="inbound_messages")
+    team = models.ForeignKey(Team, on_delete=models.CASCADE, related_name="inbound_messages")
+    sender_id = models.CharField(max_length=150)
+    payload = models.JSONField()
+    callback_url = models.URLField(max_length=500, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=InboundStatus.choices, default=InboundStatus.PENDING)
+    attempts = models.IntegerField(default=0)
+    response = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    callback_delivered_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['team', 'sender_id', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.sender_id} #{self.id} ({self.status})"
+
+class WebhookDelivery(models.Model):
+    """
+    Entrega del webhook ya procesada, identificada por el message_id de la
+    plataforma. Un reintento con el mismo message_id recibe la respuesta
+    guardada sin volver a ejecutar el flujo.
+    """
+    team = models.ForeignKey(Team, on_delete=models.CASCADE, related_name="webhook_deliveries")
+    flow = models.ForeignKey(Flow, on_delete=models.CASCADE, related_name="webhook_deliveries")
+    sender_id = models.CharField(max_length=150)
+    external_id = models.CharField(max_length=255)
+    response = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('team', 'external_id')
+
+    def __str__(self):
+        return f"{self.sender_id} - {self.external_id}"
+
+class TimerStatus(models.TextChoices):
+    PENDING = "PENDING", "Pendiente"
+    PROCESSING = "PROCESSING", "Procesando"
+    FIRED = "FIRED", "Disparado"
+    CANCELLED = "CANCELLED", "Cancelado"
+    FAILED = "FAILED", "Fallido"
+
+class FlowTimer(models.Model):
+    """
+    Temporizador de un nodo DELAY: cuando vence, el worker
+    (manage.py run_flow_timers) lo toma (PROCESSING) y reanuda la sesión en
+    el siguiente path del nodo. Solo los pendientes están en el índice por
+    due_at.
+    """
+    session = models.ForeignKey(ConversationSession, on_delete=models.CASCADE, related_name="timers")
+    # Id del nodo en el grafo de la sesión (vivo o snapshot), sin FK
+    node_id = models.IntegerField()
+    due_at = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=TimerStatus.choices, default=TimerStatus.PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Tomado por un worker; si sigue PROCESSING mucho después, el worker cayó
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    fired_at = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['due_at'],
+                name='flows_timer_pending_due',
+                condition=models.Q(status='PENDING'),
+            ),
+            models.Index(
+                fields=['claimed_at'],
+                name='flows_timer_processing',
+                condition=models.Q(status='PROCESSING'),
+            ),
+            models.Index(fields=['session', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} @ {self.due_at} ({self.status})"
+
+class FlowNodeStat(models.Model):
+    """
+    Contadores de embudo por hora y por (flujo, versión, nodo, path),
+    acumulados en proceso y sumados con upserts por lotes (ver
+    services/analytics.py). path_id=0 agrupa las entradas y las salidas
+    sin path (reinicios, saltos por título); dwell_bin es el rango de
+    tiempo en el nodo de las salidas (-1 si no se midió).
+    """
+    flow = models.ForeignKey(Flow, on_delete=models.CASCADE, related_name="node_stats")
+    # FlowVersion.version de la sesión; 0 para el grafo vivo
+    version = models.IntegerField(default=0)
+    node_id = models.IntegerField()
+    path_id = models.IntegerField(default=0)
+    dwell_bin = models.SmallIntegerField(default=-1)
+    hour = models.DateTimeField()
+    entered = models.IntegerField(default=0)
+    exited = models.IntegerField(default=0)
+    dwell_seconds = models.FloatField(default=0, help_text="Suma del tiempo en el nodo de las salidas")
+
+    class Meta:
+        unique_together = ('flow', 'version', 'node_id', 'path_id', 'dwell_bin', 'hour')
+        indexes = [
+            models.Index(fields=['flow', 'hour']),
+        ]
+
+    def __str__(self):
+        return f"{self.flow_id} v{self.version} nodo {self.node_id} @ {self.hour}: +{self.entered} -{self.exited}"
+
+class ArchivedSession(models.Model):
+    """
+    ConversationSession FINISHED e inactiva movida fuera de la tabla de
+    sesiones (manage.py sweep_flow_sessions). Los ids se guardan sin FK y
+    context / platform_data van comprimidos en `payload`.
+    """
+    session_id = models.IntegerField(help_text="Id original de la ConversationSession")
+    sender_id = models.CharField(max_length=150)
+    flow_id = models.IntegerField()
+    team_id = models.IntegerField()
+    lead_id = models.IntegerField(null=True, blank=True)
+    conversacion_id = models.IntegerField(null=True, blank=True)
+    flow_version_id = models.IntegerField(null=True, blank=True)
+    last_node_id = models.IntegerField(null=True, blank=True)
+    platform = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    payload = models.BinaryField(help_text="JSON {context, platform_data} comprimido con zlib")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['team_id', 'sender_id']),
+            models.Index(fields=['flow_id', 'finished_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.sender_id} in flow {self.flow_id} (archivada)"
+
+    def data(self):
+        """{context, platform_data} descomprimidos"""
+        from .services.sweeper import unpack_payload
+        return unpack_payload(self.payload)
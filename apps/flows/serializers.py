@@ -32,6 +32,7 @@ class FlowSerializer(serializers.ModelSerializer):
     class Meta:
         model = Flow
         fields = "__all__"
+        read_only_fields = ['version', 'published_version']
 
 
 #----
@@ -0,0 +1,22 @@
+# apps/flows/services/__init__.py
+from .graph import (
+    CompiledEntity,
+    CompiledNode,
+    CompiledPath,
+    FlowGraph,
+    clear_flow_graph_cache,
+    get_flow_graph,
+    invalidate_flow_graph,
+)
+from .unit_of_work import UnitOfWork
+
+__all__ = [
+    'CompiledEntity',
+    'CompiledNode',
+    'CompiledPath',
+    'FlowGraph',
+    'UnitOfWork',
+    'clear_flow_graph_cache',
+    'get_flow_graph',
+    'invalidate_flow_graph',
+]
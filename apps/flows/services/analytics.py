@@ -0,0 +1,278 @@
+# apps/flows/services/analytics.py
+import atexit
+import bisect
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+# Límites superiores (segundos) de los rangos de tiempo en nodo; el último
+# rango es ">= 3 días"
+DWELL_BINS = (
+    1, 2, 5, 10, 30, 60, 120, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600, 86400, 3 * 86400,
+)
+NO_DWELL = -1
+NO_PATH = 0
+
+# Filas por sentencia INSERT ... ON CONFLICT
+FLUSH_CHUNK = 500
+
+
+def _enabled():
+    return getattr(settings, 'FLOWS_FUNNEL_ENABLED', True)
+
+
+def _flush_interval():
+    return getattr(settings, 'FLOWS_FUNNEL_FLUSH_INTERVAL', 10)
+
+
+def _max_pending():
+    # Claves distintas acumuladas antes de forzar un flush
+    return getattr(settings, 'FLOWS_FUNNEL_MAX_PENDING', 1000)
+
+
+def dwell_bin(seconds):
+    """Índice del rango de DWELL_BINS de `seconds` (NO_DWELL si no se midió)"""
+    if seconds is None:
+        return NO_DWELL
+    return bisect.bisect_right(DWELL_BINS, max(seconds, 0))
+
+
+def _hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+class FunnelCounters:
+    """
+    Contadores del embudo acumulados en memoria del proceso:
+    (flow, version, node, path, dwell_bin, hora) -> [entradas, salidas,
+    segundos]. flush() los suma a FlowNodeStat con upserts por lotes;
+    maybe_flush() lo hace cada FLOWS_FUNNEL_FLUSH_INTERVAL segundos o al
+    juntar FLOWS_FUNNEL_MAX_PENDING claves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def add(self, flow_id, version, node_id, path_id=NO_PATH, bin_=NO_DWELL, hour=None,
+            entered=0, exited=0, seconds=0.0):
+        key = (flow_id, version, node_id, path_id, bin_, hour)
+        with self._lock:
+            counts = self._pending.get(key)
+            if counts is None:
+                counts = self._pending[key] = [0, 0, 0.0]
+            counts[0] += entered
+            counts[1] += exited
+            counts[2] += seconds
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def maybe_flush(self):
+        due = time.monotonic() - self._last_flush >= _flush_interval()
+        if due or self.pending() >= _max_pending():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """Suma los contadores pendientes en FlowNodeStat. Retorna cuántas filas escribió."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            _write(pending)
+        except DatabaseError as e:
+            print(f"⚠️ No se pudieron guardar {len(pending)} contadores del embudo, se reintentará: {e}")
+            with self._lock:
+                for key, (entered, exited, seconds) in pending.items():
+                    counts = self._pending.setdefault(key, [0, 0, 0.0])
+                    counts[0] += entered
+                    counts[1] += exited
+                    counts[2] += seconds
+            return 0
+        return len(pending)
+
+    def reset(self):
+        with self._lock:
+            self._pending = {}
+
+
+counters = FunnelCounters()
+
+
+def _write(pending):
+    from ..models import FlowNodeStat
+    from .upserts import ADD, supports_upsert, upsert_returning
+
+    objs = [
+        FlowNodeStat(
+            flow_id=flow_id, version=version, node_id=node_id, path_id=path_id,
+            dwell_bin=bin_, hour=hour, entered=entered, exited=exited, dwell_seconds=seconds,
+        )
+        for (flow_id, version, node_id, path_id, bin_, hour), (entered, exited, seconds) in pending.items()
+    ]
+    unique = ['flow', 'version', 'node_id', 'path_id', 'dwell_bin', 'hour']
+
+    with transaction.atomic():
+        if supports_upsert(FlowNodeStat):
+            for start in range(0, len(objs), FLUSH_CHUNK):
+                upsert_returning(FlowNodeStat, objs[start:start + FLUSH_CHUNK], unique, {
+                    'entered': ADD, 'exited': ADD, 'dwell_seconds': ADD,
+                })
+            return
+        for obj in objs:
+            lookup = {name: getattr(obj, 'flow_id' if name == 'flow' else name) for name in unique}
+            stat, created = FlowNodeStat.objects.get_or_create(**lookup, defaults={
+                'entered': obj.entered, 'exited': obj.exited, 'dwell_seconds': obj.dwell_seconds,
+            })
+            if not created:
+                FlowNodeStat.objects.filter(pk=stat.pk).update(
+                    entered=F('entered') + obj.entered,
+                    exited=F('exited') + obj.exited,
+                    dwell_seconds=F('dwell_seconds') + obj.dwell_seconds,
+                )
+
+
+def _flush_at_exit():
+    try:
+        counters.flush()
+    except Exception as e:
+        print(f"⚠️ Contadores del embudo sin guardar al salir: {e}")
+
+
+atexit.register(_flush_at_exit)
+
+
+def record_transition(session, previous_id, node_id):
+    """
+    Cuenta el paso de la sesión de `previous_id` a `node_id`: una salida
+    (por el path que eligió get_next_node, con su tiempo en el nodo) y una
+    entrada. Lo llama ConversationSession.set_current_node.
+    """
+    now = timezone.now()
+    last_path = getattr(session, '_last_path', None)
+    session._last_path = None
+    entered_at = session.node_entered_at
+    session.node_entered_at = now if node_id is not None else None
+    if not _enabled():
+        return
+
+    graph = session.flow_graph
+    version = graph.version if graph.version_id else 0
+    hour = _hour(now)
+
+    increments = []
+    if previous_id is not None:
+        if entered_at is None:
+            # La sesión se creó ya en este nodo (upsert): su entrada no se contó
+            increments.append(((session.flow_id, version, previous_id), {'hour': hour, 'entered': 1}))
+        path_id = last_path[1] if last_path and last_path[0] == previous_id else NO_PATH
+        seconds = (now - entered_at).total_seconds() if entered_at else None
+        increments.append((
+            (session.flow_id, version, previous_id, path_id, dwell_bin(seconds), hour),
+            {'exited': 1, 'seconds': seconds or 0.0},
+        ))
+    if node_id is not None:
+        increments.append(((session.flow_id, version, node_id), {'hour': hour, 'entered': 1}))
+
+    # Solo cuenta si el paso del flujo se confirma
+    def apply():
+        for args, kwargs in increments:
+            counters.add(*args, **kwargs)
+    transaction.on_commit(apply)
+
+
+# --- Lectura ---
+
+def _median(histogram):
+    """Mediana aproximada (interpolada dentro del rango) de {dwell_bin: salidas}"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    half = total / 2
+    seen = 0
+    for bin_ in sorted(histogram):
+        count = histogram[bin_]
+        if seen + count >= half:
+            low = DWELL_BINS[bin_ - 1] if bin_ > 0 else 0
+            if bin_ >= len(DWELL_BINS):
+                return float(low)
+            high = DWELL_BINS[bin_]
+            return round(low + (high - low) * (half - seen) / count, 3)
+        seen += count
+    return None
+
+
+def funnel(flow, since=None, until=None, version=None):
+    """
+    Embudo del flujo entre `since` y `until` (por defecto los últimos 7
+    días) a partir de FlowNodeStat: entradas, salidas, abandonos (entradas
+    sin salida, incluye sesiones aún en el nodo), tiempo medio y mediano en
+    el nodo y salidas por path.
+    """
+    from ..models import FlowNodeStat
+    from .graph import get_flow_graph
+
+    until = until or timezone.now()
+    since = since or until - timedelta(days=7)
+    rows = FlowNodeStat.objects.filter(flow=flow, hour__gte=_hour(since), hour__lte=until)
+    if version is not None:
+        rows = rows.filter(version=version)
+
+    nodes = {}
+    for row in rows.values('node_id', 'path_id', 'dwell_bin').annotate(
+        entered=Sum('entered'), exited=Sum('exited'), seconds=Sum('dwell_seconds'),
+    ):
+        node = nodes.setdefault(row['node_id'], {
+            'entered': 0, 'exited': 0, 'seconds': 0.0, 'timed': 0, 'histogram': {}, 'paths': {},
+        })
+        node['entered'] += row['entered']
+        node['exited'] += row['exited']
+        if row['exited']:
+            node['paths'][row['path_id']] = node['paths'].get(row['path_id'], 0) + row['exited']
+            if row['dwell_bin'] != NO_DWELL:
+                node['timed'] += row['exited']
+                node['seconds'] += row['seconds']
+                node['histogram'][row['dwell_bin']] = node['histogram'].get(row['dwell_bin'], 0) + row['exited']
+
+    graph = get_flow_graph(flow)
+    result = []
+    for node_id, node in nodes.items():
+        compiled = graph.node(node_id)
+        dropped = max(node['entered'] - node['exited'], 0)
+        result.append({
+            'node_id': node_id,
+            'title': compiled.title if compiled else None,
+            'type': compiled.type if compiled else None,
+            'entered': node['entered'],
+            'exited': node['exited'],
+            'dropped': dropped,
+            'drop_rate': round(dropped / node['entered'], 4) if node['entered'] else 0.0,
+            'avg_seconds': round(node['seconds'] / node['timed'], 3) if node['timed'] else None,
+            'median_seconds': _median(node['histogram']),
+            'paths': [
+                {
+                    'path_id': path_id or None,
+                    'label': graph.path(path_id).label if path_id and graph.path(path_id) else None,
+                    'exited': count,
+                }
+                for path_id, count in sorted(node['paths'].items(), key=lambda item: -item[1])
+            ],
+        })
+    result.sort(key=lambda n: -n['entered'])
+    return {
+        'flow_id': flow.id,
+        'version': version,
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'nodes': result,
+    }
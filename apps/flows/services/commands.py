@@ -0,0 +1,44 @@
+# apps/flows/services/commands.py
+import unicodedata
+
+# Acciones que el webhook intercepta antes de evaluar el flujo
+COMMAND_NODE = 'node'
+COMMAND_MENU = 'menu'
+COMMAND_RESTART = 'restart'
+
+# Palabras clave por defecto; cada team puede reemplazarlas en Team.flow_commands
+DEFAULT_COMMANDS = {
+    COMMAND_MENU: ('menu principal',),
+    COMMAND_RESTART: ('reiniciar historial',),
+}
+
+
+def normalize_text(text):
+    """Minúsculas, sin acentos y con los espacios colapsados"""
+    text = ''.join(
+        c for c in unicodedata.normalize('NFD', str(text))
+        if unicodedata.category(c) != 'Mn'
+    )
+    return ' '.join(text.lower().split())
+
+
+def team_commands(team):
+    """
+    Palabras clave (ya normalizadas) de cada comando para un team.
+
+    Team.flow_commands tiene la forma {"menu": ["menu principal", "inicio"],
+    "restart": "reiniciar"}; las acciones que no aparecen usan los valores
+    por defecto y las desconocidas se ignoran.
+    """
+    configured = getattr(team, 'flow_commands', None) or {}
+    commands = {}
+    for action, defaults in DEFAULT_COMMANDS.items():
+        keywords = configured.get(action, defaults) if isinstance(configured, dict) else defaults
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        if not isinstance(keywords, (list, tuple)):
+            keywords = defaults
+        commands[action] = tuple(
+            k for k in (normalize_text(k) for k in keywords if isinstance(k, str)) if k
+        )
+    return commands
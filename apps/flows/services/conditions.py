@@ -0,0 +1,268 @@
+# apps/flows/services/conditions.py
+import json
+import re
+from functools import lru_cache
+
+from django.utils import timezone
+
+ENTITY_CONDITIONS = (
+    "entity_exists", "entity_equals", "entity_contains",
+    "entity_greater", "entity_less", "entity_is_any_of",
+)
+MESSAGE_CONDITIONS = (
+    "message_equals", "message_contains", "message_starts_with",
+    "message_ends_with", "message_is_any_of", "message_matches_regex",
+)
+
+
+def _never(session, message):
+    return False
+
+
+class MessageView:
+    """
+    Mensaje del usuario normalizado una sola vez por evaluación.
+    Si no se recibe texto se usa el último mensaje entrante de la sesión.
+    """
+    __slots__ = ('_session', '_text', '_loaded', 'clean', 'lower')
+
+    def __init__(self, session, text):
+        self._session = session
+        self._text = text
+        self._loaded = False
+        self.clean = None
+        self.lower = None
+
+    def load(self):
+        if not self._loaded:
+            self._loaded = True
+            text = self._text
+            if text is None:
+                # fallback: DB
+                text = self._session._get_last_user_message()
+                if not text:
+                    return False
+            self.clean = str(text).strip()
+            self.lower = self.clean.lower()
+        return self.clean is not None
+
+
+def as_message_view(session, message):
+    if isinstance(message, MessageView):
+        return message
+    return MessageView(session, message)
+
+
+def _normalize(value):
+    return str(value).strip().lower()
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+# --- Condiciones de entidad ---
+
+def _compile_entity_condition(c):
+    condition_type = c.get("type")
+    entity_id = c.get("entity_id")
+
+    if not entity_id:
+        return _never
+
+    # ENTITY_EXISTS: Verifica si la entidad fue recolectada
+    if condition_type == "entity_exists":
+        def entity_exists(session, message):
+            return session.entities.has(entity_id)
+        return entity_exists
+
+    def value_of(session):
+        value = session.entities.value(entity_id)
+        if value is None:
+            return None
+        return str(value).strip()
+
+    if condition_type in ("entity_equals", "entity_contains"):
+        expected = c.get("value")
+        if expected is None:
+            return _never
+        expected = _normalize(expected)
+
+        if condition_type == "entity_equals":
+            def entity_equals(session, message):
+                value = value_of(session)
+                return value is not None and value.lower() == expected
+            return entity_equals
+
+        def entity_contains(session, message):
+            value = value_of(session)
+            return value is not None and expected in value.lower()
+        return entity_contains
+
+    if condition_type in ("entity_greater", "entity_less"):
+        greater = condition_type == "entity_greater"
+        expected = _to_float(c.get("value"))
+        if expected is None:
+            return _compile_date_compare(entity_id, c.get("value"), greater)
+
+        def entity_compare(session, message):
+            number = session.entities.number(entity_id)
+            if number is None:
+                return False
+            return number > expected if greater else number < expected
+        return entity_compare
+
+    if condition_type == "entity_is_any_of":
+        values = c.get("values", [])
+        if not values:
+            return _never
+        allowed = frozenset(_normalize(v) for v in values)
+
+        def entity_is_any_of(session, message):
+            value = value_of(session)
+            return value is not None and value.lower() in allowed
+        return entity_is_any_of
+
+    return _never
+
+
+RELATIVE_DATES = {
+    "now": lambda: timezone.now(),
+    "ahora": lambda: timezone.now(),
+    "today": lambda: timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0),
+    "hoy": lambda: timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
+def _compile_date_compare(entity_id, value, greater):
+    """
+    entity_greater / entity_less con una fecha ISO o "today"/"now" como
+    valor: compara contra la fecha ya interpretada al guardar (value_date).
+    """
+    from .entities import parse_iso
+
+    relative = RELATIVE_DATES.get(_normalize(value)) if value is not None else None
+    fixed = None if relative else parse_iso(value)
+    if relative is None and fixed is None:
+        return _never
+
+    def entity_compare_date(session, message):
+        date = session.entities.date(entity_id)
+        if date is None:
+            return False
+        expected = relative() if relative else fixed
+        return date > expected if greater else date < expected
+    return entity_compare_date
+
+
+# --- Condiciones de mensaje ---
+
+def _compile_message_condition(c):
+    condition_type = c.get("type")
+
+    if condition_type == "message_is_any_of":
+        values = c.get("values", [])
+        if not values:
+            return _never
+        allowed = frozenset(_normalize(v) for v in values)
+
+        def message_is_any_of(session, message):
+            return message.load() and message.lower in allowed
+        return message_is_any_of
+
+    expected = c.get("value")
+    if expected is None:
+        return _never
+
+    if condition_type == "message_matches_regex":
+        try:
+            regex = re.compile(str(expected), re.IGNORECASE)
+        except re.error as e:
+            print(f"❌ Error en expresión regular '{expected}': {e}")
+            return _never
+
+        def message_matches_regex(session, message):
+            return message.load() and regex.search(message.clean) is not None
+        return message_matches_regex
+
+    expected = _normalize(expected)
+
+    if condition_type == "message_equals":
+        def message_equals(session, message):
+            return message.load() and message.lower == expected
+        return message_equals
+
+    if condition_type == "message_contains":
+        def message_contains(session, message):
+            return message.load() and expected in message.lower
+        return message_contains
+
+    if condition_type == "message_starts_with":
+        def message_starts_with(session, message):
+            return message.load() and message.lower.startswith(expected)
+        return message_starts_with
+
+    if condition_type == "message_ends_with":
+        def message_ends_with(session, message):
+            return message.load() and message.lower.endswith(expected)
+        return message_ends_with
+
+    return _never
+
+
+def _compile_single_condition(c):
+    condition_type = c.get("type")
+    if condition_type in ENTITY_CONDITIONS:
+        return _compile_entity_condition(c)
+    if condition_type in MESSAGE_CONDITIONS:
+        return _compile_message_condition(c)
+    return _never
+
+
+def _compile(condition):
+    if not isinstance(condition, dict) or condition.get("type") != "conditions":
+        return _never
+
+    conditions_list = condition.get("conditions", [])
+    if not conditions_list or not all(isinstance(c, dict) for c in conditions_list):
+        return _never
+
+    predicates = tuple(_compile_single_condition(c) for c in conditions_list)
+    # "single" es AND; cualquier otro valor se evalúa como OR
+    combine = all if condition.get("logic", "single") == "single" else any
+
+    if len(predicates) == 1:
+        predicate = predicates[0]
+
+        def evaluate(session, message=None):
+            return predicate(session, as_message_view(session, message))
+        return evaluate
+
+    def evaluate(session, message=None):
+        message = as_message_view(session, message)
+        return combine(p(session, message) for p in predicates)
+    return evaluate
+
+
+@lru_cache(maxsize=4096)
+def _compile_cached(key):
+    return _compile(json.loads(key))
+
+
+def compile_condition(condition):
+    """
+    Compila un objeto de condición (JSON de Path.condition) en una función
+    `evaluate(session, message)` que retorna bool.
+
+    Los valores esperados se normalizan, las listas se convierten en
+    frozensets y las expresiones regulares se compilan una sola vez.
+    Condiciones idénticas comparten la misma función compilada.
+    """
+    try:
+        key = json.dumps(condition, sort_keys=True)
+    except (TypeError, ValueError):
+        return _compile(condition)
+    return _compile_cached(key)
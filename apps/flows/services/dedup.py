@@ -0,0 +1,100 @@
+# apps/flows/services/dedup.py
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+# (team_id, external_id) -> respuesta, los más recientes al final
+_recent = OrderedDict()
+_lock = threading.Lock()
+
+
+def _cache_size():
+    return getattr(settings, 'FLOWS_DEDUP_CACHE_SIZE', 10000)
+
+
+def _remember_local(team_id, external_id, response):
+    key = (team_id, str(external_id))
+    with _lock:
+        _recent[key] = response
+        _recent.move_to_end(key)
+        while len(_recent) > _cache_size():
+            _recent.popitem(last=False)
+
+
+def cached_response(team_id, external_id):
+    """Respuesta de una entrega reciente de este proceso, sin tocar la BD"""
+    key = (team_id, str(external_id))
+    with _lock:
+        response = _recent.get(key)
+        if response is not None:
+            _recent.move_to_end(key)
+        return response
+
+
+def stored_responses(team_id, external_ids):
+    """
+    Respuestas ya guardadas de los `external_ids` dados: primero la caché
+    en proceso y después una sola consulta para el resto.
+    Retorna {external_id: response}.
+    """
+    from ..models import WebhookDelivery
+
+    found = {}
+    missing = []
+    for external_id in {str(e) for e in external_ids}:
+        response = cached_response(team_id, external_id)
+        if response is not None:
+            found[external_id] = response
+        else:
+            missing.append(external_id)
+
+    if missing:
+        rows = WebhookDelivery.objects.filter(
+            team_id=team_id, external_id__in=missing
+        ).values_list('external_id', 'response')
+        for external_id, response in rows:
+            found[external_id] = response
+            _remember_local(team_id, external_id, response)
+    return found
+
+
+def stored_response(team_id, external_id):
+    return stored_responses(team_id, [external_id]).get(str(external_id))
+
+
+def delivery_record(team_id, flow_id, sender_id, external_id, response):
+    """
+    WebhookDelivery sin guardar, para insertarlo en el mismo flush (y la
+    misma transacción) que el paso del flujo que registra
+    """
+    from ..models import WebhookDelivery
+
+    return WebhookDelivery(
+        team_id=team_id,
+        flow_id=flow_id,
+        sender_id=sender_id,
+        external_id=str(external_id),
+        response=response,
+    )
+
+
+def remember_on_commit(team_id, deliveries):
+    """
+    Agrega [(external_id, response), ...] a la caché en proceso cuando la
+    transacción actual confirma (de inmediato si no hay una abierta)
+    """
+    deliveries = list(deliveries)
+    if not deliveries:
+        return
+
+    def remember():
+        for external_id, response in deliveries:
+            _remember_local(team_id, external_id, response)
+    transaction.on_commit(remember)
+
+
+def clear_dedup_cache():
+    with _lock:
+        _recent.clear()
@@ -0,0 +1,289 @@
+# apps/flows/services/entities.py
+import math
+from datetime import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .commands import normalize_text
+
+TEXT_COLUMN_LENGTH = 255
+
+
+def extract_value(raw_value):
+    """
+    Valor de un EntityValue tal como lo usan las condiciones:
+    'processed' si existe, si no 'raw', si no el diccionario como texto.
+    """
+    if isinstance(raw_value, dict):
+        if 'processed' in raw_value:
+            return raw_value['processed']
+        if 'raw' in raw_value:
+            return raw_value['raw']
+        return str(raw_value)
+    return raw_value
+
+
+def template_value(raw_value):
+    """Valor de un EntityValue tal como se sustituye en los templates"""
+    if isinstance(raw_value, dict):
+        return raw_value.get('processed') or raw_value.get('raw', '')
+    return raw_value
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def parse_iso(text):
+    """datetime (con zona) de un texto ISO '2025-06-30' / '2025-06-30T17:00:00-06:00' o None"""
+    if not isinstance(text, str):
+        return None
+    text = text.strip()
+    try:
+        parsed = parse_datetime(text)
+        if parsed is None:
+            day = parse_date(text)
+            parsed = datetime(day.year, day.month, day.day) if day else None
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _date(raw_value, value):
+    """'iso' del EntityValue si lo trae; si no, el valor procesado si es una fecha ISO"""
+    if isinstance(raw_value, dict) and raw_value.get('iso'):
+        parsed = parse_iso(raw_value['iso'])
+        if parsed is not None:
+            return parsed
+    return parse_iso(value)
+
+
+def date_iso(text):
+    """
+    Fecha ISO de lo que escribió el usuario: '2025-06-30', '30/06',
+    'mañana a las 5'... (ver DateTimeExtractor). None si no hay fecha.
+    """
+    if not isinstance(text, str) or not text.strip():
+        return None
+    parsed = parse_iso(text)
+    if parsed is None:
+        from apps.citas.utils import get_date_time_extractor
+        parsed = get_date_time_extractor().extraer_fecha_hora(text)
+    return parsed.isoformat() if parsed is not None else None
+
+
+def with_date_iso(entity, value):
+    """En las entidades DATE agrega a `value` la fecha interpretada como 'iso', junto al texto"""
+    if entity.type == 'DATE':
+        iso = date_iso(value.get('processed') or value.get('raw'))
+        if iso:
+            value['iso'] = iso
+    return value
+
+
+def typed_columns(raw_value):
+    """
+    (value_num, value_date, value_text) de un EntityValue: el valor de
+    extract_value como número, como fecha y como texto normalizado. Lo que
+    no se puede convertir queda en None (o '' para el texto).
+    """
+    value = extract_value(raw_value)
+    if value is None:
+        return None, None, ''
+    return _number(value), _date(raw_value, value), normalize_text(value)[:TEXT_COLUMN_LENGTH]
+
+
+class EntitySnapshot:
+    """
+    Valores de entidad de un sender dentro de un team, cargados con una
+    sola consulta la primera vez que se necesitan. Condiciones y templates
+    comparten la misma copia y las escrituras del request la actualizan en
+    memoria, así que no hace falta volver a consultar.
+    """
+
+    def __init__(self, team_id, sender_id):
+        self.team_id = team_id
+        self.sender_id = sender_id
+        self._rows = None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            from ..models import EntityValue
+            self._rows = {}
+            entity_values = EntityValue.objects.filter(
+                team_id=self.team_id,
+                sender_id=self.sender_id,
+            ).select_related('entity')
+            for ev in entity_values:
+                self._rows[ev.entity_id] = {
+                    'slug': ev.entity.slug,
+                    'name': ev.entity.name,
+                    'value': ev.value,
+                    'num': ev.value_num,
+                    'date': ev.value_date,
+                    'created_at': ev.created_at,
+                }
+        return self._rows
+
+    def ids(self):
+        return list(self.rows)
+
+    def has(self, entity_id):
+        return entity_id in self.rows
+
+    def value(self, entity_id):
+        try:
+            row = self.rows.get(int(entity_id))
+        except (TypeError, ValueError):
+            return None
+        if row is None:
+            return None
+        return extract_value(row['value'])
+
+    def number(self, entity_id):
+        """Valor como número (la columna value_num ya calculada) o None"""
+        try:
+            row = self.rows.get(int(entity_id))
+        except (TypeError, ValueError):
+            return None
+        if row is None:
+            return None
+        if 'num' in row:
+            return row['num']
+        return _number(extract_value(row['value']))
+
+    def date(self, entity_id):
+        """Valor como fecha (la columna value_date ya calculada) o None"""
+        try:
+            row = self.rows.get(int(entity_id))
+        except (TypeError, ValueError):
+            return None
+        if row is None:
+            return None
+        if 'date' in row:
+            return row['date']
+        return _date(row['value'], extract_value(row['value']))
+
+    def variables(self, slugs=None):
+        """Diccionario slug -> valor para renderizar templates (opcionalmente solo `slugs`)"""
+        return {
+            row['slug']: template_value(row['value'])
+            for row in self.rows.values()
+            if slugs is None or row['slug'] in slugs
+        }
+
+    def debug(self):
+        result = {}
+        for entity_id, row in self.rows.items():
+            raw_value = row['value']
+            if isinstance(raw_value, dict):
+                processed_value = raw_value.get('processed', raw_value.get('raw', str(raw_value)))
+            else:
+                processed_value = raw_value
+            result[entity_id] = {
+                'raw_value': raw_value,
+                'processed_value': processed_value,
+                'entity_name': row['name'],
+                'created_at': row['created_at'],
+            }
+        return result
+
+    def set(self, entity, value):
+        """Refleja en memoria un EntityValue recién guardado"""
+        previous = self.rows.get(entity.id)
+        num, date, _ = typed_columns(value)
+        self.rows[entity.id] = {
+            'slug': entity.slug,
+            'name': entity.name,
+            'value': value,
+            'num': num,
+            'date': date,
+            'created_at': previous['created_at'] if previous else timezone.now(),
+        }
+
+    def clear(self):
+        """Refleja en memoria el borrado de todos los valores del sender"""
+        self._rows = {}
+
+
+def store_entity_values(session, values, node_id=None, source=None):
+    """
+    Guarda {slug: valor} como EntityValue del sender de la sesión. Los
+    slugs que no son entidades del team se ignoran. Retorna {slug: valor}
+    guardados.
+    """
+    from ..models import Entity
+
+    entities = {
+        e.slug: e
+        for e in Entity.objects.filter(team_id=session.team_id, slug__in=list(values))
+    }
+    items = []
+    for slug, processed in values.items():
+        entity = entities.get(slug)
+        if entity is None:
+            print(f"⚠️ No existe la entidad '{slug}' en el team {session.team_id}")
+            continue
+        items.append((entity, processed, processed))
+    return store_entities(session, items, node_id=node_id, source=source)
+
+
+def store_entities(session, items, node_id=None, source=None):
+    """
+    Guarda [(entidad, valor procesado, texto original)] como EntityValue
+    del sender (una sola sentencia INSERT ... ON CONFLICT donde se soporta)
+    y lo refleja en el snapshot y en session.context['collected_entities'].
+    Retorna {slug: valor procesado}.
+    """
+    from ..models import EntityValue
+    from .upserts import TAKE_NEW, supports_upsert, upsert_returning
+
+    if not items:
+        return {}
+    timestamp = timezone.now().isoformat()
+    rows = [
+        (entity, with_date_iso(entity, {
+            'raw': raw,
+            'processed': processed,
+            'node_id': node_id,
+            'timestamp': timestamp,
+            'entity_type': entity.type,
+            'source': source,
+        }))
+        for entity, processed, raw in items
+    ]
+
+    objs = [
+        EntityValue(entity_id=entity.id, team_id=session.team_id, sender_id=session.sender_id, value=value)
+        for entity, value in rows
+    ]
+    if supports_upsert(EntityValue):
+        for obj in objs:
+            obj.fill_typed_columns()
+        upsert_returning(EntityValue, objs, ['entity', 'team', 'sender_id'], {
+            'value': TAKE_NEW, 'value_num': TAKE_NEW, 'value_date': TAKE_NEW, 'value_text': TAKE_NEW,
+        })
+    else:
+        for obj in objs:
+            EntityValue.objects.update_or_create(
+                entity_id=obj.entity_id,
+                team_id=obj.team_id,
+                sender_id=obj.sender_id,
+                defaults={'value': obj.value},
+            )
+
+    collected = session.context.setdefault('collected_entities', {})
+    for entity, value in rows:
+        session.entities.set(entity, value)
+        collected[entity.slug] = value['processed']
+    return {entity.slug: value['processed'] for entity, value in rows}
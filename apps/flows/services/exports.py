@@ -0,0 +1,110 @@
+# apps/flows/services/exports.py
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+
+def _ttl():
+    # Igual que el grafo compilado: acota cuánto tarda otro worker en ver una edición
+    return getattr(settings, 'FLOWS_EXPORT_CACHE_TTL', 60)
+
+
+def _cache_size():
+    # Cada flujo consultado ocupa una entrada con su JSON completo
+    return getattr(settings, 'FLOWS_EXPORT_CACHE_SIZE', 200)
+
+
+def flow_detail_nodes():
+    """
+    Prefetch de nodos para FlowDetailSerializer: entidad a colectar y
+    default path en el mismo SELECT de los nodos y los paths de todos los
+    nodos (con su destino) en uno solo.
+    """
+    from ..models import Node, Path
+
+    return Prefetch(
+        'nodes',
+        queryset=Node.objects.select_related('collect_entity', 'default_path').prefetch_related(
+            Prefetch('paths', queryset=Path.objects.select_related('target_node'))
+        ),
+    )
+
+
+def render_flow_detail(flow):
+    """JSON de FlowDetailSerializer para `flow` con un número fijo de consultas"""
+    from ..models import Flow
+    from ..serializers import FlowDetailSerializer
+
+    flow = Flow.objects.prefetch_related(flow_detail_nodes()).get(pk=flow.pk)
+    data = FlowDetailSerializer(flow).data
+    node_ids = frozenset(node['id'] for node in data['nodes'])
+    return json.dumps(data, cls=DjangoJSONEncoder).encode(), node_ids
+
+
+def make_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """True si la cabecera If-None-Match incluye `etag` (o es *)"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+# --- Caché en proceso por (flow_id, version) ---
+
+# (flow_id, version) -> (cuerpo, etag, team_id, node_ids, guardado), en orden de uso (LRU)
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _cached(key):
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+        return entry
+
+
+def get_flow_detail(flow):
+    """(cuerpo JSON, ETag) del detalle del flujo, renderizado una vez por TTL o edición"""
+    key = (flow.id, flow.version)
+    now = time.monotonic()
+    entry = _cached(key)
+    if entry is not None and now - entry[4] < _ttl():
+        return entry[0], entry[1]
+
+    body, node_ids = render_flow_detail(flow)
+    etag = make_etag(body)
+    with _lock:
+        # Las versiones anteriores del flujo ya no se piden (la clave usa flow.version)
+        for old in [k for k in _cache if k[0] == flow.id and k != key]:
+            del _cache[old]
+        _cache[key] = (body, etag, flow.team_id, node_ids, now)
+        _cache.move_to_end(key)
+        while len(_cache) > _cache_size():
+            _cache.popitem(last=False)
+    return body, etag
+
+
+def invalidate_flow_detail(flow_id=None, team_id=None, node_id=None):
+    """Descarta el detalle en caché de un flujo, del flujo que contiene `node_id` o de todo un team"""
+    with _lock:
+        for key, (_, _, cached_team_id, node_ids, _) in list(_cache.items()):
+            if (flow_id is not None and key[0] == flow_id) or \
+               (team_id is not None and cached_team_id == team_id) or \
+               (node_id is not None and node_id in node_ids):
+                del _cache[key]
+
+
+def clear_flow_detail_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,187 @@
+# apps/flows/services/extraction.py
+import re
+import threading
+import time
+from typing import Dict, Tuple
+
+from django.conf import settings
+
+from .commands import normalize_text
+from .options import option_aliases, option_label
+
+MONTHS = (
+    'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio',
+    'agosto', 'septiembre', 'setiembre', 'octubre', 'noviembre', 'diciembre',
+)
+
+# Patrones sobre el texto normalizado (minúsculas, sin acentos); el orden
+# de la alternancia decide qué gana cuando dos se solapan
+PATTERNS = (
+    ('EMAIL', r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+'),
+    ('DATE',
+     r'\b\d{4}-\d{1,2}-\d{1,2}\b'
+     r'|\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b'
+     r'|\b\d{1,2} de (?:' + '|'.join(MONTHS) + r')(?: de(?:l)? \d{4})?\b'),
+    ('PHONE', r'(?<![\w+])\+?\d[\d ().-]{7,}\d(?!\w)'),
+    ('NUMBER', r'(?<![\w.,])-?\d+(?:[.,]\d+)*(?![\w])'),
+)
+
+MIN_ALIAS_LENGTH = 3
+
+
+def _ttl():
+    return getattr(settings, 'FLOWS_EXTRACTOR_CACHE_TTL', 60)
+
+
+def _phone(text):
+    digits = re.sub(r'\D', '', text)
+    if not 10 <= len(digits) <= 15:
+        return None
+    return ('+' if text.startswith('+') else '') + digits
+
+
+def _number(text):
+    # "5.000" / "5,000" son miles; "12,5" / "12.5" decimales
+    if re.fullmatch(r'-?\d{1,3}(?:[.,]\d{3})+', text):
+        return re.sub(r'[.,]', '', text)
+    return text.replace(',', '.')
+
+
+NORMALIZERS = {
+    'EMAIL': lambda text: text,
+    'DATE': lambda text: text,
+    'PHONE': _phone,
+    'NUMBER': _number,
+}
+
+
+class TeamExtractor:
+    """
+    Las entidades auto_extract de un team compiladas en una sola expresión
+    regular: email, teléfono, fecha, número y los alias de las opciones de
+    las MULTIPLE_CHOICE. Un mensaje se recorre una sola vez para todas.
+    """
+
+    def __init__(self, entities):
+        self.entities = tuple(entities)
+        self._by_type = {}
+        self._aliases = {}  # alias normalizado -> [(entidad, opción)]
+
+        for entity in self.entities:
+            if entity.type == 'MULTIPLE_CHOICE':
+                for text, idx in option_aliases(entity.options, entity.fuzzy_aliases):
+                    alias = normalize_text(text)
+                    if len(alias) < MIN_ALIAS_LENGTH:
+                        continue
+                    targets = self._aliases.setdefault(alias, [])
+                    if all(e.id != entity.id for e, _ in targets):
+                        targets.append((entity, entity.options[idx]))
+            elif entity.type in NORMALIZERS:
+                self._by_type.setdefault(entity.type, []).append(entity)
+
+        groups = [f'(?P<{kind}>{pattern})' for kind, pattern in PATTERNS if kind in self._by_type]
+        if self._aliases:
+            # Los alias más largos primero para que "limpieza dental" gane a "limpieza"
+            alternatives = '|'.join(re.escape(a) for a in sorted(self._aliases, key=len, reverse=True))
+            groups.append(rf'(?P<ALIAS>(?<!\w)(?:{alternatives})(?!\w))')
+        self._regex = re.compile('|'.join(groups)) if groups else None
+
+    def __bool__(self):
+        return self._regex is not None
+
+    def extract(self, message, answer=False, exclude=()):
+        """
+        Valores encontrados en `message`: [(entidad, valor procesado, texto)].
+        Cada coincidencia se asigna a una sola entidad: la primera (por id)
+        de su tipo que todavía no tiene valor y no está en `exclude`; así
+        dos teléfonos llenan dos entidades PHONE en orden y uno solo no se
+        copia en todas. Con answer=True (el mensaje responde a una pregunta)
+        no se toma un valor que ocupe el mensaje completo: esa respuesta es
+        de la pregunta actual.
+        """
+        if self._regex is None or not message:
+            return []
+        text = normalize_text(message)
+        exclude = set(exclude)
+        found = {}
+        for m in self._regex.finditer(text):
+            if answer and m.start() == 0 and m.end() == len(text):
+                continue
+            kind = m.lastgroup
+            raw = m.group()
+            if kind == 'ALIAS':
+                candidates = [
+                    (entity, option_label(option)) for entity, option in self._aliases.get(raw, ())
+                ]
+            else:
+                processed = NORMALIZERS[kind](raw)
+                if processed is None:
+                    continue
+                candidates = [(entity, processed) for entity in self._by_type[kind]]
+            for entity, value in candidates:
+                if entity.id not in found and entity.id not in exclude:
+                    found[entity.id] = (entity, value, raw)
+                    break
+        return list(found.values())
+
+
+# --- Caché en proceso por team ---
+
+_cache: Dict[int, Tuple[TeamExtractor, float]] = {}
+_lock = threading.Lock()
+
+
+def get_team_extractor(team_id):
+    """Extractor de las entidades auto_extract del team, compilado una vez por TTL"""
+    from ..models import Entity
+    from .graph import compile_entity
+
+    now = time.monotonic()
+    entry = _cache.get(team_id)
+    if entry is not None and now - entry[1] < _ttl():
+        return entry[0]
+
+    entities = Entity.objects.filter(team_id=team_id, auto_extract=True).order_by('id').values(
+        'id', 'name', 'slug', 'type', 'options', 'auto_extract', 'fuzzy_aliases', 'team_id'
+    )
+    extractor = TeamExtractor(compile_entity(e) for e in entities)
+    with _lock:
+        _cache[team_id] = (extractor, now)
+    return extractor
+
+
+def invalidate_team_extractor(team_id):
+    with _lock:
+        _cache.pop(team_id, None)
+
+
+def clear_extractor_cache():
+    with _lock:
+        _cache.clear()
+
+
+def auto_extract(session, message, current_node=None):
+    """
+    Guarda las entidades auto_extract del team que el usuario mencionó en
+    `message` y que la sesión todavía no tiene, en un solo upsert. La
+    entidad que colecta el nodo actual se deja a la captura normal.
+    Retorna {slug: valor}.
+    """
+    from .entities import store_entities
+
+    extractor = get_team_extractor(session.team_id)
+    if not extractor:
+        return {}
+
+    collecting = current_node.collect_entity if current_node is not None else None
+    exclude = {entity.id for entity in extractor.entities if session.entities.has(entity.id)}
+    if collecting is not None:
+        exclude.add(collecting.id)
+    items = extractor.extract(message, answer=collecting is not None, exclude=exclude)
+    if not items:
+        return {}
+    stored = store_entities(
+        session, items, node_id=current_node.id if current_node is not None else None, source='auto_extract'
+    )
+    print(f"🔎 Entidades extraídas del mensaje: {stored}")
+    return stored
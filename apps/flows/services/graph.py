@@ -0,0 +1,406 @@
+# apps/flows/services/graph.py
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+
+from .commands import COMMAND_MENU, COMMAND_NODE, COMMAND_RESTART, normalize_text, team_commands
+from .conditions import compile_condition
+from .options import OptionMatcher
+from .templates import CompiledTemplate, options_suffix
+
+
+@dataclass(frozen=True)
+class CompiledEntity:
+    """Copia inmutable de una Entity usada por el motor de flujos"""
+    id: int
+    name: str
+    slug: str
+    type: str
+    options: Tuple = ()
+    auto_extract: bool = False
+    fuzzy_aliases: Optional[object] = None
+    team_id: Optional[int] = None
+    option_matcher: Optional[OptionMatcher] = field(repr=False, compare=False, default=None)
+
+
+@dataclass(frozen=True)
+class CompiledPath:
+    """Copia inmutable de un Path con su nodo destino ya resuelto por id"""
+    id: int
+    node_id: int
+    label: str
+    enabled: bool
+    condition: Optional[dict]
+    target_node_id: Optional[int]
+    order: int
+    predicate: Optional[Callable] = field(repr=False, compare=False, default=None)
+    graph: 'FlowGraph' = field(repr=False, compare=False, default=None)
+
+    @property
+    def target_node(self):
+        if self.target_node_id is None or self.graph is None:
+            return None
+        return self.graph.node(self.target_node_id)
+
+
+@dataclass(frozen=True)
+class CompiledNode:
+    """
+    Copia inmutable de un Node. Expone los mismos atributos que el modelo
+    (id, type, title, message_template, collect_entity, ...) para que las
+    vistas puedan usarlo indistintamente.
+    """
+    id: int
+    type: str
+    title: str
+    message_template: str
+    collect_entity: Optional[CompiledEntity]
+    collect_entity_mode: str
+    ui_settings: Optional[dict]
+    config: Optional[dict]
+    paths: Tuple[CompiledPath, ...]
+    default_path_id: Optional[int]
+    graph: 'FlowGraph' = field(repr=False, compare=False, default=None)
+    template: Optional[CompiledTemplate] = field(repr=False, compare=False, default=None)
+    # Config precompilada de los nodos que ejecutan algo (WEBHOOK, SCRIPT)
+    action: Optional[object] = field(repr=False, compare=False, default=None)
+
+    @property
+    def default_path(self):
+        if self.default_path_id is None or self.graph is None:
+            return None
+        return self.graph.path(self.default_path_id)
+
+    def __str__(self):
+        return f"{self.title} ({self.type})"
+
+
+class FlowGraph:
+    """
+    Grafo compilado de un Flow: nodos, paths ordenados, destinos, entidades
+    y default paths. Se construye una sola vez por (flow.id, flow.version)
+    y se recorre sin consultas a la base de datos.
+    """
+
+    def __init__(self, flow_id, version, team_id):
+        self.flow_id = flow_id
+        self.version = version
+        self.team_id = team_id
+        # FlowVersion de la que sale el grafo; None para el grafo vivo
+        self.version_id = None
+        self.start_node_id = None
+        self._nodes: Dict[int, CompiledNode] = {}
+        self._paths: Dict[int, CompiledPath] = {}
+        self._titles: Dict[str, int] = {}
+        # texto normalizado -> (acción, node_id)
+        self._intercepts: Dict[str, Tuple[str, Optional[int]]] = {}
+
+    def node(self, node_id):
+        return self._nodes.get(node_id)
+
+    def path(self, path_id):
+        return self._paths.get(path_id)
+
+    @property
+    def nodes(self):
+        return self._nodes.values()
+
+    @property
+    def start_node(self):
+        if self.start_node_id is None:
+            return None
+        return self._nodes.get(self.start_node_id)
+
+    def node_by_title(self, title):
+        """Nodo cuyo título coincide exactamente con `title`"""
+        node_id = self._titles.get(title)
+        return self._nodes.get(node_id) if node_id is not None else None
+
+    def intercept(self, message):
+        """
+        Comando global que corresponde a `message`, con una sola búsqueda:
+        (COMMAND_NODE, nodo) si es el título de un nodo marcado como
+        intercept o la palabra clave del menú, (COMMAND_RESTART, None) para reiniciar, o None.
+        """
+        if not message:
+            return None
+        hit = self._intercepts.get(normalize_text(message))
+        if hit is None:
+            return None
+        action, node_id = hit
+        return action, self._nodes.get(node_id) if node_id is not None else None
+
+    # --- Construcción ---
+
+    @classmethod
+    def build(cls, flow):
+        """Compila el grafo vivo (Node/Path/Entity) de `flow`"""
+        return cls.from_snapshot(
+            flow.id, flow.version, flow.team_id, serialize_flow(flow), team_commands(flow.team)
+        )
+
+    @classmethod
+    def load_version(cls, flow, version_id):
+        """Compila una versión publicada de `flow` con una lectura por PK del snapshot"""
+        from ..models import FlowVersion
+
+        snapshot = FlowVersion.objects.get(pk=version_id, flow_id=flow.id)
+        graph = cls.from_snapshot(
+            snapshot.flow_id, snapshot.version, flow.team_id, snapshot.graph, team_commands(flow.team)
+        )
+        graph.version_id = snapshot.id
+        return graph
+
+    @classmethod
+    def from_snapshot(cls, flow_id, version, team_id, data, commands):
+        """Compila el grafo a partir del JSON de serialize_flow()"""
+        from ..models import NodeType
+
+        graph = cls(flow_id, version, team_id)
+
+        entities = {e['id']: compile_entity(e) for e in data.get('entities', [])}
+
+        paths = data.get('paths', [])
+        for p in paths + data.get('extra_paths', []):
+            graph._paths[p['id']] = CompiledPath(
+                id=p['id'],
+                node_id=p['node_id'],
+                label=p['label'],
+                enabled=p['enabled'],
+                condition=p['condition'],
+                target_node_id=p['target_node_id'],
+                order=p['order'],
+                predicate=compile_condition(p['condition']) if p['condition'] else None,
+                graph=graph,
+            )
+
+        # paths ya vienen ordenados por (order, id)
+        paths_by_node = {}
+        for p in paths:
+            paths_by_node.setdefault(p['node_id'], []).append(graph._paths[p['id']])
+
+        nodes = data.get('nodes', [])
+        for n in nodes:
+            entity = entities.get(n['collect_entity_id'])
+            graph._nodes[n['id']] = CompiledNode(
+                id=n['id'],
+                type=n['type'],
+                title=n['title'],
+                message_template=n['message_template'],
+                collect_entity=entity,
+                collect_entity_mode=n['collect_entity_mode'],
+                ui_settings=n['ui_settings'],
+                config=n.get('config'),
+                paths=tuple(paths_by_node.get(n['id'], ())),
+                default_path_id=n['default_path_id'],
+                graph=graph,
+                template=CompiledTemplate(
+                    n['message_template'] or f"Nodo: {n['title']}", options_suffix(entity)
+                ),
+                action=compile_action(n['type'], n.get('config')),
+            )
+            graph._titles.setdefault(n['title'], n['id'])
+            if graph.start_node_id is None and n['type'] == NodeType.START:
+                graph.start_node_id = n['id']
+
+        graph._build_intercepts(nodes, commands)
+        return graph
+
+    def _build_intercepts(self, nodes, commands):
+        # Solo palabras clave de comandos y títulos de nodos marcados con
+        # config {"intercept": true}: un título cualquiera ("Confirmar")
+        # también puede ser una respuesta normal a la pregunta actual
+        titles = {}
+        marked = {}
+        for n in nodes:
+            title = normalize_text(n['title'])
+            titles.setdefault(title, n['id'])
+            config = n.get('config')
+            if isinstance(config, dict) and config.get('intercept'):
+                marked.setdefault(title, n['id'])
+
+        # Los títulos marcados tienen prioridad sobre las palabras clave
+        for keyword in commands.get(COMMAND_RESTART, ()):
+            self._intercepts[keyword] = (COMMAND_RESTART, None)
+        menu_keywords = commands.get(COMMAND_MENU, ())
+        menu_node_id = next((titles[k] for k in menu_keywords if k in titles), None)
+        if menu_node_id is not None:
+            for keyword in menu_keywords:
+                self._intercepts[keyword] = (COMMAND_NODE, menu_node_id)
+        for title, node_id in marked.items():
+            self._intercepts[title] = (COMMAND_NODE, node_id)
+
+
+def serialize_flow(flow):
+    """
+    Grafo vivo de `flow` como JSON (el formato de FlowVersion.graph), con un
+    número constante de consultas.
+    """
+    from ..models import Node, Path
+
+    nodes = list(
+        Node.objects.filter(flow_id=flow.id)
+        .select_related('collect_entity')
+        .order_by('id')
+    )
+    paths = list(Path.objects.filter(node__flow_id=flow.id).order_by('order', 'id'))
+    path_ids = {p.id for p in paths}
+
+    # default_path puede apuntar a un path fuera del flujo; se cargan aparte
+    missing = {n.default_path_id for n in nodes if n.default_path_id and n.default_path_id not in path_ids}
+    extra_paths = list(Path.objects.filter(id__in=missing)) if missing else []
+
+    entities = {}
+    for n in nodes:
+        if n.collect_entity_id and n.collect_entity_id not in entities:
+            e = n.collect_entity
+            entities[e.id] = {
+                'id': e.id,
+                'name': e.name,
+                'slug': e.slug,
+                'type': e.type,
+                'options': e.options,
+                'auto_extract': e.auto_extract,
+                'fuzzy_aliases': e.fuzzy_aliases,
+                'team_id': e.team_id,
+            }
+
+    def path_data(p):
+        return {
+            'id': p.id,
+            'node_id': p.node_id,
+            'label': p.label,
+            'enabled': p.enabled,
+            'condition': p.condition,
+            'target_node_id': p.target_node_id,
+            'order': p.order,
+        }
+
+    return {
+        'nodes': [
+            {
+                'id': n.id,
+                'type': n.type,
+                'title': n.title,
+                'message_template': n.message_template,
+                'collect_entity_id': n.collect_entity_id,
+                'collect_entity_mode': n.collect_entity_mode,
+                'ui_settings': n.ui_settings,
+                'config': n.config,
+                'default_path_id': n.default_path_id,
+            }
+            for n in nodes
+        ],
+        'paths': [path_data(p) for p in paths],
+        'extra_paths': [path_data(p) for p in extra_paths],
+        'entities': list(entities.values()),
+    }
+
+
+def compile_action(node_type, config):
+    """Precompila la config de un nodo ejecutable; None para los demás tipos"""
+    from ..models import NodeType
+
+    if node_type == NodeType.WEBHOOK:
+        from .webhooks import compile_webhook
+        return compile_webhook(config)
+    if node_type == NodeType.SCRIPT:
+        from .scripts import compile_script
+        return compile_script(config)
+    return None
+
+
+def compile_entity(entity):
+    """CompiledEntity a partir del dict de una entidad del snapshot"""
+    options = entity.get('options') if isinstance(entity.get('options'), list) else ()
+    return CompiledEntity(
+        id=entity['id'],
+        name=entity['name'],
+        slug=entity['slug'],
+        type=entity['type'],
+        options=tuple(options),
+        auto_extract=entity.get('auto_extract', False),
+        fuzzy_aliases=entity.get('fuzzy_aliases'),
+        team_id=entity.get('team_id'),
+        option_matcher=OptionMatcher(options, entity.get('fuzzy_aliases')) if options else None,
+    )
+
+
+# --- Caché en proceso ---
+
+# clave -> (grafo, compilado en), los usados más recientemente al final
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _ttl():
+    # Acota cuánto tarda otro worker en ver una edición del grafo vivo
+    return getattr(settings, 'FLOWS_GRAPH_CACHE_TTL', 60)
+
+
+def _cache_size():
+    # Cada versión publicada que carga una sesión ocupa una entrada
+    return getattr(settings, 'FLOWS_GRAPH_CACHE_SIZE', 500)
+
+
+def _cached(key):
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+        return entry
+
+
+def get_flow_graph(flow, version_id=None):
+    """
+    Devuelve el grafo compilado de `flow`, compilándolo si no está en caché:
+    la versión `version_id`, si no la versión publicada del flujo y, si
+    nunca se publicó, el grafo vivo.
+    """
+    version_id = version_id or flow.published_version_id
+    now = time.monotonic()
+
+    if version_id:
+        # Los snapshots son inmutables: no caducan ni hace falta invalidarlos
+        key = (flow.id, 'version', version_id)
+        entry = _cached(key)
+        if entry is not None:
+            return entry[0]
+        graph = FlowGraph.load_version(flow, version_id)
+    else:
+        key = (flow.id, 'live', flow.version)
+        entry = _cached(key)
+        if entry is not None and now - entry[1] < _ttl():
+            return entry[0]
+        graph = FlowGraph.build(flow)
+
+    with _lock:
+        _cache[key] = (graph, now)
+        _cache.move_to_end(key)
+        while len(_cache) > _cache_size():
+            _cache.popitem(last=False)
+    return graph
+
+
+def invalidate_flow_graph(flow_id=None, team_id=None, node_id=None):
+    """
+    Descarta los grafos vivos de un flujo o del flujo que contiene
+    `node_id`, o todos los grafos de un team (sus comandos forman parte del
+    grafo compilado).
+    """
+    with _lock:
+        for key, (graph, _) in list(_cache.items()):
+            live = graph.version_id is None
+            if (team_id is not None and graph.team_id == team_id) or \
+               (live and flow_id is not None and graph.flow_id == flow_id) or \
+               (live and node_id is not None and graph.node(node_id) is not None):
+                del _cache[key]
+
+
+def clear_flow_graph_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,445 @@
+# apps/flows/services/graph_io.py
+from django.core.exceptions import ValidationError
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+EXPORT_FORMAT = 'flow-graph'
+EXPORT_FORMAT_VERSION = 1
+
+# Campos editables; las referencias (collect_entity, default_path, node,
+# target_node) se resuelven aparte porque pueden ser ids temporales
+NODE_FIELDS = (
+    'type', 'title', 'message_template', 'collect_entity_mode', 'position', 'ui_settings', 'config',
+)
+PATH_FIELDS = ('label', 'enabled', 'condition', 'order', 'temporary_hide_on_message')
+ENTITY_FIELDS = ('name', 'type', 'required_format', 'options', 'auto_extract', 'fuzzy_aliases')
+
+
+class GraphError(ValueError):
+    pass
+
+
+def _items(data, key):
+    items = data.get(key) or []
+    if not isinstance(items, list):
+        raise GraphError(f"'{key}' must be a list")
+    for item in items:
+        if not isinstance(item, dict):
+            raise GraphError(f"each item of '{key}' must be an object")
+    return items
+
+
+def _ref(value, kind):
+    """Id real (entero) u id temporal del cliente (string no vacío)"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or value == '':
+        raise GraphError(f"invalid {kind} id {value!r}")
+    return value
+
+
+def _index(items, kind, existing, owner):
+    """{ref: item} del payload; los ids enteros deben existir en `existing`"""
+    indexed = {}
+    for item in items:
+        ref = _ref(item.get('id'), kind)
+        if ref in indexed:
+            raise GraphError(f"duplicated {kind} id {ref!r}")
+        if isinstance(ref, int) and ref not in existing:
+            raise GraphError(f"{kind} {ref} does not belong to this {owner}")
+        indexed[ref] = item
+    return indexed
+
+
+def _member(value, refs, label, kind):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or value not in refs:
+        raise GraphError(f"{label}: unknown {kind} {value!r}")
+    return value
+
+
+def _clean(model, name, value, label):
+    """
+    Convierte y valida `value` para el campo. No usa field.clean(): su
+    validación de `blank` rechaza los defaults vacíos (position = {}) de
+    los objetos creados por las vistas de siempre.
+    """
+    field = model._meta.get_field(name)
+    try:
+        value = field.to_python(value)
+        if value is None:
+            if not field.null:
+                raise ValidationError(field.error_messages['null'], code='null')
+            return None
+        if field.choices and value not in {choice for choice, _ in field.flatchoices}:
+            raise ValidationError(
+                field.error_messages['invalid_choice'], code='invalid_choice', params={'value': value},
+            )
+        field.run_validators(value)
+    except ValidationError as e:
+        raise GraphError(f"{label}.{name}: {' '.join(e.messages)}")
+    return value
+
+
+def _assign(obj, item, fields, label, new):
+    """Copia los campos de `item` a `obj` (todos si es nuevo) y retorna los que cambiaron"""
+    model = type(obj)
+    changed = []
+    for name in fields:
+        if name in item:
+            value = _clean(model, name, item[name], label)
+        elif new:
+            value = _clean(model, name, model._meta.get_field(name).get_default(), label)
+        else:
+            continue
+        if getattr(obj, name) != value:
+            setattr(obj, name, value)
+            changed.append(name)
+    return changed
+
+
+def _create(model, objs):
+    """bulk_create que deja asignados los pk; uno por uno si el motor no los retorna"""
+    if not objs:
+        return
+    connection = connections[router.db_for_write(model)]
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objs)
+        return
+    for obj in objs:
+        obj.save(force_insert=True)
+
+
+def _update(model, objs, fields):
+    if objs and fields:
+        model.objects.bulk_update(objs, sorted(fields))
+
+
+def _unique_slug(base, taken):
+    base = base or 'entity'
+    slug = base
+    counter = 1
+    while slug in taken:
+        slug = f"{base}_{counter}"
+        counter += 1
+    taken.add(slug)
+    return slug
+
+
+def save_graph(flow, data):
+    """
+    Guarda el grafo completo del editor en una transacción: compara
+    nodos, paths y entidades de `data` con la BD e inserta, actualiza y
+    borra por lotes (bulk_create, bulk_update y un DELETE por modelo), con
+    un número de consultas que no depende del tamaño del grafo.
+
+    `data` = {"nodes": [...], "paths": [...], "entities": [...]} con los
+    nombres de campo de NodeSerializer/PathSerializer. Los objetos nuevos
+    llevan un id temporal (string) que pueden usar las referencias
+    (collect_entity, default_path, node, target_node). Los nodos y paths
+    del flujo que no vienen en `data` se borran; las entidades son del
+    team y solo se crean o actualizan. En objetos existentes solo se
+    tocan los campos presentes. Lanza GraphError si algo no es válido.
+
+    Retorna {created, updated, deleted, id_map: {nodes, paths, entities}}.
+    """
+    from ..models import Entity, Flow, Node, Path
+    from .exports import invalidate_flow_detail
+    from .extraction import invalidate_team_extractor
+    from .graph import invalidate_flow_graph
+
+    if not isinstance(data, dict):
+        raise GraphError('graph must be an object')
+    nodes_in = _items(data, 'nodes')
+    paths_in = _items(data, 'paths')
+    entities_in = _items(data, 'entities')
+
+    with transaction.atomic():
+        flow = Flow.objects.select_for_update().get(pk=flow.pk)
+        nodes = {n.id: n for n in Node.objects.filter(flow_id=flow.id)}
+        paths = {p.id: p for p in Path.objects.filter(node__flow_id=flow.id)}
+        node_items = _index(nodes_in, 'node', nodes, 'flow')
+        path_items = _index(paths_in, 'path', paths, 'flow')
+
+        wanted = {
+            ref for ref in [e.get('id') for e in entities_in] + [n.get('collect_entity') for n in nodes_in]
+            if isinstance(ref, int) and not isinstance(ref, bool)
+        }
+        entities = {e.id: e for e in Entity.objects.filter(team_id=flow.team_id, id__in=wanted)} if wanted else {}
+        entity_items = _index(entities_in, 'entity', entities, 'team')
+
+        # 1. Referencias: se validan todas antes de escribir
+        gone_paths = [path_id for path_id in paths if path_id not in path_items]
+        gone_nodes = [node_id for node_id in nodes if node_id not in node_items]
+
+        path_links = {}
+        for ref, item in path_items.items():
+            label = f"path {ref!r}"
+            current = paths.get(ref)
+            node = item['node'] if 'node' in item else (current.node_id if current else None)
+            if node is None:
+                raise GraphError(f"{label}: node is required")
+            node = _member(node, node_items, label, 'node')
+            if 'target_node' in item:
+                target = _member(item['target_node'], node_items, label, 'node')
+            else:
+                # Sin cambio; si su destino se borra queda en NULL
+                target = current.target_node_id if current and current.target_node_id in node_items else None
+            path_links[ref] = (node, target)
+
+        entity_refs = set(entity_items) | set(entities)
+        node_links = {}
+        for ref, item in node_items.items():
+            label = f"node {ref!r}"
+            current = nodes.get(ref)
+            links = {}
+            if 'collect_entity' in item:
+                links['collect_entity'] = _member(item['collect_entity'], entity_refs, label, 'entity')
+            if 'default_path' in item:
+                default = item['default_path']
+                # Un default_path antiguo fuera del flujo se conserva si no cambia
+                if not (current and default is not None and default == current.default_path_id and default not in paths):
+                    default = _member(default, path_items, label, 'path')
+                links['default_path'] = default
+            node_links[ref] = links
+
+        # 2. Paths que ya no están (la BD pone en NULL los default_path que los usaban)
+        if gone_paths:
+            Path.objects.filter(id__in=gone_paths).delete()
+            gone = set(gone_paths)
+            for node in nodes.values():
+                if node.default_path_id in gone:
+                    node.default_path_id = None
+
+        # 3. Entidades
+        created_entities, updated_entities, entity_fields = {}, [], set()
+        taken = None
+        for ref, item in entity_items.items():
+            label = f"entity {ref!r}"
+            current = entities.get(ref)
+            entity = current or Entity(team_id=flow.team_id)
+            changed = _assign(entity, item, ENTITY_FIELDS, label, new=current is None)
+            if current is None or ('slug' in item and slugify(item['slug'] or '') != current.slug):
+                if taken is None:
+                    taken = set(Entity.objects.filter(team_id=flow.team_id).values_list('slug', flat=True))
+                if current is not None:
+                    taken.discard(current.slug)
+                entity.slug = _unique_slug(slugify(item.get('slug') or item.get('name') or ''), taken)
+                changed.append('slug')
+            if current is None:
+                created_entities[ref] = entity
+            elif changed:
+                entity.updated_at = timezone.now()
+                updated_entities.append(entity)
+                entity_fields.update(changed, ['updated_at'])
+        _create(Entity, list(created_entities.values()))
+        _update(Entity, updated_entities, entity_fields)
+
+        def entity_id(ref):
+            if ref is None:
+                return None
+            return created_entities[ref].id if ref in created_entities else ref
+
+        # 4. Nodos (el default_path se asigna cuando existen los paths)
+        created_nodes, updated_nodes, node_fields = {}, [], set()
+        for ref, item in node_items.items():
+            current = nodes.get(ref)
+            node = current or Node(flow_id=flow.id)
+            changed = _assign(node, item, NODE_FIELDS, f"node {ref!r}", new=current is None)
+            links = node_links[ref]
+            if 'collect_entity' in links and node.collect_entity_id != entity_id(links['collect_entity']):
+                node.collect_entity_id = entity_id(links['collect_entity'])
+                changed.append('collect_entity')
+            if current is None:
+                created_nodes[ref] = node
+            elif changed:
+                updated_nodes.append(node)
+                node_fields.update(changed)
+        _create(Node, list(created_nodes.values()))
+        _update(Node, updated_nodes, node_fields)
+
+        def node_id(ref):
+            if ref is None:
+                return None
+            return created_nodes[ref].id if ref in created_nodes else ref
+
+        # 5. Paths
+        created_paths, updated_paths, path_fields = {}, [], set()
+        for ref, item in path_items.items():
+            current = paths.get(ref)
+            path = current or Path()
+            changed = _assign(path, item, PATH_FIELDS, f"path {ref!r}", new=current is None)
+            node, target = path_links[ref]
+            for field, value in (('node', node_id(node)), ('target_node', node_id(target))):
+                if getattr(path, f'{field}_id') != value:
+                    setattr(path, f'{field}_id', value)
+                    changed.append(field)
+            if current is None:
+                created_paths[ref] = path
+            elif changed:
+                updated_paths.append(path)
+                path_fields.update(changed)
+        _create(Path, list(created_paths.values()))
+        _update(Path, updated_paths, path_fields)
+
+        # 6. default_path de los nodos
+        defaults = []
+        for ref, links in node_links.items():
+            if 'default_path' not in links:
+                continue
+            default = links['default_path']
+            value = created_paths[default].id if default in created_paths else default
+            node = created_nodes.get(ref) or nodes[ref]
+            if node.default_path_id != value:
+                node.default_path_id = value
+                defaults.append(node)
+        _update(Node, defaults, {'default_path'})
+
+        # 7. Nodos que ya no están (sus paths ya se borraron en el paso 2)
+        if gone_nodes:
+            Node.objects.filter(id__in=gone_nodes).delete()
+
+    # bulk_create/bulk_update no emiten post_save
+    invalidate_flow_graph(flow_id=flow.id)
+    invalidate_flow_detail(flow_id=flow.id)
+    if created_entities or updated_entities:
+        invalidate_flow_graph(team_id=flow.team_id)
+        invalidate_flow_detail(team_id=flow.team_id)
+        invalidate_team_extractor(flow.team_id)
+
+    return {
+        'created': {
+            'nodes': len(created_nodes), 'paths': len(created_paths), 'entities': len(created_entities),
+        },
+        'updated': {
+            'nodes': len({n.id for n in updated_nodes + defaults} - {n.id for n in created_nodes.values()}),
+            'paths': len(updated_paths),
+            'entities': len(updated_entities),
+        },
+        'deleted': {'nodes': len(gone_nodes), 'paths': len(gone_paths)},
+        'id_map': {
+            'nodes': {ref: n.id for ref, n in created_nodes.items()},
+            'paths': {ref: p.id for ref, p in created_paths.items()},
+            'entities': {ref: e.id for ref, e in created_entities.items()},
+        },
+    }
+
+
+def export_flow(flow):
+    """
+    Grafo de `flow` en JSON portable (también es lo que carga el editor):
+    datos del flujo, entidades que colecta, nodos con posición y paths,
+    con sus ids actuales. Cuatro consultas sin importar el tamaño.
+    """
+    from ..models import Entity, Node, Path
+
+    nodes = list(Node.objects.filter(flow_id=flow.id).order_by('id'))
+    paths = list(Path.objects.filter(node__flow_id=flow.id).order_by('node_id', 'order', 'id'))
+    path_ids = {p.id for p in paths}
+    entity_ids = {n.collect_entity_id for n in nodes if n.collect_entity_id}
+    entities = Entity.objects.filter(id__in=entity_ids).order_by('id') if entity_ids else []
+
+    return {
+        'format': EXPORT_FORMAT,
+        'format_version': EXPORT_FORMAT_VERSION,
+        'flow': {
+            'name': flow.name,
+            'description': flow.description,
+            'is_active': flow.is_active,
+            'metadata': flow.metadata,
+        },
+        'entities': [
+            dict({'id': e.id, 'slug': e.slug}, **{name: getattr(e, name) for name in ENTITY_FIELDS})
+            for e in entities
+        ],
+        'nodes': [
+            dict(
+                {'id': n.id},
+                **{name: getattr(n, name) for name in NODE_FIELDS},
+                collect_entity=n.collect_entity_id,
+                # Un default_path fuera del flujo no se puede exportar
+                default_path=n.default_path_id if n.default_path_id in path_ids else None,
+            )
+            for n in nodes
+        ],
+        'paths': [
+            dict(
+                {'id': p.id, 'node': p.node_id, 'target_node': p.target_node_id},
+                **{name: getattr(p, name) for name in PATH_FIELDS},
+            )
+            for p in paths
+        ],
+    }
+
+
+def import_flow(team, data, name=None, user=None):
+    """
+    Crea un flujo nuevo (sin publicar) en `team` a partir de un export.
+    Las entidades se emparejan por slug con las del team y las que faltan
+    se crean; los ids del export pasan a ser ids temporales de save_graph.
+    Retorna (flow, resultado de save_graph).
+    """
+    from ..models import Entity, Flow
+
+    if not isinstance(data, dict) or data.get('format') != EXPORT_FORMAT:
+        raise GraphError(f"not a '{EXPORT_FORMAT}' export")
+    if data.get('format_version') != EXPORT_FORMAT_VERSION:
+        raise GraphError(f"unsupported format_version {data.get('format_version')!r}")
+    meta = data.get('flow') if isinstance(data.get('flow'), dict) else {}
+    name = _clean(Flow, 'name', name or meta.get('name') or 'Flujo importado', 'flow')
+    description = _clean(Flow, 'description', meta.get('description') or '', 'flow')
+    is_active = _clean(Flow, 'is_active', meta.get('is_active', True), 'flow')
+    metadata = meta.get('metadata')
+    if metadata is not None and not isinstance(metadata, dict):
+        raise GraphError('flow.metadata must be an object')
+    entities_in = _items(data, 'entities')
+    nodes_in = _items(data, 'nodes')
+    paths_in = _items(data, 'paths')
+
+    slugs = [e.get('slug') for e in entities_in if e.get('slug')]
+    existing = dict(Entity.objects.filter(team=team, slug__in=slugs).values_list('slug', 'id')) if slugs else {}
+
+    def temp(prefix, ref):
+        return None if ref is None else f"{prefix}{ref}"
+
+    entity_refs, entities = {}, []
+    for e in entities_in:
+        if e.get('slug') in existing:
+            entity_refs[e.get('id')] = existing[e['slug']]
+        else:
+            entity_refs[e.get('id')] = temp('e', e.get('id'))
+            entities.append(dict(e, id=entity_refs[e.get('id')]))
+
+    graph = {
+        'entities': entities,
+        'nodes': [
+            dict(
+                n,
+                id=temp('n', n.get('id')),
+                collect_entity=entity_refs.get(n.get('collect_entity')),
+                default_path=temp('p', n.get('default_path')),
+            )
+            for n in nodes_in
+        ],
+        'paths': [
+            dict(p, id=temp('p', p.get('id')), node=temp('n', p.get('node')), target_node=temp('n', p.get('target_node')))
+            for p in paths_in
+        ],
+    }
+
+    with transaction.atomic():
+        flow = Flow.objects.create(
+            team=team,
+            name=name,
+            description=description,
+            is_active=is_active,
+            metadata=metadata,
+            created_by=user,
+        )
+        result = save_graph(flow, graph)
+    return flow, result
+
+
+def clone_flow(flow, name=None, user=None):
+    """Copia profunda de `flow` en su mismo team (comparte sus entidades). Retorna (flow, resultado)."""
+    return import_flow(flow.team, export_flow(flow), name=name or f"{flow.name} (copia)", user=user)
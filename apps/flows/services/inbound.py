@@ -0,0 +1,236 @@
+# apps/flows/services/inbound.py
+import ipaddress
+import socket
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+
+def _max_attempts():
+    return getattr(settings, 'FLOWS_QUEUE_MAX_ATTEMPTS', 3)
+
+
+def _stale_after():
+    # Un mensaje PROCESSING más viejo que esto se considera de un worker caído
+    return getattr(settings, 'FLOWS_QUEUE_STALE_SECONDS', 300)
+
+
+def _callback_timeout():
+    return getattr(settings, 'FLOWS_QUEUE_CALLBACK_TIMEOUT', 10)
+
+
+def _callback_allowed_hosts(flow):
+    # FLOWS_CALLBACK_ALLOWED_HOSTS + metadata['callback_hosts'] del flujo.
+    # Un host que empieza con '.' acepta también sus subdominios
+    hosts = list(getattr(settings, 'FLOWS_CALLBACK_ALLOWED_HOSTS', []) or [])
+    metadata = flow.metadata if isinstance(flow.metadata, dict) else {}
+    hosts.extend(metadata.get('callback_hosts') or [])
+    return [str(h).lower() for h in hosts if h]
+
+
+def _host_allowed(host, allowed):
+    for entry in allowed:
+        if entry.startswith('.'):
+            if host == entry[1:] or host.endswith(entry):
+                return True
+        elif host == entry:
+            return True
+    return False
+
+
+def _is_public_address(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_callback_url(flow, callback_url):
+    """
+    Valida callback_url antes de encolar y antes de cada entrega. Lanza
+    ValueError si la URL no es válida, si el host no está en la lista de
+    permitidos (cuando hay una) o si resuelve a una dirección privada,
+    loopback, link-local o reservada. FLOWS_CALLBACK_ALLOW_PRIVATE=True
+    desactiva esta última revisión (solo para desarrollo).
+    """
+    try:
+        URLValidator(schemes=['http', 'https'])(callback_url)
+    except ValidationError:
+        raise ValueError('callback_url is not a valid URL')
+
+    parts = urlsplit(callback_url)
+    host = (parts.hostname or '').lower()
+    allowed = _callback_allowed_hosts(flow)
+    if allowed and not _host_allowed(host, allowed):
+        raise ValueError('callback_url host is not allowed')
+
+    if getattr(settings, 'FLOWS_CALLBACK_ALLOW_PRIVATE', False):
+        return
+    try:
+        infos = socket.getaddrinfo(host, parts.port or (443 if parts.scheme == 'https' else 80), proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError('callback_url host does not resolve')
+    if not infos or not all(_is_public_address(info[4][0]) for info in infos):
+        raise ValueError('callback_url must point to a public address')
+
+
+def enqueue_message(team, flow, data):
+    """
+    Guarda el payload en la cola. Lanza ValueError si callback_url no pasa
+    check_callback_url.
+    """
+    from ..models import InboundMessage
+
+    callback_url = data.get('callback_url') or None
+    if callback_url:
+        check_callback_url(flow, callback_url)
+
+    return InboundMessage.objects.create(
+        flow=flow,
+        team=team,
+        sender_id=str(data['sender_id']),
+        payload=data,
+        callback_url=callback_url,
+    )
+
+
+def claim_next():
+    """
+    Toma el siguiente mensaje procesable y lo marca PROCESSING. Solo se
+    toma el mensaje más antiguo de cada remitente y nunca mientras otro
+    mensaje del mismo remitente se está procesando, así el orden por
+    remitente se respeta aunque haya varios workers.
+    """
+    from ..models import InboundMessage, InboundStatus
+
+    now = timezone.now()
+    stale = now - timedelta(seconds=_stale_after())
+    claimable = Q(status=InboundStatus.PENDING) | Q(status=InboundStatus.PROCESSING, started_at__lt=stale)
+
+    same_sender = InboundMessage.objects.filter(
+        team_id=OuterRef('team_id'),
+        sender_id=OuterRef('sender_id'),
+    )
+    busy = same_sender.filter(status=InboundStatus.PROCESSING, started_at__gte=stale)
+    older = same_sender.filter(claimable, id__lt=OuterRef('id'))
+
+    with transaction.atomic():
+        queryset = (
+            InboundMessage.objects.filter(claimable)
+            .exclude(Exists(busy))
+            .exclude(Exists(older))
+            .order_by('id')
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        inbound = queryset.first()
+        if inbound is None:
+            return None
+
+        inbound.status = InboundStatus.PROCESSING
+        inbound.started_at = now
+        inbound.attempts += 1
+        inbound.save(update_fields=['status', 'started_at', 'attempts'])
+    return inbound
+
+
+def process_message(inbound):
+    """Procesa un mensaje tomado con claim_next y entrega el callback"""
+    from ..models import InboundStatus
+    from ..views import FlowWebhookView
+
+    try:
+        response = FlowWebhookView().handle_payload(inbound.team, inbound.flow, inbound.payload)
+    except Exception as e:
+        print(f"❌ Error procesando mensaje en cola #{inbound.id} (intento {inbound.attempts}): {e}")
+        inbound.error = str(e)
+        if inbound.attempts >= _max_attempts():
+            inbound.status = InboundStatus.FAILED
+            inbound.processed_at = timezone.now()
+        else:
+            inbound.status = InboundStatus.PENDING
+        inbound.save(update_fields=['status', 'error', 'processed_at'])
+    else:
+        inbound.status = InboundStatus.DONE
+        inbound.response = response
+        inbound.error = ''
+        inbound.processed_at = timezone.now()
+        inbound.save(update_fields=['status', 'response', 'error', 'processed_at'])
+
+    if inbound.callback_url and inbound.status in (InboundStatus.DONE, InboundStatus.FAILED):
+        deliver_callback(inbound)
+    return inbound
+
+
+def serialize_inbound(inbound):
+    """Representación usada por el callback y el endpoint de consulta"""
+    return {
+        'message_id': inbound.id,
+        'sender_id': inbound.sender_id,
+        'status': inbound.status,
+        'response': inbound.response,
+        'error': inbound.error or None,
+        'created_at': inbound.created_at.isoformat() if inbound.created_at else None,
+        'processed_at': inbound.processed_at.isoformat() if inbound.processed_at else None,
+    }
+
+
+def deliver_callback(inbound):
+    # Se revisa de nuevo: el DNS del host puede haber cambiado desde que se encoló
+    try:
+        check_callback_url(inbound.flow, inbound.callback_url)
+    except ValueError as e:
+        print(f"⚠️ Callback rechazado para mensaje en cola #{inbound.id}: {e}")
+        return False
+
+    try:
+        r = requests.post(
+            inbound.callback_url,
+            json=serialize_inbound(inbound),
+            timeout=_callback_timeout(),
+            allow_redirects=False,
+        )
+        r.raise_for_status()
+        if r.is_redirect:
+            raise requests.RequestException(f'redirect to {r.headers.get("Location")} not followed')
+    except requests.RequestException as e:
+        # La respuesta sigue disponible en el endpoint de consulta
+        print(f"⚠️ Callback fallido para mensaje en cola #{inbound.id}: {e}")
+        return False
+
+    inbound.callback_delivered_at = timezone.now()
+    inbound.save(update_fields=['callback_delivered_at'])
+    return True
+
+
+def run_worker(stop_event=None, poll_interval=1.0, once=False):
+    """
+    Bucle de un worker: toma y procesa mensajes hasta que `stop_event` se
+    active (o hasta vaciar la cola con once=True). Retorna cuántos procesó.
+    """
+    processed = 0
+    try:
+        while stop_event is None or not stop_event.is_set():
+            close_old_connections()
+            inbound = claim_next()
+            if inbound is None:
+                if once:
+                    break
+                if stop_event is not None:
+                    stop_event.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+                continue
+            process_message(inbound)
+            processed += 1
+    finally:
+        connection.close()
+    return processed
@@ -0,0 +1,164 @@
+# apps/flows/services/locks.py
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, router
+
+
+class SenderLockTimeout(Exception):
+    """No se obtuvo el lock del remitente dentro del tiempo máximo de espera"""
+
+
+def _timeout():
+    return getattr(settings, 'FLOWS_SENDER_LOCK_TIMEOUT', 5.0)
+
+
+class LockStats:
+    """Contadores de contención de los locks por remitente (por proceso)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquired = 0
+            self.contended = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.hold_total = 0.0
+            self.hold_max = 0.0
+
+    def record_wait(self, waited, contended, timed_out):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+            if contended:
+                self.contended += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def record_hold(self, held):
+        with self._lock:
+            self.hold_total += held
+            self.hold_max = max(self.hold_max, held)
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self.acquired + self.timeouts
+            return {
+                'acquired': self.acquired,
+                'contended': self.contended,
+                'timeouts': self.timeouts,
+                'contention_rate': round(self.contended / attempts, 4) if attempts else 0.0,
+                'wait_avg_ms': round(self.wait_total / attempts * 1000, 3) if attempts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'hold_avg_ms': round(self.hold_total / self.acquired * 1000, 3) if self.acquired else 0.0,
+                'hold_max_ms': round(self.hold_max * 1000, 3),
+            }
+
+
+stats = LockStats()
+
+
+def lock_key(team_id, sender_id):
+    """Clave bigint estable para pg_advisory_lock"""
+    digest = hashlib.blake2b(f"flows:{team_id}:{sender_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+# --- Stand-in en proceso para motores sin advisory locks (SQLite) ---
+
+_local_locks = {}
+_local_guard = threading.Lock()
+
+
+def _acquire_local(key, timeout):
+    with _local_guard:
+        entry = _local_locks.get(key)
+        if entry is None:
+            entry = _local_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    lock = entry[0]
+    contended = not lock.acquire(blocking=False)
+    if contended and not lock.acquire(timeout=timeout):
+        _release_local(key, locked=False)
+        return False, True
+    return True, contended
+
+
+def _release_local(key, locked=True):
+    with _local_guard:
+        entry = _local_locks[key]
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _local_locks[key]
+
+
+# --- PostgreSQL ---
+
+def _acquire_advisory(connection, key, timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    contended = False
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+            if cursor.fetchone()[0]:
+                return True, contended
+            contended = True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, contended
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.2)
+
+
+def _release_advisory(connection, key):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+@contextmanager
+def sender_lock(team_id, sender_id, timeout=None):
+    """
+    Serializa el procesamiento de un remitente (team, sender_id) entre
+    workers. En PostgreSQL usa un advisory lock de sesión; en otros motores
+    un lock en memoria del proceso. Espera como máximo `timeout` segundos
+    (FLOWS_SENDER_LOCK_TIMEOUT) y si no lo obtiene lanza SenderLockTimeout.
+    """
+    from ..models import ConversationSession
+
+    timeout = _timeout() if timeout is None else timeout
+    key = lock_key(team_id, sender_id)
+    connection = connections[router.db_for_write(ConversationSession)]
+    advisory = connection.vendor == 'postgresql'
+
+    started = time.monotonic()
+    if advisory:
+        acquired, contended = _acquire_advisory(connection, key, timeout)
+    else:
+        acquired, contended = _acquire_local(key, timeout)
+    locked_at = time.monotonic()
+    stats.record_wait(locked_at - started, contended, timed_out=not acquired)
+
+    if not acquired:
+        print(f"⏳ Timeout esperando el lock del remitente {sender_id} (team {team_id})")
+        raise SenderLockTimeout(f"sender {sender_id} is busy")
+
+    try:
+        yield
+    finally:
+        if advisory:
+            _release_advisory(connection, key)
+        else:
+            _release_local(key)
+        stats.record_hold(time.monotonic() - locked_at)
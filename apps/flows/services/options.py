@@ -0,0 +1,336 @@
+# apps/flows/services/options.py
+from collections import deque
+
+from django.conf import settings
+
+from .commands import normalize_text
+
+FUZZY_MIN_LENGTH = 4
+FUZZY_MAX_DISTANCE = 3
+FUZZY_CACHE_SIZE = 1024
+
+
+def _fuzzy_ratio():
+    # Errores tolerados por carácter del alias (0 desactiva el match aproximado)
+    return getattr(settings, 'FLOWS_FUZZY_MAX_RATIO', 0.2)
+
+
+class _ContainmentIndex:
+    """
+    Autómata Aho-Corasick sobre textos de opciones. Recorre el mensaje una
+    sola vez y devuelve el menor índice de opción cuyo texto aparece dentro
+    de él, sin importar cuántas opciones haya.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]
+
+    def add(self, text, idx):
+        state = 0
+        for ch in text:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+            state = nxt
+        if self._out[state] is None or idx < self._out[state]:
+            self._out[state] = idx
+
+    def freeze(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = fail if fail != nxt else 0
+                queue.append(nxt)
+            # Cada estado guarda el mínimo de su cadena de sufijos
+            inherited = self._out[self._fail[state]]
+            if inherited is not None and (self._out[state] is None or inherited < self._out[state]):
+                self._out[state] = inherited
+
+    def first(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        best = out[0]  # texto vacío: siempre está contenido
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            found = out[state]
+            if found is not None and (best is None or found < best):
+                best = found
+        return best
+
+
+def _char_masks(text):
+    """Máscara de bits de las posiciones de cada carácter (para edit_distance)"""
+    masks = {}
+    for i, ch in enumerate(text):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    return masks
+
+
+def edit_distance(a, b, masks=None):
+    """
+    Distancia de Levenshtein entre `a` y `b` con el algoritmo de vectores de
+    bits de Myers/Hyyrö: una operación con enteros por carácter de `b`.
+    `masks` son las máscaras de `a` precalculadas con _char_masks.
+    """
+    if a == b:
+        return 0
+    m = len(a)
+    if not m:
+        return len(b)
+    if masks is None:
+        masks = _char_masks(a)
+    full = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = full, 0, m
+    for ch in b:
+        eq = masks.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def _trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _FuzzyIndex:
+    """
+    Índice de trigramas de los alias de las opciones (normalizados: sin
+    acentos ni mayúsculas). Los trigramas en común con el mensaje eligen
+    candidatos y cada uno se verifica con una distancia de edición acotada
+    contra las ventanas del mensaje con el mismo número de palabras.
+    """
+
+    def __init__(self, aliases, ratio):
+        self._entries = []  # (alias, trigramas, máscaras, índice de opción, palabras, distancia máxima)
+        self._postings = {}  # trigrama -> [entrada]
+        seen = set()
+        for text, idx in aliases:
+            alias = normalize_text(text)
+            # Los alias repetidos se quedan con la primera opción (la de menor índice)
+            if len(alias) < FUZZY_MIN_LENGTH or alias in seen:
+                continue
+            limit = min(int(len(alias) * ratio), FUZZY_MAX_DISTANCE)
+            if limit < 1:
+                continue
+            seen.add(alias)
+            grams = frozenset(_trigrams(alias))
+            entry = len(self._entries)
+            self._entries.append((alias, grams, _char_masks(alias), idx, len(alias.split()), limit))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(entry)
+        # Los mismos errores de escritura se repiten entre usuarios
+        self._recent = {}
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    def match(self, text):
+        """Índice de la opción más cercana a `text` (ya normalizado) o None"""
+        try:
+            return self._recent[text]
+        except KeyError:
+            pass
+        if len(self._recent) >= FUZZY_CACHE_SIZE:
+            self._recent.clear()
+        result = self._recent[text] = self._search(text)
+        return result
+
+    def _search(self, text):
+        hits = {}
+        for gram in _trigrams(text):
+            for entry in self._postings.get(gram, ()):
+                hits[entry] = hits.get(entry, 0) + 1
+
+        # Cada edición rompe como máximo 3 trigramas: cota inferior de la distancia
+        candidates = []
+        for entry, count in hits.items():
+            grams, limit = self._entries[entry][1], self._entries[entry][5]
+            bound = -(-(len(grams) - count) // 3)
+            if bound <= limit:
+                candidates.append((bound, self._entries[entry][3], entry))
+        if not candidates:
+            return None
+        candidates.sort()
+
+        words = text.split()
+        windows = {}  # (inicio, palabras) -> (texto, trigramas)
+        best = None  # (distancia, índice de opción)
+        for bound, idx, entry in candidates:
+            if best is not None and (bound, idx) >= best:
+                break
+            alias, grams, masks, _, size, limit = self._entries[entry]
+            for start in range(max(len(words) - size, 0) + 1):
+                window = windows.get((start, size))
+                if window is None:
+                    joined = ' '.join(words[start:start + size])
+                    window = windows[(start, size)] = (joined, _trigrams(joined))
+                joined, window_grams = window
+                if abs(len(joined) - len(alias)) > limit:
+                    continue
+                if -(-(len(grams) - len(grams & window_grams)) // 3) > limit:
+                    continue
+                distance = edit_distance(alias, joined, masks)
+                if distance <= limit and (best is None or (distance, idx) < best):
+                    best = (distance, idx)
+        return best[1] if best is not None else None
+
+
+class OptionMatcher:
+    """
+    Índices de las opciones de una entidad MULTIPLE_CHOICE
+    ([{ 'key': str, 'label': str, 'keywords': [str] }]), construidos una vez.
+
+    `match` devuelve el mismo resultado que recorrer las opciones en orden
+    aplicando a cada una: label o key exactos, label contenido en el
+    mensaje, mensaje contenido en el label (3+ caracteres), keywords en
+    cualquier dirección y palabras de 3+ letras en común con el label.
+    Gana la primera opción que cumpla cualquiera de las reglas. Si ninguna
+    cumple, se busca el alias más parecido (label, key, keywords y
+    fuzzy_aliases) con el índice de trigramas.
+    """
+
+    def __init__(self, options, fuzzy_aliases=None):
+        self.options = tuple(options or ())
+        self._exact = {}       # label/key exactos
+        self._containing = {}  # substrings de labels (3+) y de keywords -> opción que los contiene
+        self._words = {}       # palabras de 3+ letras del label
+        self._contained = _ContainmentIndex()  # labels y keywords contenidos en el mensaje
+
+        for idx, option in enumerate(self.options):
+            if not isinstance(option, dict):
+                continue
+            label = str(option.get('label') or '').lower()
+            key = str(option.get('key') or '').lower()
+            keywords = option.get('keywords') or []
+
+            self._exact.setdefault(label, idx)
+            self._exact.setdefault(key, idx)
+
+            if label:
+                self._contained.add(label, idx)
+                self._add_substrings(label, idx, min_length=3)
+                for word in label.split():
+                    if len(word) >= 3:
+                        self._words.setdefault(word, idx)
+
+            for keyword in keywords:
+                keyword = str(keyword).lower()
+                self._contained.add(keyword, idx)
+                self._add_substrings(keyword, idx, min_length=0)
+
+        self._contained.freeze()
+        aliases = option_aliases(self.options, fuzzy_aliases)
+        # Las palabras sueltas del label también, como en la regla de palabras en común
+        aliases += [
+            (word, idx)
+            for idx, option in enumerate(self.options) if isinstance(option, dict)
+            for word in str(option.get('label') or '').split()
+        ]
+        self._fuzzy = _FuzzyIndex(aliases, _fuzzy_ratio())
+
+    def _add_substrings(self, text, idx, min_length):
+        length = len(text)
+        for start in range(length + 1):
+            for end in range(start + min_length, length + 1):
+                self._containing.setdefault(text[start:end], idx)
+
+    def match(self, message):
+        """Retorna (opción, índice) o (None, None)"""
+        if not self.options:
+            return None, None
+
+        message_lower = message.strip().lower()
+
+        # 1. Match por número (1, 2, 3, etc.)
+        if message_lower.isdigit():
+            index = int(message_lower) - 1
+            if 0 <= index < len(self.options):
+                return self.options[index], index
+
+        # 2. La opción de menor índice que cumpla cualquiera de las reglas
+        candidates = [
+            self._exact.get(message_lower),
+            self._contained.first(message_lower),
+            self._containing.get(message_lower),
+        ]
+        candidates.extend(self._words.get(word) for word in message_lower.split() if len(word) >= 3)
+
+        found = [idx for idx in candidates if idx is not None]
+        if found:
+            index = min(found)
+            return self.options[index], index
+
+        # 3. Errores de escritura ("vasectomia", "blanqueamiento dentl")
+        if self._fuzzy:
+            index = self._fuzzy.match(normalize_text(message_lower))
+            if index is not None:
+                return self.options[index], index
+        return None, None
+
+
+def option_label(option):
+    """Valor que se guarda al elegir una opción: label o, si está vacío, key"""
+    label = str(option.get('label') or '').strip()
+    return label or str(option.get('key') or '')
+
+
+def option_aliases(options, fuzzy_aliases=None):
+    """
+    Textos con los que se puede mencionar cada opción: label, key, keywords
+    y los alias de Entity.fuzzy_aliases, que pueden venir como
+    {key: [alias, ...]} o [{'key': key, 'aliases': [alias, ...]}, ...].
+    Retorna [(texto, índice de opción)] en orden de opción.
+    """
+    options = list(options or ())
+    by_key = {str(o.get('key') or ''): idx for idx, o in enumerate(options) if isinstance(o, dict)}
+
+    extra = {}
+    if isinstance(fuzzy_aliases, dict):
+        items = fuzzy_aliases.items()
+    elif isinstance(fuzzy_aliases, list):
+        items = [
+            (a.get('key'), a.get('aliases') or a.get('alias'))
+            for a in fuzzy_aliases if isinstance(a, dict)
+        ]
+    else:
+        items = ()
+    for key, aliases in items:
+        idx = by_key.get(str(key))
+        if idx is None:
+            continue
+        if isinstance(aliases, str):
+            aliases = [aliases]
+        extra.setdefault(idx, []).extend(str(a) for a in aliases or ())
+
+    result = []
+    for idx, option in enumerate(options):
+        if not isinstance(option, dict):
+            continue
+        texts = [option.get('label'), option.get('key')] + list(option.get('keywords') or []) + extra.get(idx, [])
+        result.extend((str(text), idx) for text in texts if text)
+    return result
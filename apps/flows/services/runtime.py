@@ -0,0 +1,58 @@
+# apps/flows/services/runtime.py
+
+# Nodos automáticos seguidos en un mismo mensaje, para cortar ciclos
+MAX_AUTOMATIC_STEPS = 20
+
+
+def _executors():
+    from ..models import NodeType
+    from .scripts import run_script_node
+    from .webhooks import run_webhook_node
+
+    return {NodeType.WEBHOOK: run_webhook_node, NodeType.SCRIPT: run_script_node}
+
+
+def _already_known(session, node):
+    """Pregunta por una entidad auto_extract que el usuario ya dio"""
+    entity = node.collect_entity
+    return entity is not None and entity.auto_extract and session.entities.has(entity.id)
+
+
+def enter_node(session, node, skip_known=True):
+    """
+    Asigna `node` como nodo actual de la sesión y ejecuta lo que el tipo de
+    nodo hace al entrar: un DELAY programa el temporizador que reanudará la
+    sesión; un WEBHOOK o SCRIPT se ejecuta y la sesión sigue por sus paths
+    hasta llegar a un nodo que espera al usuario. Con skip_known también se
+    saltan las preguntas de entidades auto_extract que ya tienen valor. Si
+    un nodo automático no tiene salida, la sesión queda en él.
+    Retorna el nodo en el que queda la sesión.
+    """
+    from ..models import NodeType
+
+    executors = _executors()
+    for _ in range(MAX_AUTOMATIC_STEPS):
+        session.set_current_node(node)
+        if node is None:
+            return None
+        if node.type == NodeType.DELAY:
+            from .timers import schedule_timer
+            schedule_timer(session, node)
+            return node
+
+        executor = executors.get(node.type)
+        if executor is not None:
+            executor(session, node)
+        elif skip_known and _already_known(session, node):
+            print(f"⏩ Saltando nodo {node.id}: la entidad '{node.collect_entity.slug}' ya tiene valor")
+        else:
+            return node
+
+        next_node = session.get_next_node("")
+        if next_node is None or next_node.id == node.id:
+            return node
+        node = next_node
+
+    session.set_current_node(node)
+    print(f"⚠️ Se alcanzó el máximo de {MAX_AUTOMATIC_STEPS} nodos automáticos seguidos en la sesión {session.id}")
+    return node
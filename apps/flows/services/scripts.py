@@ -0,0 +1,502 @@
+# apps/flows/services/scripts.py
+"""
+Lenguaje de expresiones de los nodos SCRIPT.
+
+config: {"script": "total = precio * cantidad\\nseguimiento = date_add(today(), 3)"}
+
+Cada línea asigna una expresión a un nombre. Si el nombre es el slug de
+una entidad del team se guarda como EntityValue; si no, queda en
+session.context['collected_entities'] para los templates. Las variables
+son los slugs de entidades colectadas, lead_name / lead_phone / lead_email
+y las asignaciones anteriores del mismo script.
+
+Las expresiones se parsean con `ast` y solo se aceptan literales,
+variables, aritmética, comparaciones, and/or/not, `a if c else b`, listas
+y las funciones de FUNCTIONS. Cada script se compila una vez a un árbol de
+closures (se guarda en el grafo compilado) y su evaluación está acotada
+por un número máximo de pasos y un tiempo máximo.
+"""
+import ast
+import math
+import operator
+import time
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .templates import LEAD_VARIABLES
+
+MAX_STRING = 10000
+MAX_NUMBER = 10 ** 30
+MAX_EXPONENT = 100
+MAX_DIGITS = 15
+# Textos más largos no se interpretan como número (int() de miles de dígitos es cuadrático)
+MAX_NUMBER_TEXT = 100
+MAX_STATEMENTS = 50
+MAX_SOURCE = 5000
+
+
+def _max_steps():
+    return getattr(settings, 'FLOWS_SCRIPT_MAX_STEPS', 1000)
+
+
+def _timeout():
+    # Segundos
+    return getattr(settings, 'FLOWS_SCRIPT_TIMEOUT', 0.05)
+
+
+class ScriptError(Exception):
+    """Script inválido o error al evaluarlo"""
+
+
+class ScriptBudgetExceeded(ScriptError):
+    """El script superó el máximo de pasos o de tiempo"""
+
+
+class _Context:
+    __slots__ = ('vars', 'steps', 'deadline')
+
+    def __init__(self, variables, steps, deadline):
+        self.vars = variables
+        self.steps = steps
+        self.deadline = deadline
+
+    def tick(self):
+        self.steps -= 1
+        if self.steps < 0:
+            raise ScriptBudgetExceeded('step budget exceeded')
+
+    def check_time(self):
+        if time.perf_counter() > self.deadline:
+            raise ScriptBudgetExceeded('time budget exceeded')
+
+
+# --- Valores ---
+
+def _try_number(value):
+    """Números tal cual; textos numéricos (los EntityValue llegan como texto) convertidos; si no, None"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        text = value.strip().replace(',', '')
+        if len(text) > MAX_NUMBER_TEXT:
+            return None
+        try:
+            number = float(text)
+        except ValueError:
+            return None
+        if number.is_integer() and text.lstrip('+-').isdigit():
+            return int(text)
+        return number
+    return None
+
+
+def _number(value):
+    number = _try_number(value)
+    if number is None:
+        raise ScriptError(f'{_preview(value)} is not a number')
+    # Los operandos también se acotan: las variables de la sesión no pasan por _checked
+    return _checked(number)
+
+
+def _preview(value):
+    if isinstance(value, str) and len(value) > 50:
+        return repr(value[:50] + '...')
+    if isinstance(value, int) and not isinstance(value, bool) and abs(value) > MAX_NUMBER:
+        return 'number'
+    return repr(value)
+
+
+def _checked(value):
+    if isinstance(value, str) and len(value) > MAX_STRING:
+        raise ScriptBudgetExceeded('string too long')
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+            raise ScriptError('invalid number')
+        if abs(value) > MAX_NUMBER:
+            raise ScriptBudgetExceeded('number too large')
+    return value
+
+
+def _add(a, b):
+    # Dos textos se concatenan salvo que ambos sean numéricos; lo demás se suma como número
+    x, y = _try_number(a), _try_number(b)
+    if x is not None and y is not None:
+        return x + y
+    if isinstance(a, str) and isinstance(b, str):
+        return a + b
+    return _number(a) + _number(b)
+
+
+def _mul(a, b):
+    x = _try_number(a)
+    if x is None and isinstance(a, str):
+        count = _try_number(b)
+        if not isinstance(count, int):
+            raise ScriptError(f'{a!r} is not a number')
+        if len(a) * max(count, 0) > MAX_STRING:
+            raise ScriptBudgetExceeded('string too long')
+        return a * count
+    return _number(a) * _number(b)
+
+
+def _pow(a, b):
+    a, b = _number(a), _number(b)
+    if abs(b) > MAX_EXPONENT:
+        raise ScriptBudgetExceeded('exponent too large')
+    return a ** b
+
+
+def _numeric(op):
+    def run(a, b):
+        return op(_number(a), _number(b))
+    return run
+
+
+def _compare(op):
+    def run(a, b):
+        # Dos textos se comparan como texto; un número contra un texto numérico, como números
+        if not (isinstance(a, str) and isinstance(b, str)):
+            x, y = _try_number(a), _try_number(b)
+            if x is not None and y is not None:
+                return op(x, y)
+        if isinstance(a, (date, datetime)) or isinstance(b, (date, datetime)):
+            return op(_date(a), _date(b))
+        return op(a, b)
+    return run
+
+
+BINARY_OPERATORS = {
+    ast.Add: _add,
+    ast.Sub: _numeric(operator.sub),
+    ast.Mult: _mul,
+    ast.Div: _numeric(operator.truediv),
+    ast.FloorDiv: _numeric(operator.floordiv),
+    ast.Mod: _numeric(operator.mod),
+    ast.Pow: _pow,
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: _compare(operator.eq),
+    ast.NotEq: _compare(operator.ne),
+    ast.Lt: _compare(operator.lt),
+    ast.LtE: _compare(operator.le),
+    ast.Gt: _compare(operator.gt),
+    ast.GtE: _compare(operator.ge),
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+
+# --- Funciones ---
+
+def _date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.strip()).date()
+        except ValueError:
+            pass
+    raise ScriptError(f'{value!r} is not a date')
+
+
+def _round(value, digits=0):
+    digits = _number(digits)
+    if not float(digits).is_integer() or abs(digits) > MAX_DIGITS:
+        raise ScriptError(f'round(): digits must be an integer between -{MAX_DIGITS} and {MAX_DIGITS}')
+    return round(_number(value), int(digits))
+
+
+def _to_int(value):
+    return int(_number(value))
+
+
+def _text(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # str() de un entero enorme es cuadrático
+        return str(_checked(value))
+    return _checked(str(value))
+
+
+FUNCTIONS = {
+    'abs': lambda v: abs(_number(v)),
+    'round': _round,
+    'int': _to_int,
+    'float': lambda v: float(_number(v)),
+    'number': _number,
+    'str': _text,
+    'len': lambda v: len(v),
+    'lower': lambda v: _text(v).lower(),
+    'upper': lambda v: _text(v).upper(),
+    'concat': lambda *values: ''.join(_text(v) for v in values),
+    'min': lambda *values: min(_number(v) for v in values),
+    'max': lambda *values: max(_number(v) for v in values),
+    'today': lambda: timezone.localdate(),
+    'date': _date,
+    'date_add': lambda d, days: _date(d) + timedelta(days=_number(days)),
+    'days_between': lambda a, b: (_date(b) - _date(a)).days,
+    'format_date': lambda d, fmt='%d/%m/%Y': _date(d).strftime(str(fmt)),
+}
+
+
+# --- Compilación ---
+
+_MISSING = object()
+
+
+def _compile(node):
+    """Nodo de `ast` -> closure fn(ctx)"""
+    if isinstance(node, ast.Constant):
+        value = node.value
+        if not isinstance(value, (int, float, str, bool, type(None))):
+            raise ScriptError(f'unsupported literal {value!r}')
+        _checked(value)
+        return lambda ctx: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+
+        def variable(ctx):
+            value = ctx.vars.get(name, _MISSING)
+            if value is _MISSING:
+                raise ScriptError(f'undefined variable {name}')
+            return value
+        return variable
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        items = [_compile(e) for e in node.elts]
+
+        def sequence(ctx):
+            ctx.tick()
+            return [item(ctx) for item in items]
+        return sequence
+
+    if isinstance(node, ast.BinOp):
+        op = BINARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise ScriptError(f'unsupported operator {type(node.op).__name__}')
+        left, right = _compile(node.left), _compile(node.right)
+
+        def binary(ctx):
+            ctx.tick()
+            return _checked(op(left(ctx), right(ctx)))
+        return binary
+
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile(node.operand)
+        if isinstance(node.op, ast.Not):
+            def negation(ctx):
+                ctx.tick()
+                return not operand(ctx)
+            return negation
+        if isinstance(node.op, (ast.USub, ast.UAdd)):
+            sign = -1 if isinstance(node.op, ast.USub) else 1
+
+            def signed(ctx):
+                ctx.tick()
+                return sign * _number(operand(ctx))
+            return signed
+        raise ScriptError(f'unsupported operator {type(node.op).__name__}')
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile(v) for v in node.values]
+        if isinstance(node.op, ast.And):
+            def conjunction(ctx):
+                ctx.tick()
+                result = True
+                for value in values:
+                    result = value(ctx)
+                    if not result:
+                        return result
+                return result
+            return conjunction
+
+        def disjunction(ctx):
+            ctx.tick()
+            result = False
+            for value in values:
+                result = value(ctx)
+                if result:
+                    return result
+            return result
+        return disjunction
+
+    if isinstance(node, ast.Compare):
+        left = _compile(node.left)
+        steps = []
+        for op, comparator in zip(node.ops, node.comparators):
+            fn = COMPARE_OPERATORS.get(type(op))
+            if fn is None:
+                raise ScriptError(f'unsupported comparison {type(op).__name__}')
+            steps.append((fn, _compile(comparator)))
+
+        def comparison(ctx):
+            ctx.tick()
+            a = left(ctx)
+            for fn, comparator in steps:
+                b = comparator(ctx)
+                if not fn(a, b):
+                    return False
+                a = b
+            return True
+        return comparison
+
+    if isinstance(node, ast.IfExp):
+        test, body, orelse = _compile(node.test), _compile(node.body), _compile(node.orelse)
+
+        def conditional(ctx):
+            ctx.tick()
+            return body(ctx) if test(ctx) else orelse(ctx)
+        return conditional
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            raise ScriptError('unknown function')
+        if node.keywords or any(isinstance(a, ast.Starred) for a in node.args):
+            raise ScriptError('only positional arguments are supported')
+        fn_name = node.func.id
+        fn = FUNCTIONS[fn_name]
+        args = [_compile(a) for a in node.args]
+
+        def call(ctx):
+            ctx.tick()
+            ctx.check_time()
+            try:
+                return _checked(fn(*[arg(ctx) for arg in args]))
+            except ScriptError:
+                raise
+            except (TypeError, ValueError, OverflowError) as e:
+                raise ScriptError(f'{fn_name}(): {e}')
+        return call
+
+    raise ScriptError(f'unsupported syntax {type(node).__name__}')
+
+
+def _names(tree):
+    return {n.id for n in ast.walk(tree) if isinstance(n, ast.Name) and n.id not in FUNCTIONS}
+
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, list):
+        return [_json_value(v) for v in value]
+    return value
+
+
+class CompiledScript:
+    """Script de un nodo SCRIPT ya validado y compilado a closures"""
+
+    def __init__(self, source):
+        if not isinstance(source, str) or not source.strip():
+            raise ScriptError('script is empty')
+        if len(source) > MAX_SOURCE:
+            raise ScriptError(f'script longer than {MAX_SOURCE} characters')
+        try:
+            tree = ast.parse(source.strip(), mode='exec')
+        except SyntaxError as e:
+            raise ScriptError(f'syntax error in line {e.lineno}: {e.msg}')
+        except RecursionError:
+            raise ScriptError('expression nested too deeply')
+        if len(tree.body) > MAX_STATEMENTS:
+            raise ScriptError(f'more than {MAX_STATEMENTS} statements')
+
+        self.statements = []
+        inputs = set()
+        for statement in tree.body:
+            if not isinstance(statement, ast.Assign) or len(statement.targets) != 1 \
+                    or not isinstance(statement.targets[0], ast.Name):
+                raise ScriptError(f'line {statement.lineno}: expected "name = expression"')
+            name = statement.targets[0].id
+            # Solo se leen de la sesión los nombres que no se asignaron antes
+            inputs |= _names(statement.value) - {n for n, _ in self.statements}
+            try:
+                self.statements.append((name, _compile(statement.value)))
+            except RecursionError:
+                raise ScriptError(f'line {statement.lineno}: expression nested too deeply')
+        self.targets = tuple(dict.fromkeys(name for name, _ in self.statements))
+        self.inputs = frozenset(inputs)
+        self.max_steps = _max_steps()
+        self.timeout = _timeout()
+
+    def variables(self, session):
+        """Valores de la sesión para los nombres que usa el script"""
+        values = dict(session.entities.variables(self.inputs))
+        collected = (session.context or {}).get('collected_entities') or {}
+        for name in self.inputs:
+            if name in values:
+                continue
+            if name in LEAD_VARIABLES and session.lead is not None:
+                values[name] = LEAD_VARIABLES[name](session.lead)
+            elif name in collected:
+                values[name] = collected[name]
+        return values
+
+    def evaluate(self, variables, max_steps=None, timeout=None):
+        """
+        Ejecuta las asignaciones sobre `variables`. Retorna {nombre: valor}
+        de los nombres asignados (valores JSON). Lanza ScriptError.
+        """
+        ctx = _Context(
+            dict(variables),
+            self.max_steps if max_steps is None else max_steps,
+            time.perf_counter() + (self.timeout if timeout is None else timeout),
+        )
+        for name, expression in self.statements:
+            ctx.vars[name] = expression(ctx)
+            ctx.check_time()
+        return {name: _json_value(ctx.vars[name]) for name in self.targets}
+
+    def run(self, session):
+        return self.evaluate(self.variables(session))
+
+
+def compile_script(config):
+    """CompiledScript de la config de un nodo, o None si no es válida"""
+    if not isinstance(config, dict):
+        return None
+    try:
+        return CompiledScript(config.get('script'))
+    except ScriptError as e:
+        print(f"⚠️ Script inválido en nodo SCRIPT: {e}")
+        return None
+
+
+def run_script_node(session, node):
+    """
+    Ejecuta un nodo SCRIPT. Si alguna línea falla no se guarda nada; el
+    resultado queda en session.context['last_script'] para los paths.
+    """
+    from .entities import store_entity_values
+
+    script = getattr(node, 'action', None) or compile_script(node.config)
+    if script is None:
+        print(f"❌ Nodo SCRIPT {node.id} sin script válido")
+        session.context['last_script'] = {'node_id': node.id, 'ok': False, 'error': 'invalid script'}
+        return None
+
+    try:
+        values = script.run(session)
+    except (ScriptError, ArithmeticError, TypeError, ValueError) as e:
+        print(f"❌ Error ejecutando el script del nodo {node.id}: {e}")
+        session.context['last_script'] = {'node_id': node.id, 'ok': False, 'error': str(e)}
+        return None
+
+    stored = store_entity_values(session, values, node_id=node.id, source='script')
+    collected = session.context.setdefault('collected_entities', {})
+    for name, value in values.items():
+        if name not in stored:
+            collected[name] = value
+    session.context['last_script'] = {'node_id': node.id, 'ok': True, 'error': None}
+    print(f"🧮 SCRIPT nodo {node.id}: {values}")
+    return values
@@ -0,0 +1,174 @@
+# apps/flows/services/segments.py
+from django.db.models import Exists, OuterRef
+
+from .commands import normalize_text
+from .entities import _number, parse_iso
+
+# Operador -> (columna tipada, lookup, tipo del valor esperado)
+OPERATORS = {
+    'exists': (None, None, None),
+    'missing': (None, None, None),
+    'eq': ('value_text', 'exact', 'text'),
+    'contains': ('value_text', 'contains', 'text'),
+    'in': ('value_text', 'in', 'text_list'),
+    'gt': ('value_num', 'gt', 'number'),
+    'gte': ('value_num', 'gte', 'number'),
+    'lt': ('value_num', 'lt', 'number'),
+    'lte': ('value_num', 'lte', 'number'),
+    'between': ('value_num', 'range', 'number_pair'),
+    'before': ('value_date', 'lt', 'date'),
+    'after': ('value_date', 'gt', 'date'),
+    'date_between': ('value_date', 'range', 'date_pair'),
+}
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+class SegmentError(ValueError):
+    pass
+
+
+def _coerce(kind, value, op):
+    if kind == 'text':
+        if value is None or isinstance(value, (list, dict)):
+            raise SegmentError(f"'{op}' needs a text value")
+        return normalize_text(value)
+    if kind == 'text_list':
+        if not isinstance(value, list) or not value:
+            raise SegmentError(f"'{op}' needs a non-empty list")
+        return [normalize_text(v) for v in value]
+    if kind == 'number':
+        number = _number(value)
+        if number is None:
+            raise SegmentError(f"'{op}' needs a number")
+        return number
+    if kind == 'date':
+        date = parse_iso(value)
+        if date is None:
+            raise SegmentError(f"'{op}' needs an ISO date")
+        return date
+    if kind in ('number_pair', 'date_pair'):
+        if not isinstance(value, list) or len(value) != 2:
+            raise SegmentError(f"'{op}' needs [from, to]")
+        single = kind.split('_')[0]
+        return tuple(_coerce(single, v, op) for v in value)
+    return value
+
+
+class SegmentFilter:
+    """Un filtro ya validado: entidad, operador y el lookup sobre su columna tipada"""
+
+    def __init__(self, entity_id, op, lookup=None):
+        self.entity_id = entity_id
+        self.op = op
+        self.lookup = lookup or {}
+
+    @property
+    def negated(self):
+        return self.op == 'missing'
+
+    def values(self, team_id):
+        from ..models import EntityValue
+        return EntityValue.objects.filter(team_id=team_id, entity_id=self.entity_id, **self.lookup)
+
+
+def compile_filters(team_id, filters):
+    """
+    Valida `filters` ([{entity: slug|id, op, value}], combinados con AND)
+    y resuelve las entidades del team. Lanza SegmentError si algo no es válido.
+    """
+    from ..models import Entity
+
+    if not isinstance(filters, list) or not filters:
+        raise SegmentError('filters must be a non-empty list')
+
+    refs = [f.get('entity') if isinstance(f, dict) else None for f in filters]
+    entities = Entity.objects.filter(team_id=team_id).values_list('id', 'slug')
+    by_ref = {}
+    for entity_id, slug in entities:
+        by_ref[slug] = entity_id
+        by_ref[str(entity_id)] = entity_id
+
+    compiled = []
+    for f, ref in zip(filters, refs):
+        if ref is None:
+            raise SegmentError('each filter needs an entity')
+        entity_id = by_ref.get(str(ref))
+        if entity_id is None:
+            raise SegmentError(f"unknown entity '{ref}'")
+        op = f.get('op', 'exists')
+        if op not in OPERATORS:
+            raise SegmentError(f"unknown operator '{op}'")
+        column, lookup, kind = OPERATORS[op]
+        if column is None:
+            compiled.append(SegmentFilter(entity_id, op))
+            continue
+        value = _coerce(kind, f.get('value'), op)
+        compiled.append(SegmentFilter(entity_id, op, {f'{column}__{lookup}': value}))
+    return compiled
+
+
+def segment_queryset(team_id, filters):
+    """
+    sender_id (ordenados) que cumplen todos los filtros. El primer filtro
+    positivo recorre su índice (team, entity, columna) y los demás se
+    comprueban con EXISTS / NOT EXISTS por sender.
+    """
+    from ..models import EntityValue
+
+    compiled = compile_filters(team_id, filters)
+    positive = [f for f in compiled if not f.negated]
+    if positive:
+        driver = positive[0]
+        queryset = driver.values(team_id)
+        rest = [f for f in compiled if f is not driver]
+    else:
+        queryset = EntityValue.objects.filter(team_id=team_id)
+        rest = compiled
+
+    for f in rest:
+        condition = Exists(f.values(team_id).filter(sender_id=OuterRef('sender_id')))
+        queryset = queryset.filter(~condition if f.negated else condition)
+
+    queryset = queryset.values_list('sender_id', flat=True).order_by('sender_id')
+    if not positive:
+        queryset = queryset.distinct()
+    return queryset
+
+
+def page_size(value):
+    try:
+        size = int(value or DEFAULT_PAGE_SIZE)
+    except (TypeError, ValueError):
+        raise SegmentError('page_size must be an integer')
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def segment_page(team_id, filters, cursor=None, size=DEFAULT_PAGE_SIZE):
+    """
+    Una página de sender_id del segmento, paginada por clave: `next` es el
+    cursor de la siguiente página (el último sender_id) o None al terminar.
+    """
+    queryset = segment_queryset(team_id, filters)
+    if cursor:
+        queryset = queryset.filter(sender_id__gt=str(cursor))
+    senders = list(queryset[:size + 1])
+    has_more = len(senders) > size
+    senders = senders[:size]
+    return {
+        'results': senders,
+        'next': senders[-1] if has_more else None,
+    }
+
+
+def iter_segment(team_id, filters, size=DEFAULT_PAGE_SIZE):
+    """Recorre el segmento completo página por página (listas de sender_id)"""
+    cursor = None
+    while True:
+        page = segment_page(team_id, filters, cursor=cursor, size=size)
+        if page['results']:
+            yield page['results']
+        cursor = page['next']
+        if cursor is None:
+            return
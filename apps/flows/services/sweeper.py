@@ -0,0 +1,220 @@
+# apps/flows/services/sweeper.py
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+
+def default_ttl_hours():
+    # Horas sin actividad tras las que se finaliza una sesión ACTIVE (0 = nunca)
+    return getattr(settings, 'FLOWS_SESSION_TTL_HOURS', 72)
+
+
+def default_archive_days():
+    # Días sin actividad tras los que una sesión FINISHED se archiva (0 = nunca)
+    return getattr(settings, 'FLOWS_SESSION_ARCHIVE_DAYS', 30)
+
+
+def default_delivery_retention_days():
+    # Días que se guardan las respuestas de WebhookDelivery para deduplicar
+    # reintentos (0 = siempre). Debe cubrir la ventana de reintentos de las plataformas
+    return getattr(settings, 'FLOWS_DEDUP_RETENTION_DAYS', 7)
+
+
+def default_inbound_retention_days():
+    # Días que se guardan los InboundMessage DONE / FAILED de la cola asíncrona
+    # (0 = siempre). Pasado ese plazo el endpoint de consulta responde 404
+    return getattr(settings, 'FLOWS_QUEUE_RETENTION_DAYS', 7)
+
+
+def session_ttl(flow):
+    """TTL del flujo: metadata['session_ttl_hours'] o FLOWS_SESSION_TTL_HOURS"""
+    metadata = flow.metadata if isinstance(flow.metadata, dict) else {}
+    try:
+        hours = float(metadata.get('session_ttl_hours', default_ttl_hours()))
+    except (TypeError, ValueError):
+        print(f"⚠️ session_ttl_hours inválido en el flujo {flow.id}: {metadata.get('session_ttl_hours')!r}")
+        hours = default_ttl_hours()
+    return timedelta(hours=hours) if hours > 0 else None
+
+
+def pack_payload(context, platform_data):
+    raw = json.dumps({'context': context, 'platform_data': platform_data}, cls=DjangoJSONEncoder)
+    return zlib.compress(raw.encode(), 6)
+
+
+def unpack_payload(payload):
+    return json.loads(zlib.decompress(bytes(payload)).decode())
+
+
+def _chunks(queryset, chunk_size):
+    """Ids de `queryset` en bloques, avanzando por PK (cada bloque usa el índice de la PK)"""
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def finish_stale_sessions(now=None, chunk_size=1000, flow_ids=None, dry_run=False):
+    """
+    Finaliza las sesiones ACTIVE sin actividad (updated_at) por más tiempo
+    que el TTL de su flujo, con UPDATE por bloques de ids. Las que esperan
+    un temporizador DELAY pendiente no se tocan. Su siguiente mensaje
+    reinicia el flujo desde el inicio. Retorna {flow_id: sesiones}.
+    """
+    from ..models import ConversationSession, Flow, FlowStatus, FlowTimer, TimerStatus
+
+    now = now or timezone.now()
+    flows = Flow.objects.only('id', 'metadata')
+    if flow_ids:
+        flows = flows.filter(id__in=flow_ids)
+
+    pending_timer = FlowTimer.objects.filter(
+        session_id=OuterRef('pk'), status__in=[TimerStatus.PENDING, TimerStatus.PROCESSING],
+    )
+    finished = {}
+    for flow in flows.iterator():
+        ttl = session_ttl(flow)
+        if ttl is None:
+            continue
+        stale = ConversationSession.objects.filter(
+            flow_id=flow.id, status=FlowStatus.ACTIVE, updated_at__lt=now - ttl,
+        ).filter(~Exists(pending_timer))
+
+        total = 0
+        for ids in _chunks(stale, chunk_size):
+            if dry_run:
+                total += len(ids)
+                continue
+            # Se repiten las condiciones: una sesión pudo recibir un mensaje entre lecturas
+            total += stale.filter(id__in=ids).update(
+                status=FlowStatus.FINISHED,
+                finished_at=now,
+                current_node=None,
+                node_entered_at=None,
+            )
+        if total:
+            finished[flow.id] = total
+            print(f"⌛ {total} sesiones inactivas finalizadas en el flujo {flow.id} (TTL {ttl})")
+    return finished
+
+
+def archive_finished_sessions(older_than_days=None, now=None, chunk_size=1000, flow_ids=None, dry_run=False):
+    """
+    Mueve a ArchivedSession las sesiones FINISHED sin actividad desde hace
+    más de `older_than_days` días: por bloque, un bulk_create y un DELETE en
+    la misma transacción. Retorna cuántas archivó.
+    """
+    from ..models import ArchivedSession, ConversationSession, FlowStatus
+
+    days = default_archive_days() if older_than_days is None else older_than_days
+    if days <= 0:
+        return 0
+    now = now or timezone.now()
+    old = ConversationSession.objects.filter(status=FlowStatus.FINISHED, updated_at__lt=now - timedelta(days=days))
+    if flow_ids:
+        old = old.filter(flow_id__in=flow_ids)
+
+    fields = (
+        'id', 'sender_id', 'flow_id', 'team_id', 'lead_id', 'conversacion_id', 'flow_version_id',
+        'current_node_id', 'platform', 'created_at', 'updated_at', 'finished_at', 'context', 'platform_data',
+    )
+    total = 0
+    for ids in _chunks(old, chunk_size):
+        if dry_run:
+            total += len(ids)
+            continue
+        with transaction.atomic():
+            # Se vuelven a aplicar los filtros con las filas bloqueadas: una sesión que
+            # recibió un mensaje después de leer los ids ya no se archiva
+            sessions = list(old.filter(id__in=ids).select_for_update().only(*fields))
+            if not sessions:
+                continue
+            ArchivedSession.objects.bulk_create([
+                ArchivedSession(
+                    session_id=s.id,
+                    sender_id=s.sender_id,
+                    flow_id=s.flow_id,
+                    team_id=s.team_id,
+                    lead_id=s.lead_id,
+                    conversacion_id=s.conversacion_id,
+                    flow_version_id=s.flow_version_id,
+                    last_node_id=s.current_node_id,
+                    platform=s.platform,
+                    created_at=s.created_at,
+                    updated_at=s.updated_at,
+                    finished_at=s.finished_at,
+                    payload=pack_payload(s.context, s.platform_data),
+                )
+                for s in sessions
+            ])
+            ConversationSession.objects.filter(id__in=[s.id for s in sessions]).delete()
+        total += len(sessions)
+    if total:
+        print(f"📦 {total} sesiones finalizadas archivadas (inactivas hace más de {days} días)")
+    return total
+
+
+def purge_webhook_deliveries(older_than_days=None, now=None, chunk_size=1000, flow_ids=None, dry_run=False):
+    """
+    Borra por bloques de ids los WebhookDelivery de hace más de
+    `older_than_days` días (FLOWS_DEDUP_RETENTION_DAYS). Un reintento más
+    viejo que eso se procesa como un mensaje nuevo. Retorna cuántos borró.
+    """
+    from ..models import WebhookDelivery
+
+    days = default_delivery_retention_days() if older_than_days is None else older_than_days
+    if days <= 0:
+        return 0
+    now = now or timezone.now()
+    old = WebhookDelivery.objects.filter(created_at__lt=now - timedelta(days=days))
+    if flow_ids:
+        old = old.filter(flow_id__in=flow_ids)
+
+    total = 0
+    for ids in _chunks(old, chunk_size):
+        if dry_run:
+            total += len(ids)
+            continue
+        total += WebhookDelivery.objects.filter(id__in=ids).delete()[0]
+    if total:
+        print(f"🧹 {total} registros de reintentos del webhook borrados (más de {days} días)")
+    return total
+
+
+def purge_inbound_messages(older_than_days=None, now=None, chunk_size=1000, flow_ids=None, dry_run=False):
+    """
+    Borra por bloques de ids los InboundMessage DONE / FAILED procesados hace
+    más de `older_than_days` días (FLOWS_QUEUE_RETENTION_DAYS). Los
+    PENDING / PROCESSING nunca se tocan. Retorna cuántos borró.
+    """
+    from ..models import InboundMessage, InboundStatus
+
+    days = default_inbound_retention_days() if older_than_days is None else older_than_days
+    if days <= 0:
+        return 0
+    now = now or timezone.now()
+    old = InboundMessage.objects.filter(
+        status__in=[InboundStatus.DONE, InboundStatus.FAILED],
+        processed_at__lt=now - timedelta(days=days),
+    )
+    if flow_ids:
+        old = old.filter(flow_id__in=flow_ids)
+
+    total = 0
+    for ids in _chunks(old, chunk_size):
+        if dry_run:
+            total += len(ids)
+            continue
+        total += InboundMessage.objects.filter(id__in=ids).delete()[0]
+    if total:
+        print(f"🧹 {total} mensajes de la cola asíncrona borrados (procesados hace más de {days} días)")
+    return total
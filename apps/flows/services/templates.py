@@ -0,0 +1,89 @@
+# apps/flows/services/templates.py
+import re
+
+# {variable}; en "{{variable}}" las llaves externas quedan como texto
+_PLACEHOLDER = re.compile(r'\{([^{}]+)\}')
+
+LEAD_VARIABLES = {
+    'lead_name': lambda lead: lead.nombre or 'Usuario',
+    'lead_phone': lambda lead: lead.telefono or '',
+    'lead_email': lambda lead: lead.email or '',
+}
+
+
+def options_suffix(entity):
+    """Lista numerada de opciones que se añade a los nodos MULTIPLE_CHOICE"""
+    if entity is None or entity.type != 'MULTIPLE_CHOICE' or not entity.options:
+        return ''
+    if not isinstance(entity.options, (list, tuple)):
+        return ''
+    suffix = "\n\n"
+    for idx, option in enumerate(entity.options, 1):
+        # Obtener el label de la opción, usar key si label está vacío
+        if isinstance(option, dict):
+            label = option.get('label', '').strip()
+            if not label:
+                label = option.get('key', f'Opción {idx}')
+        else:
+            label = str(option)
+        suffix += f"{idx}. {label}"
+    return suffix
+
+
+class CompiledTemplate:
+    """
+    message_template de un nodo separado en texto literal y variables.
+    Se renderiza en una pasada resolviendo solo las variables usadas;
+    sin variables el resultado es un texto fijo.
+    """
+    __slots__ = ('segments', 'names', 'suffix', 'static')
+
+    def __init__(self, text, suffix=''):
+        # split alterna literal, variable, literal, ...
+        self.segments = tuple(_PLACEHOLDER.split(text))
+        self.names = frozenset(self.segments[1::2])
+        self.suffix = suffix
+        self.static = text + suffix if not self.names else None
+
+    def render(self, session):
+        if self.static is not None:
+            return self.static
+
+        values = self.resolve(session)
+        parts = []
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                parts.append(segment)
+            elif segment in values:
+                parts.append(values[segment])
+            else:
+                parts.append('{' + segment + '}')
+        parts.append(self.suffix)
+        return ''.join(parts)
+
+    def resolve(self, session):
+        """
+        Valor de cada variable usada: entidad colectada, datos del lead o,
+        como fallback, el contexto de la sesión.
+        """
+        values = {
+            slug: str(value)
+            for slug, value in session.entities.variables(self.names).items()
+        }
+        collected = (session.context or {}).get('collected_entities') or {}
+        for name in self.names:
+            if name in values:
+                continue
+            if name in LEAD_VARIABLES:
+                values[name] = str(LEAD_VARIABLES[name](session.lead))
+            elif name in collected:
+                values[name] = str(collected[name])
+        return values
+
+
+def compile_template(node):
+    """Compila el mensaje de un Node (modelo o CompiledNode)"""
+    return CompiledTemplate(
+        node.message_template or f"Nodo: {node.title}",
+        options_suffix(node.collect_entity),
+    )
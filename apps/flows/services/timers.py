@@ -0,0 +1,363 @@
+# apps/flows/services/timers.py
+import heapq
+import threading
+import time
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+DELAY_UNITS = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}
+
+
+def _outbound_timeout():
+    return getattr(settings, 'FLOWS_TIMER_OUTBOUND_TIMEOUT', 10)
+
+
+def _stale_after():
+    # Un temporizador PROCESSING más viejo que esto se considera de un worker caído
+    return getattr(settings, 'FLOWS_TIMER_STALE_SECONDS', 300)
+
+
+def _claimable(now):
+    from ..models import TimerStatus
+
+    stale = now - timedelta(seconds=_stale_after())
+    return Q(status=TimerStatus.PENDING, due_at__lte=now) | Q(status=TimerStatus.PROCESSING, claimed_at__lt=stale)
+
+
+def delay_seconds(config):
+    """Duración de un nodo DELAY: suma de {seconds, minutes, hours, days} de su config"""
+    if not isinstance(config, dict):
+        return 0
+    total = 0.0
+    for unit, factor in DELAY_UNITS.items():
+        try:
+            total += float(config.get(unit) or 0) * factor
+        except (TypeError, ValueError):
+            print(f"⚠️ Valor inválido para '{unit}' en nodo DELAY: {config.get(unit)!r}")
+    return max(total, 0)
+
+
+def schedule_timer(session, node):
+    """
+    Programa la reanudación de la sesión al vencer el DELAY de `node`. Un
+    temporizador pendiente anterior de la misma sesión queda cancelado.
+    """
+    from ..models import FlowTimer, TimerStatus
+
+    FlowTimer.objects.filter(session_id=session.id, status=TimerStatus.PENDING).update(
+        status=TimerStatus.CANCELLED
+    )
+    timer = FlowTimer.objects.create(
+        session_id=session.id,
+        node_id=node.id,
+        due_at=timezone.now() + timedelta(seconds=delay_seconds(node.config)),
+    )
+    print(f"⏰ Temporizador #{timer.id} programado para {timer.due_at.isoformat()} (nodo {node.id})")
+    return timer
+
+
+class TimerStats:
+    """Contadores del worker de temporizadores; lag = disparo - vencimiento"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.fired = 0
+            self.cancelled = 0
+            self.failed = 0
+            self.lag_total = 0.0
+            self.lag_max = 0.0
+            self.lag_last = 0.0
+
+    def record_lag(self, lag):
+        with self._lock:
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_last = lag
+
+    def record_result(self, status):
+        from ..models import TimerStatus
+
+        with self._lock:
+            if status == TimerStatus.FIRED:
+                self.fired += 1
+            elif status == TimerStatus.CANCELLED:
+                self.cancelled += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        with self._lock:
+            claimed = self.fired + self.cancelled + self.failed
+            return {
+                'fired': self.fired,
+                'cancelled': self.cancelled,
+                'failed': self.failed,
+                'lag_avg_ms': round(self.lag_total / claimed * 1000, 3) if claimed else 0.0,
+                'lag_max_ms': round(self.lag_max * 1000, 3),
+                'lag_last_ms': round(self.lag_last * 1000, 3),
+            }
+
+
+stats = TimerStats()
+
+
+def claim_due(limit, ids=None):
+    """
+    Toma hasta `limit` temporizadores vencidos (de `ids`, si se indica) y los
+    marca PROCESSING. También retoma los PROCESSING de un worker que cayó
+    antes de dispararlos. Con SKIP LOCKED dos workers nunca toman el mismo.
+    """
+    from ..models import FlowTimer, TimerStatus
+
+    now = timezone.now()
+    with transaction.atomic():
+        queryset = FlowTimer.objects.filter(_claimable(now))
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        queryset = queryset.order_by('due_at')
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        timers = list(queryset[:limit])
+        if timers:
+            FlowTimer.objects.filter(id__in=[t.id for t in timers]).update(
+                status=TimerStatus.PROCESSING, claimed_at=now
+            )
+
+    for timer in timers:
+        if timer.status == TimerStatus.PENDING:
+            stats.record_lag((now - timer.due_at).total_seconds())
+        else:
+            print(f"♻️ Temporizador #{timer.id} retomado: quedó PROCESSING desde {timer.claimed_at.isoformat()}")
+        timer.status = TimerStatus.PROCESSING
+        timer.claimed_at = now
+    return timers
+
+
+def fire_timer(timer):
+    """
+    Reanuda la sesión del temporizador en el siguiente path de su nodo
+    DELAY. Si la sesión ya no está esperando en ese nodo (el usuario
+    respondió antes, se reinició o terminó) el temporizador se cancela.
+    Retorna el estado final del temporizador.
+    """
+    from apps.conversaciones.models import Message, MessageDirection, MessageType
+    from ..models import ConversationSession, FlowStatus, TimerStatus
+    from .analytics import counters as funnel_counters
+    from .locks import sender_lock
+    from .runtime import enter_node
+    from .unit_of_work import UnitOfWork
+
+    session = (
+        ConversationSession.objects
+        .select_related('flow__team', 'lead', 'conversacion')
+        .filter(pk=timer.session_id)
+        .first()
+    )
+    if session is None:
+        return TimerStatus.CANCELLED
+
+    # Como en el webhook: el paso completo se confirma en una transacción
+    with sender_lock(session.team_id, session.sender_id), transaction.atomic():
+        # El estado pudo cambiar mientras se esperaba el lock
+        session.refresh_from_db(fields=['current_node', 'status', 'context', 'flow_version', 'node_entered_at'])
+        if session.status != FlowStatus.ACTIVE or session.current_node_id != timer.node_id:
+            print(f"⏭️ Temporizador #{timer.id} descartado: la sesión {session.id} ya no está en el nodo {timer.node_id}")
+            return TimerStatus.CANCELLED
+
+        uow = UnitOfWork()
+        uow.track(session, session.conversacion)
+
+        next_node = enter_node(session, session.get_next_node(""))
+        response = None
+        if next_node is None:
+            session.finish_session(save=False)
+        else:
+            response = next_node.template.render(session)
+
+        if response and session.conversacion:
+            uow.add(Message(
+                conversacion=session.conversacion,
+                direction=MessageDirection.OUTBOUND,
+                type=MessageType.TEXT,
+                content=response,
+                metadata={
+                    'platform': session.platform,
+                    'is_automated': True,
+                    'source': 'timer',
+                    'node_id': next_node.id,
+                },
+            ))
+            session.conversacion.last_message_at = timezone.now()
+        uow.flush()
+
+    funnel_counters.maybe_flush()
+    if response:
+        deliver_followup(session, next_node, response)
+    return TimerStatus.FIRED
+
+
+def deliver_followup(session, node, response):
+    """
+    Envía el mensaje de la sesión reanudada a metadata['outbound_webhook']
+    del flujo, si está configurado. El mensaje ya quedó en la conversación.
+    """
+    metadata = session.flow.metadata if isinstance(session.flow.metadata, dict) else {}
+    url = metadata.get('outbound_webhook')
+    if not url:
+        return False
+    payload = {
+        'sender_id': session.sender_id,
+        'platform': session.platform,
+        'session_id': session.id,
+        'conversation_id': session.conversacion_id,
+        'node': {'id': node.id, 'title': node.title, 'type': node.type},
+        'response': response,
+    }
+    try:
+        r = requests.post(url, json=payload, timeout=_outbound_timeout())
+        r.raise_for_status()
+    except requests.RequestException as e:
+        print(f"⚠️ No se pudo entregar el seguimiento de la sesión {session.id}: {e}")
+        return False
+    return True
+
+
+def fire_timers(timers):
+    """
+    Dispara los temporizadores ya tomados con claim_due. Cada uno queda
+    FIRED (o CANCELLED/FAILED) solo después de fire_timer; si el worker cae
+    antes, sigue PROCESSING y otro lo retoma.
+    """
+    from ..models import FlowTimer, TimerStatus
+
+    for timer in timers:
+        try:
+            status = fire_timer(timer)
+        except Exception as e:
+            print(f"❌ Error disparando temporizador #{timer.id}: {e}")
+            FlowTimer.objects.filter(pk=timer.pk).update(status=TimerStatus.FAILED, error=str(e))
+            status = TimerStatus.FAILED
+        else:
+            if status == TimerStatus.FIRED:
+                timer.fired_at = timezone.now()
+                FlowTimer.objects.filter(pk=timer.pk).update(status=status, fired_at=timer.fired_at)
+            else:
+                FlowTimer.objects.filter(pk=timer.pk).update(status=status)
+        timer.status = status
+        stats.record_result(status)
+    return len(timers)
+
+
+class TimerScheduler:
+    """
+    Bucle del worker de temporizadores. Cada `refresh` segundos carga en un
+    min-heap los pendientes que vencen dentro de `horizon` segundos (una
+    consulta sobre el índice parcial de pendientes) y entre cargas duerme
+    justo hasta el siguiente vencimiento. Los vencidos se toman en lotes
+    con claim_due, así que varios workers pueden correr a la vez.
+    """
+
+    def __init__(self, batch_size=100, horizon=60.0, refresh=5.0):
+        self.batch_size = batch_size
+        self.horizon = horizon
+        self.refresh = refresh
+        self._heap = []
+        self._queued = set()
+
+    def refill(self, horizon=None):
+        """
+        Agrega al heap los pendientes del horizonte y los PROCESSING
+        abandonados por un worker caído. Retorna cuántos leyó.
+        """
+        from ..models import FlowTimer, TimerStatus
+
+        horizon = self.horizon if horizon is None else horizon
+        now = timezone.now()
+        limit = now + timedelta(seconds=horizon)
+        stale = now - timedelta(seconds=_stale_after())
+        rows = list(
+            FlowTimer.objects
+            .filter(
+                Q(status=TimerStatus.PENDING, due_at__lte=limit)
+                | Q(status=TimerStatus.PROCESSING, claimed_at__lt=stale)
+            )
+            .order_by('due_at')
+            .values_list('id', 'due_at')[:self.batch_size * 10]
+        )
+        for timer_id, due_at in rows:
+            if timer_id not in self._queued:
+                self._queued.add(timer_id)
+                heapq.heappush(self._heap, (due_at, timer_id))
+        return len(rows)
+
+    def fire_due(self):
+        """Toma y dispara un lote de los vencidos del heap. Retorna cuántos sacó del heap."""
+        now = timezone.now()
+        ids = []
+        while self._heap and self._heap[0][0] <= now and len(ids) < self.batch_size:
+            _, timer_id = heapq.heappop(self._heap)
+            self._queued.discard(timer_id)
+            ids.append(timer_id)
+        if ids:
+            # Los que ya tomó otro worker no vuelven en claim_due
+            fire_timers(claim_due(len(ids), ids=ids))
+        return len(ids)
+
+    def seconds_to_next(self):
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - timezone.now()).total_seconds(), 0)
+
+    def run(self, stop_event=None, once=False, stats_interval=60.0):
+        """
+        Procesa temporizadores hasta que `stop_event` se active (o, con
+        once=True, hasta que no quede ninguno vencido). Retorna cuántos tomó.
+        """
+        taken = 0
+        next_refill = 0.0
+        next_report = time.monotonic() + stats_interval
+        try:
+            while stop_event is None or not stop_event.is_set():
+                close_old_connections()
+                if once:
+                    self.refill(horizon=0)
+                    popped = self.fire_due()
+                    taken += popped
+                    if not popped:
+                        break
+                    continue
+
+                if time.monotonic() >= next_refill:
+                    self.refill()
+                    next_refill = time.monotonic() + self.refresh
+
+                popped = self.fire_due()
+                taken += popped
+
+                if time.monotonic() >= next_report:
+                    print(f"⏱️ Temporizadores: {stats.snapshot()}")
+                    next_report = time.monotonic() + stats_interval
+
+                if popped:
+                    continue
+                wait = next_refill - time.monotonic()
+                due_in = self.seconds_to_next()
+                if due_in is not None:
+                    wait = min(wait, due_in)
+                if wait > 0:
+                    if stop_event is not None:
+                        stop_event.wait(wait)
+                    else:
+                        time.sleep(wait)
+        finally:
+            connection.close()
+        return taken
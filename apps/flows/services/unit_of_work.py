@@ -0,0 +1,81 @@
+# apps/flows/services/unit_of_work.py
+import copy
+from contextlib import nullcontext
+
+from django.db import models, transaction
+
+
+class UnitOfWork:
+    """
+    Registra el estado de los objetos al inicio de un request y, al final,
+    guarda cada uno como máximo una vez con update_fields limitado a los
+    campos que cambiaron, todo dentro de una sola transacción. Los objetos
+    nuevos registrados con add() se insertan con un bulk_create por modelo
+    en la misma transacción.
+    """
+
+    def __init__(self):
+        self._tracked = {}
+        self._new = []
+
+    def track(self, *objs):
+        for obj in objs:
+            if obj is not None and id(obj) not in self._tracked:
+                self._tracked[id(obj)] = (obj, self._snapshot(obj))
+
+    def add(self, *objs):
+        """Objetos nuevos (sin guardar) que se insertan en flush()"""
+        self._new.extend(obj for obj in objs if obj is not None)
+
+    def changed_fields(self, obj):
+        entry = self._tracked.get(id(obj))
+        if entry is None:
+            return []
+        _, snapshot = entry
+        return [name for name, value in self._snapshot(obj).items() if snapshot[name] != value]
+
+    def flush(self):
+        """Inserta los objetos nuevos y guarda los modificados. Retorna el número de sentencias."""
+        pending = []
+        for obj, _ in self._tracked.values():
+            fields = self.changed_fields(obj)
+            if fields:
+                pending.append((obj, fields))
+
+        new_by_model = {}
+        for obj in self._new:
+            new_by_model.setdefault(type(obj), []).append(obj)
+        self._new = []
+
+        statements = len(pending) + len(new_by_model)
+        if not statements:
+            return 0
+
+        # Una sola sentencia ya es atómica; se evita el BEGIN/COMMIT extra
+        with transaction.atomic() if statements > 1 else nullcontext():
+            for model, objs in new_by_model.items():
+                model.objects.bulk_create(objs)
+            for obj, fields in pending:
+                obj.save(update_fields=fields + self._auto_now_fields(obj, fields))
+
+        for obj, _ in pending:
+            self._tracked[id(obj)] = (obj, self._snapshot(obj))
+        return statements
+
+    @staticmethod
+    def _snapshot(obj):
+        snapshot = {}
+        for f in obj._meta.concrete_fields:
+            if f.primary_key:
+                continue
+            value = getattr(obj, f.attname)
+            # Los JSONField se mutan en sitio (p. ej. session.context)
+            snapshot[f.attname] = copy.deepcopy(value) if isinstance(f, models.JSONField) else value
+        return snapshot
+
+    @staticmethod
+    def _auto_now_fields(obj, fields):
+        return [
+            f.attname for f in obj._meta.concrete_fields
+            if getattr(f, 'auto_now', False) and f.attname not in fields
+        ]
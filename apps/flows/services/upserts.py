@@ -0,0 +1,277 @@
+# apps/flows/services/upserts.py
+from django.db import connections, router
+from django.utils import timezone
+
+UPSERT_VENDORS = ('postgresql', 'sqlite')
+
+
+def supports_upsert(model):
+    """PostgreSQL y SQLite (3.35+) soportan INSERT ... ON CONFLICT ... RETURNING"""
+    connection = connections[router.db_for_write(model)]
+    return connection.vendor in UPSERT_VENDORS
+
+
+# Expresiones para DO UPDATE SET: {table} es la fila existente y
+# EXCLUDED la fila que se intentó insertar.
+FILL_IF_EMPTY = (
+    "CASE WHEN COALESCE({table}.{column}, '') = '' "
+    "AND COALESCE(EXCLUDED.{column}, '') <> '' "
+    "THEN EXCLUDED.{column} ELSE {table}.{column} END"
+)
+KEEP_EXISTING = "COALESCE({table}.{column}, EXCLUDED.{column})"
+PREFER_NEW = "COALESCE(EXCLUDED.{column}, {table}.{column})"
+TAKE_NEW = "EXCLUDED.{column}"
+ADD = "{table}.{column} + EXCLUDED.{column}"
+
+
+def upsert_returning(model, objs, unique_fields, update):
+    """
+    Inserta `objs` (instancias sin guardar) en una sola sentencia
+    INSERT ... ON CONFLICT (unique_fields) DO UPDATE SET ... RETURNING.
+
+    `update` mapea nombre de campo -> expresión SQL (FILL_IF_EMPTY,
+    KEEP_EXISTING, ...), donde {table} y {column} se sustituyen por los
+    nombres ya entrecomillados.
+    Retorna las filas resultantes como instancias del modelo.
+    """
+    if not objs:
+        return []
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = model._meta
+    table = qn(meta.db_table)
+
+    insert_fields = [f for f in meta.concrete_fields if not f.primary_key]
+    rows_sql = []
+    params = []
+    for obj in objs:
+        rows_sql.append('(' + ', '.join(['%s'] * len(insert_fields)) + ')')
+        for f in insert_fields:
+            params.append(f.get_db_prep_save(f.pre_save(obj, add=True), connection))
+
+    set_sql = ', '.join(
+        f"{qn(meta.get_field(name).column)} = "
+        + expression.format(table=table, column=qn(meta.get_field(name).column))
+        for name, expression in update.items()
+    )
+    returning_fields = list(meta.concrete_fields)
+
+    sql = (
+        f"INSERT INTO {table} ({', '.join(qn(f.column) for f in insert_fields)}) "
+        f"VALUES {', '.join(rows_sql)} "
+        f"ON CONFLICT ({', '.join(qn(meta.get_field(name).column) for name in unique_fields)}) "
+        f"DO UPDATE SET {set_sql} "
+        f"RETURNING {', '.join(f'{table}.{qn(f.column)}' for f in returning_fields)}"
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    converters = []
+    for f in returning_fields:
+        col = f.get_col(meta.db_table)
+        converters.append(connection.ops.get_db_converters(col) + col.get_db_converters(connection))
+
+    field_names = [f.attname for f in returning_fields]
+    instances = []
+    for row in rows:
+        values = []
+        for value, field_converters, f in zip(row, converters, returning_fields):
+            for converter in field_converters:
+                value = converter(value, f.get_col(meta.db_table), connection)
+            values.append(value)
+        instances.append(model.from_db(using, field_names, values))
+    return instances
+
+
+def merge_senders(senders):
+    """
+    Agrupa los datos de remitentes por sender_id: toma la primera
+    plataforma y el primer nombre/teléfono/email no vacío de cada uno.
+    """
+    merged = {}
+    for sender in senders:
+        # Los ids pueden llegar como números en el JSON; en la BD son texto
+        sender = dict(sender, sender_id=str(sender['sender_id']), platform=str(sender['platform']))
+        current = merged.get(sender['sender_id'])
+        if current is None:
+            merged[sender['sender_id']] = sender
+            continue
+        for key in ('sender_name', 'sender_phone', 'sender_email'):
+            if not current.get(key) and sender.get(key):
+                current[key] = sender[key]
+        current['has_message'] = current.get('has_message') or sender.get('has_message')
+    return list(merged.values())
+
+
+def resolve_participants(team, flow, start_node_id, senders):
+    """
+    Obtiene o crea Lead, Conversacion y ConversationSession de cada
+    remitente con tres sentencias en total, sin importar cuántos sean.
+
+    `senders` es una lista de dicts con sender_id, platform, sender_name,
+    sender_phone, sender_email, platform_data y has_message.
+    Retorna {sender_id: (lead, conversacion, session)}.
+    """
+    from apps.leads.models import Lead
+    from apps.conversaciones.models import Conversacion, ConversationStatus
+    from ..models import ConversationSession
+
+    senders = merge_senders(senders)
+    if not supports_upsert(Lead):
+        return _resolve_participants_orm(team, flow, start_node_id, senders)
+
+    now = timezone.now()
+
+    # 1. Leads: solo se rellenan nombre/teléfono/email vacíos
+    leads = upsert_returning(
+        Lead,
+        [
+            Lead(
+                plataforma=s['platform'],
+                plataforma_id=s['sender_id'],
+                nombre=s.get('sender_name', ''),
+                telefono=s.get('sender_phone', ''),
+                email=s.get('sender_email', ''),
+                fuente='mensaje_directo',
+                asignado_a=team,
+                ultima_interaccion=now,
+            )
+            for s in senders
+        ],
+        unique_fields=['plataforma', 'plataforma_id'],
+        update={
+            'nombre': FILL_IF_EMPTY,
+            'telefono': FILL_IF_EMPTY,
+            'email': FILL_IF_EMPTY,
+            'ultima_interaccion': TAKE_NEW,
+            'fecha_actualizacion': TAKE_NEW,
+        },
+    )
+    leads_by_key = {(lead.plataforma, lead.plataforma_id): lead for lead in leads}
+    lead_for = {s['sender_id']: leads_by_key[(s['platform'], s['sender_id'])] for s in senders}
+
+    # 2. Conversaciones
+    conversaciones = upsert_returning(
+        Conversacion,
+        [
+            Conversacion(
+                sender_id=s['sender_id'],
+                team=team,
+                platform=s['platform'],
+                lead=lead_for[s['sender_id']],
+                status=ConversationStatus.ACTIVE,
+                last_message_at=now if s.get('has_message') else None,
+            )
+            for s in senders
+        ],
+        unique_fields=['sender_id', 'team'],
+        update={
+            'last_message_at': PREFER_NEW,
+            'updated_at': TAKE_NEW,
+        },
+    )
+    conversacion_for = {c.sender_id: c for c in conversaciones}
+
+    # 3. Sesiones: se conservan la conversación y la versión ya asignadas
+    sessions = upsert_returning(
+        ConversationSession,
+        [
+            ConversationSession(
+                sender_id=s['sender_id'],
+                flow=flow,
+                team=team,
+                current_node_id=start_node_id,
+                flow_version_id=flow.published_version_id,
+                lead=lead_for[s['sender_id']],
+                conversacion=conversacion_for[s['sender_id']],
+                platform=s['platform'],
+                platform_data=s.get('platform_data', {}),
+            )
+            for s in senders
+        ],
+        unique_fields=['sender_id', 'flow', 'team'],
+        update={
+            'conversacion': KEEP_EXISTING,
+        },
+    )
+
+    result = {}
+    for session in sessions:
+        lead = lead_for[session.sender_id]
+        conversacion = conversacion_for[session.sender_id]
+        session.flow = flow
+        session.team = team
+        if session.lead_id == lead.id:
+            session.lead = lead
+        if session.conversacion_id == conversacion.id:
+            session.conversacion = conversacion
+        else:
+            conversacion = session.conversacion
+        result[session.sender_id] = (lead, conversacion, session)
+    return result
+
+
+def _resolve_participants_orm(team, flow, start_node_id, senders):
+    """Fallback con get_or_create para motores sin ON CONFLICT ... RETURNING"""
+    from apps.leads.models import Lead
+    from apps.conversaciones.utils import get_or_create_conversation
+    from ..models import ConversationSession
+
+    result = {}
+    now = timezone.now()
+    for s in senders:
+        lead, lead_created = Lead.objects.get_or_create(
+            plataforma=s['platform'],
+            plataforma_id=s['sender_id'],
+            defaults={
+                'nombre': s.get('sender_name', ''),
+                'telefono': s.get('sender_phone', ''),
+                'email': s.get('sender_email', ''),
+                'fuente': 'mensaje_directo',
+                'asignado_a': team,
+            }
+        )
+        if not lead_created:
+            for field, key in (('nombre', 'sender_name'), ('telefono', 'sender_phone'), ('email', 'sender_email')):
+                if s.get(key) and not getattr(lead, field):
+                    setattr(lead, field, s[key])
+        lead.ultima_interaccion = now
+        lead.save()
+
+        session, _ = ConversationSession.objects.get_or_create(
+            sender_id=s['sender_id'],
+            flow=flow,
+            team=team,
+            defaults={
+                'current_node_id': start_node_id,
+                'flow_version_id': flow.published_version_id,
+                'lead': lead,
+                'platform': s['platform'],
+                'platform_data': s.get('platform_data', {}),
+            }
+        )
+        if not session.conversacion_id:
+            conversacion, _ = get_or_create_conversation(
+                sender_id=s['sender_id'],
+                team=team,
+                platform=s['platform'],
+                lead=lead
+            )
+            session.conversacion = conversacion
+            session.save(update_fields=['conversacion'])
+        else:
+            conversacion = session.conversacion
+        if s.get('has_message'):
+            conversacion.last_message_at = now
+        conversacion.save(update_fields=['last_message_at', 'updated_at'])
+
+        session.flow = flow
+        session.team = team
+        if session.lead_id == lead.id:
+            session.lead = lead
+        result[s['sender_id']] = (lead, conversacion, session)
+    return result
@@ -0,0 +1,27 @@
+# apps/flows/services/versions.py
+from django.db import transaction
+
+from .graph import serialize_flow
+
+
+def publish_flow(flow, user=None):
+    """
+    Congela el grafo vivo de `flow` en un FlowVersion inmutable y lo marca
+    como la versión publicada. Flow.version pasa a ser el número del
+    siguiente borrador. Las sesiones en curso siguen en su versión hasta
+    reiniciarse.
+    """
+    from ..models import Flow, FlowVersion
+
+    with transaction.atomic():
+        flow = Flow.objects.select_for_update().get(pk=flow.pk)
+        snapshot = FlowVersion.objects.create(
+            flow=flow,
+            version=flow.version,
+            graph=serialize_flow(flow),
+            published_by=user,
+        )
+        flow.published_version = snapshot
+        flow.version += 1
+        flow.save(update_fields=['published_version', 'version'])
+    return snapshot
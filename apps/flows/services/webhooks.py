@@ -0,0 +1,346 @@
+# apps/flows/services/webhooks.py
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .templates import CompiledTemplate
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def _pool_hosts():
+    return getattr(settings, 'FLOWS_WEBHOOK_POOL_HOSTS', 32)
+
+
+def _pool_maxsize():
+    # Conexiones keep-alive que se conservan por host
+    return getattr(settings, 'FLOWS_WEBHOOK_POOL_MAXSIZE', 10)
+
+
+def _connect_timeout():
+    return getattr(settings, 'FLOWS_WEBHOOK_CONNECT_TIMEOUT', 3.05)
+
+
+def _read_timeout():
+    # Tope para el "timeout" configurado en cada nodo
+    return getattr(settings, 'FLOWS_WEBHOOK_READ_TIMEOUT', 10)
+
+
+def _cache_ttl():
+    # Solo para GET; los demás métodos se cachean si el nodo define cache_ttl
+    return getattr(settings, 'FLOWS_WEBHOOK_CACHE_TTL', 60)
+
+
+def _cache_size():
+    return getattr(settings, 'FLOWS_WEBHOOK_CACHE_SIZE', 1000)
+
+
+# --- Sesión HTTP compartida ---
+
+_http = None
+_http_lock = threading.Lock()
+
+
+def http_session():
+    """
+    requests.Session compartida por todos los nodos WEBHOOK del proceso:
+    reutiliza conexiones (keep-alive) y conserva hasta
+    FLOWS_WEBHOOK_POOL_MAXSIZE por host. Con el pool lleno se abre una
+    conexión extra que se cierra al terminar (pool_block=False): esperar
+    un lugar en el pool no tiene timeout en requests y dejaría el paso
+    del flujo colgado. No guarda cookies, para que nada pase de un team
+    a otro.
+    """
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                session = requests.Session()
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(
+                    pool_connections=_pool_hosts(),
+                    pool_maxsize=_pool_maxsize(),
+                    pool_block=False,
+                    max_retries=0,
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _http = session
+    return _http
+
+
+def close_http_session():
+    global _http
+    with _http_lock:
+        if _http is not None:
+            _http.close()
+            _http = None
+
+
+# --- Métricas ---
+
+class WebhookStats:
+    """Llamadas, errores, aciertos de caché y latencia por host (por proceso)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+
+    def record(self, host, elapsed, ok, cached=False):
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                entry = self._hosts[host] = {
+                    'calls': 0, 'errors': 0, 'cache_hits': 0, 'latency_total': 0.0, 'latency_max': 0.0,
+                }
+            if cached:
+                entry['cache_hits'] += 1
+                return
+            entry['calls'] += 1
+            if not ok:
+                entry['errors'] += 1
+            entry['latency_total'] += elapsed
+            entry['latency_max'] = max(entry['latency_max'], elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                host: {
+                    'calls': e['calls'],
+                    'errors': e['errors'],
+                    'cache_hits': e['cache_hits'],
+                    'latency_avg_ms': round(e['latency_total'] / e['calls'] * 1000, 3) if e['calls'] else 0.0,
+                    'latency_max_ms': round(e['latency_max'] * 1000, 3),
+                }
+                for host, e in self._hosts.items()
+            }
+
+
+stats = WebhookStats()
+
+
+# --- Caché de respuestas ---
+
+# clave del request renderizado -> (expira, resultado), los más recientes al final
+_responses = OrderedDict()
+_responses_lock = threading.Lock()
+
+
+def _cached(key):
+    with _responses_lock:
+        entry = _responses.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _responses[key]
+            return None
+        _responses.move_to_end(key)
+        return entry[1]
+
+
+def _store(key, result, ttl):
+    with _responses_lock:
+        _responses[key] = (time.monotonic() + ttl, result)
+        _responses.move_to_end(key)
+        while len(_responses) > _cache_size():
+            _responses.popitem(last=False)
+
+
+def clear_webhook_cache():
+    with _responses_lock:
+        _responses.clear()
+
+
+# --- Compilación de la config del nodo ---
+
+def _compile_value(value):
+    if isinstance(value, str):
+        return CompiledTemplate(value)
+    if isinstance(value, dict):
+        return {str(k): _compile_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_compile_value(v) for v in value]
+    return value
+
+
+def _render_value(value, session):
+    if isinstance(value, CompiledTemplate):
+        return value.render(session)
+    if isinstance(value, dict):
+        return {k: _render_value(v, session) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_render_value(v, session) for v in value]
+    return value
+
+
+def _split_path(path):
+    """'data.items.0.total' -> ('data', 'items', 0, 'total')"""
+    return tuple(int(part) if part.isdigit() else part for part in str(path).split('.') if part)
+
+
+def extract_path(data, path):
+    """Valor de `data` en `path` (ver _split_path) o None si no existe"""
+    for part in path:
+        if isinstance(part, int) and isinstance(data, list):
+            if part >= len(data):
+                return None
+            data = data[part]
+        elif isinstance(data, dict) and str(part) in data:
+            data = data[str(part)]
+        else:
+            return None
+    return data
+
+
+class WebhookCall:
+    """
+    Config de un nodo WEBHOOK ya compilada: url, headers, query y body con
+    sus variables separadas y las rutas de response_map divididas.
+
+    config: {
+        "method": "POST", "url": "https://api/{slug}", "headers": {...},
+        "query": {...}, "body": {...}, "timeout": 5, "cache_ttl": 60,
+        "response_map": {"entity_slug": "data.campo"}
+    }
+    """
+
+    def __init__(self, config):
+        url = config.get('url')
+        if not url or not isinstance(url, str):
+            raise ValueError('url is required')
+        self.method = str(config.get('method') or 'POST').upper()
+        if self.method not in METHODS:
+            raise ValueError(f'unsupported method {self.method}')
+        self.url = CompiledTemplate(url)
+        self.headers = _compile_value(config.get('headers') or {})
+        self.params = _compile_value(config.get('query') or {})
+        self.body = _compile_value(config['body']) if config.get('body') is not None else None
+        self.response_map = {
+            str(slug): _split_path(path) for slug, path in (config.get('response_map') or {}).items()
+        }
+        timeout = float(config.get('timeout') or _read_timeout())
+        self.timeout = (_connect_timeout(), min(timeout, _read_timeout()))
+        default_ttl = _cache_ttl() if self.method == 'GET' else 0
+        self.cache_ttl = float(config.get('cache_ttl', default_ttl) or 0)
+
+    def render(self, session):
+        """Request listo para enviar, con las variables de la sesión"""
+        return {
+            'method': self.method,
+            'url': self.url.render(session),
+            'headers': {k: str(v) for k, v in _render_value(self.headers, session).items()},
+            'params': _render_value(self.params, session),
+            'json': _render_value(self.body, session),
+        }
+
+    def extract(self, data):
+        """{slug: valor} de la respuesta según response_map (omite las rutas sin valor)"""
+        values = {}
+        for slug, path in self.response_map.items():
+            value = extract_path(data, path)
+            if value is not None:
+                values[slug] = value
+        return values
+
+
+def compile_webhook(config):
+    """WebhookCall de la config de un nodo, o None si no es válida"""
+    if not isinstance(config, dict):
+        return None
+    try:
+        return WebhookCall(config)
+    except (TypeError, ValueError) as e:
+        print(f"⚠️ Config inválida en nodo WEBHOOK: {e}")
+        return None
+
+
+# --- Ejecución ---
+
+def perform_request(request, team_id=None, cache_ttl=0, timeout=None):
+    """
+    Envía `request` (ver WebhookCall.render) por la sesión compartida.
+    Retorna {'ok', 'status_code', 'data', 'error', 'cached', 'elapsed_ms'}.
+    Las respuestas 2xx se cachean `cache_ttl` segundos por request renderizado.
+    """
+    host = urlsplit(request['url']).netloc or request['url']
+    key = None
+    if cache_ttl > 0:
+        raw = json.dumps([team_id, request], sort_keys=True, default=str)
+        key = hashlib.sha256(raw.encode()).hexdigest()
+        cached = _cached(key)
+        if cached is not None:
+            stats.record(host, 0.0, True, cached=True)
+            return dict(cached, cached=True, elapsed_ms=0.0)
+
+    started = time.perf_counter()
+    try:
+        r = http_session().request(
+            request['method'],
+            request['url'],
+            headers=request['headers'] or None,
+            params=request['params'] or None,
+            json=request['json'],
+            timeout=timeout or (_connect_timeout(), _read_timeout()),
+        )
+        try:
+            data = r.json()
+        except ValueError:
+            data = r.text
+        result = {'ok': r.ok, 'status_code': r.status_code, 'data': data, 'error': None if r.ok else r.reason}
+    except requests.RequestException as e:
+        result = {'ok': False, 'status_code': None, 'data': None, 'error': str(e)}
+    elapsed = time.perf_counter() - started
+    stats.record(host, elapsed, result['ok'])
+
+    if key is not None and result['ok']:
+        _store(key, result, cache_ttl)
+    return dict(result, cached=False, elapsed_ms=round(elapsed * 1000, 3))
+
+
+def run_webhook_node(session, node):
+    """
+    Ejecuta un nodo WEBHOOK: renderiza el request, lo envía, guarda los
+    campos de response_map como EntityValue y deja el resultado en
+    session.context['last_webhook'] para las condiciones de los paths.
+    """
+    from .entities import store_entity_values
+
+    call = getattr(node, 'action', None) or compile_webhook(node.config)
+    if call is None:
+        print(f"❌ Nodo WEBHOOK {node.id} sin config válida")
+        session.context['last_webhook'] = {'node_id': node.id, 'ok': False, 'error': 'invalid config'}
+        return None
+
+    request = call.render(session)
+    result = perform_request(request, session.team_id, call.cache_ttl, call.timeout)
+    print(
+        f"🌐 WEBHOOK {request['method']} {request['url']} -> {result['status_code']} "
+        f"({result['elapsed_ms']} ms{', caché' if result['cached'] else ''})"
+    )
+
+    if result['ok'] and call.response_map:
+        values = call.extract(result['data'])
+        if values:
+            store_entity_values(session, values, node_id=node.id, source='webhook')
+
+    session.context['last_webhook'] = {
+        'node_id': node.id,
+        'ok': result['ok'],
+        'status_code': result['status_code'],
+        'error': result['error'],
+        'elapsed_ms': result['elapsed_ms'],
+        'cached': result['cached'],
+    }
+    return result
@@ -0,0 +1,40 @@
+# apps/flows/signals.py
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from apps.teams.models import Team
+from .models import Flow, Node, Path, Entity
+from .services.exports import invalidate_flow_detail
+from .services.extraction import invalidate_team_extractor
+from .services.graph import invalidate_flow_graph
+
+
+@receiver([post_save, post_delete], sender=Flow)
+def invalidate_flow(sender, instance, **kwargs):
+    invalidate_flow_graph(flow_id=instance.id)
+    invalidate_flow_detail(flow_id=instance.id)
+
+
+@receiver([post_save, post_delete], sender=Node)
+def invalidate_node(sender, instance, **kwargs):
+    invalidate_flow_graph(flow_id=instance.flow_id)
+    invalidate_flow_detail(flow_id=instance.flow_id)
+
+
+@receiver([post_save, post_delete], sender=Path)
+def invalidate_path(sender, instance, **kwargs):
+    # Sin consulta extra: basta con saber qué grafo en caché contiene el nodo
+    invalidate_flow_graph(node_id=instance.node_id)
+    invalidate_flow_detail(node_id=instance.node_id)
+
+
+@receiver([post_save, post_delete], sender=Entity)
+def invalidate_entity(sender, instance, **kwargs):
+    invalidate_flow_graph(team_id=instance.team_id)
+    invalidate_flow_detail(team_id=instance.team_id)
+    invalidate_team_extractor(instance.team_id)
+
+
+@receiver(post_save, sender=Team)
+def invalidate_team(sender, instance, **kwargs):
+    # Las palabras clave de comandos (flow_commands) forman parte del grafo
+    invalidate_flow_graph(team_id=instance.id)
@@ -1,3 +1,1201 @@
-from django.test import TestCase
+import json
+import socket
+import threading
+import time
+from types import SimpleNamespace
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from apps.conversaciones.models import Message
+from apps.teams.models import Team
+
+from .models import (
+    CollectMode, ConversationSession, Entity, EntityType, EntityValue, Flow, FlowTimer, InboundMessage, InboundStatus,
+    FlowVersion, Node, NodeType, Path, WebhookDelivery,
+)
+from .services import analytics, dedup, exports, locks, webhooks
+from .services import graph as graph_cache
+from .services.conditions import compile_condition
+from .services.dedup import clear_dedup_cache
+from .services.entities import date_iso, with_date_iso
+from .services.extraction import TeamExtractor
+from .services.graph import clear_flow_graph_cache, get_flow_graph
+from .services.graph_io import GraphError, clone_flow, export_flow, import_flow, save_graph
+from .services.inbound import check_callback_url
+from .services.locks import SenderLockTimeout, sender_lock
+from .services.options import OptionMatcher, edit_distance
+from .services.scripts import CompiledScript, ScriptBudgetExceeded, ScriptError
+from .services.segments import segment_page
+from .services.sweeper import finish_stale_sessions, purge_inbound_messages, purge_webhook_deliveries
+from .services.timers import claim_due, delay_seconds, fire_timers
+from .services.upserts import resolve_participants, supports_upsert
+from .services.versions import publish_flow
+from .services.webhooks import WebhookCall, perform_request, run_webhook_node
+from .views import FlowProcessorView
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Respuestas fijas por ruta; guarda el puerto de origen de cada request"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.client_address[1]))
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+            self._send(200, {'slow': True})
+        elif self.path.startswith('/error'):
+            self._send(500, {'error': 'boom'})
+        elif self.path.startswith('/text'):
+            self._send(200, 'sin json', content_type='text/plain')
+        else:
+            self._send(200, {'data': {'total': 42, 'items': [{'nombre': 'Ana'}]}, 'path': self.path})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null')
+        self.server.requests.append((self.command, self.path, self.client_address[1]))
+        self._send(200, {'echo': body})
+
+    def _send(self, status, payload, content_type='application/json'):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente ya se fue por timeout
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServerMixin:
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.server.daemon_threads = True
+        cls.server.requests = []
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        webhooks.close_http_session()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.server.requests.clear()
+        webhooks.close_http_session()
+        webhooks.clear_webhook_cache()
+        webhooks.stats.reset()
+
+    def request(self, path, method='GET', body=None):
+        return {'method': method, 'url': self.base_url + path, 'headers': {}, 'params': {}, 'json': body}
+
+
+class PerformRequestTests(StubServerMixin, SimpleTestCase):
+
+    def test_reuses_pooled_connection(self):
+        for i in range(3):
+            result = perform_request(self.request(f'/json?i={i}'))
+            self.assertTrue(result['ok'])
+        ports = {port for _, _, port in self.server.requests}
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(ports), 1)
+        self.assertIs(webhooks.http_session(), webhooks.http_session())
+
+    def test_parses_json_and_text(self):
+        result = perform_request(self.request('/json'))
+        self.assertEqual(result['status_code'], 200)
+        self.assertEqual(result['data']['data']['total'], 42)
+        self.assertIsNone(result['error'])
+
+        result = perform_request(self.request('/text'))
+        self.assertEqual(result['data'], 'sin json')
+
+        result = perform_request(self.request('/echo', method='POST', body={'a': 1}))
+        self.assertEqual(result['data'], {'echo': {'a': 1}})
+
+    def test_http_error_is_not_ok(self):
+        result = perform_request(self.request('/error'))
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['status_code'], 500)
+        self.assertEqual(result['error'], 'Internal Server Error')
+        self.assertEqual(webhooks.stats.snapshot()[self.base_url[len('http://'):]]['errors'], 1)
+
+    def test_read_timeout(self):
+        result = perform_request(self.request('/slow'), timeout=(1, 0.1))
+        self.assertFalse(result['ok'])
+        self.assertIsNone(result['status_code'])
+        self.assertIn('timed out', result['error'])
+
+    @override_settings(FLOWS_WEBHOOK_POOL_MAXSIZE=1)
+    def test_full_pool_does_not_wait(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(perform_request(self.request('/slow'), timeout=(1, 2))))
+            for _ in range(3)
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.monotonic() - started, 1.2)
+        self.assertTrue(all(result['ok'] for result in results))
+
+    def test_connection_refused(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        request = dict(self.request('/json'), url=f"http://127.0.0.1:{port}/json")
+        result = perform_request(request, timeout=(0.5, 0.5))
+        self.assertFalse(result['ok'])
+        self.assertIsNone(result['status_code'])
+        self.assertTrue(result['error'])
+
+    @override_settings(FLOWS_WEBHOOK_READ_TIMEOUT=2)
+    def test_node_timeout_is_capped(self):
+        call = WebhookCall({'url': self.base_url, 'timeout': 60})
+        self.assertEqual(call.timeout[1], 2)
+
+    def test_caches_successful_responses(self):
+        first = perform_request(self.request('/json'), team_id=1, cache_ttl=60)
+        second = perform_request(self.request('/json'), team_id=1, cache_ttl=60)
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['data'], first['data'])
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Otro team no comparte la respuesta
+        other = perform_request(self.request('/json'), team_id=2, cache_ttl=60)
+        self.assertFalse(other['cached'])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_does_not_cache_errors_or_expired(self):
+        perform_request(self.request('/error'), cache_ttl=60)
+        perform_request(self.request('/error'), cache_ttl=60)
+        self.assertEqual(len(self.server.requests), 2)
+
+        perform_request(self.request('/json'), cache_ttl=0.05)
+        time.sleep(0.1)
+        result = perform_request(self.request('/json'), cache_ttl=0.05)
+        self.assertFalse(result['cached'])
+        self.assertEqual(len(self.server.requests), 4)
+
+
+class WebhookNodeTests(StubServerMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.team = Team.objects.create(name='Team')
+        self.flow = Flow.objects.create(team=self.team, name='Flujo')
+        self.total = Entity.objects.create(team=self.team, name='Total', slug='total', type=EntityType.NUMBER)
+        self.nombre = Entity.objects.create(team=self.team, name='Nombre', slug='nombre', type=EntityType.TEXT)
+        self.session = ConversationSession.objects.create(
+            team=self.team, flow=self.flow, sender_id='5215550000',
+        )
+
+    def node(self, **config):
+        return Node.objects.create(flow=self.flow, type=NodeType.WEBHOOK, title='Webhook', config=config)
+
+    def test_stores_response_map_as_entity_values(self):
+        node = self.node(
+            method='GET',
+            url=self.base_url + '/json',
+            query={'canal': 'whatsapp'},
+            response_map={'total': 'data.total', 'nombre': 'data.items.0.nombre', 'falta': 'data.nada'},
+        )
+        result = run_webhook_node(self.session, node)
+
+        self.assertTrue(result['ok'])
+        values = {
+            v.entity.slug: v for v in EntityValue.objects.filter(team=self.team, sender_id=self.session.sender_id)
+        }
+        self.assertEqual(set(values), {'total', 'nombre'})
+        self.assertEqual(values['total'].value['processed'], 42)
+        self.assertEqual(values['total'].value_num, 42)
+        self.assertEqual(values['nombre'].value['processed'], 'Ana')
+        self.assertEqual(self.session.context['last_webhook']['status_code'], 200)
+        self.assertTrue(self.session.context['last_webhook']['ok'])
+
+    def test_failed_call_stores_nothing(self):
+        node = self.node(method='GET', url=self.base_url + '/error', response_map={'total': 'error'})
+        result = run_webhook_node(self.session, node)
+
+        self.assertFalse(result['ok'])
+        self.assertFalse(EntityValue.objects.filter(team=self.team).exists())
+        self.assertFalse(self.session.context['last_webhook']['ok'])
+        self.assertEqual(self.session.context['last_webhook']['status_code'], 500)
+
+    def test_invalid_config(self):
+        node = self.node(method='GET')
+        self.assertIsNone(run_webhook_node(self.session, node))
+        self.assertEqual(self.session.context['last_webhook']['error'], 'invalid config')
+
+
+class FlowFixtureMixin:
+    """
+    Flujo de prueba: inicio -> nombre (TEXT) -> color (MULTIPLE_CHOICE) -> fin
+    y helpers para llamar al webhook
+    """
+
+    def setUp(self):
+        super().setUp()
+        clear_flow_graph_cache()
+        clear_dedup_cache()
+        self.team = Team.objects.create(name='Team')
+        self.flow = Flow.objects.create(team=self.team, name='Flujo')
+        self.nombre = Entity.objects.create(team=self.team, name='Nombre', slug='nombre', type=EntityType.TEXT)
+        self.color = Entity.objects.create(
+            team=self.team, name='Color', slug='color', type=EntityType.MULTIPLE_CHOICE,
+            options=[{'key': 'rojo', 'label': 'Rojo'}, {'key': 'azul', 'label': 'Azul'}],
+        )
+        self.start = self.node(NodeType.START, 'Inicio', 'Hola')
+        self.ask_name = self.node(NodeType.QUESTION, 'Pedir nombre', '¿Cómo te llamas?', self.nombre)
+        self.ask_color = self.node(NodeType.QUESTION, 'Pedir color', 'Hola {nombre}, ¿qué color?', self.color)
+        self.end = self.node(NodeType.END, 'Fin', 'Gracias')
+        self.link(self.start, self.ask_name)
+        self.link(self.ask_name, self.ask_color)
+        self.link(self.ask_color, self.end)
+
+    def node(self, type, title, template='', entity=None, **fields):
+        return Node.objects.create(
+            flow=self.flow, type=type, title=title, message_template=template, collect_entity=entity,
+            collect_entity_mode=CollectMode.REQUIRED if entity else CollectMode.NONE, **fields,
+        )
+
+    def link(self, node, target, condition=None, order=0):
+        return Path.objects.create(node=node, target_node=target, label='->', condition=condition, order=order)
+
+    def url(self, suffix=''):
+        return f"/webhook/{self.team.slug}/{self.flow.slug}/{suffix}"
+
+    def post(self, data, suffix=''):
+        return self.client.post(self.url(suffix), json.dumps(data), content_type='application/json')
+
+    def send(self, message, sender_id='5215550000', **extra):
+        response = self.post(dict({'sender_id': sender_id, 'message': message}, **extra))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def session(self, sender_id='5215550000'):
+        return ConversationSession.objects.get(team=self.team, sender_id=sender_id)
+
+    def values(self, sender_id='5215550000'):
+        return {
+            ev.entity.slug: ev.value['processed']
+            for ev in EntityValue.objects.filter(team=self.team, sender_id=sender_id).select_related('entity')
+        }
+
+
+class WebhookStepTests(FlowFixtureMixin, TestCase):
+
+    def test_collects_entities_along_the_flow(self):
+        self.assertEqual(self.send('hola')['response'], '¿Cómo te llamas?')
+        self.assertTrue(self.send('Ana')['response'].startswith('Hola Ana, ¿qué color?'))
+        self.assertEqual(self.send('azul')['status'], 'success')
+        self.assertEqual(self.values(), {'nombre': 'Ana', 'color': 'Azul'})
+        self.assertEqual(self.session().current_node_id, self.end.id)
+
+    def test_failed_flush_rolls_back_the_whole_step(self):
+        self.send('hola')
+        messages = Message.objects.count()
+        with mock.patch('apps.flows.services.unit_of_work.UnitOfWork.flush', side_effect=DatabaseError('boom')):
+            response = self.post({'sender_id': '5215550000', 'message': 'Ana'})
+        self.assertEqual(response.status_code, 500)
+
+        # Ni la entidad ni el avance de nodo ni los mensajes quedaron a medias
+        self.assertEqual(self.values(), {})
+        self.assertEqual(self.session().current_node_id, self.ask_name.id)
+        self.assertEqual(Message.objects.count(), messages)
+
+        # El reintento procesa el paso completo
+        self.assertTrue(self.send('Ana')['response'].startswith('Hola Ana, ¿qué color?'))
+        self.assertEqual(self.values(), {'nombre': 'Ana'})
+
+    def test_failed_step_does_not_keep_delay_timer(self):
+        delay = self.node(NodeType.DELAY, 'Esperar', '', config={'minutes': 5})
+        Path.objects.filter(node=self.ask_name).update(target_node=delay)
+        self.link(delay, self.ask_color)
+        self.send('hola')
+        with mock.patch('apps.flows.services.unit_of_work.UnitOfWork.flush', side_effect=DatabaseError('boom')):
+            self.post({'sender_id': '5215550000', 'message': 'Ana'})
+        self.assertFalse(FlowTimer.objects.exists())
+
+        self.send('Ana')
+        self.assertEqual(FlowTimer.objects.count(), 1)
+
+
+class WebhookDedupTests(FlowFixtureMixin, TestCase):
+
+    def test_retry_returns_stored_response_without_reprocessing(self):
+        self.send('hola', message_id='m1')
+        first = self.send('Ana', message_id='m2')
+        messages = Message.objects.count()
+
+        # Otro proceso: sin la caché en memoria, la respuesta sale de la BD
+        clear_dedup_cache()
+        self.assertEqual(self.send('Ana', message_id='m2'), first)
+        self.assertEqual(Message.objects.count(), messages)
+        self.assertEqual(self.session().current_node_id, self.ask_color.id)
+        self.assertEqual(WebhookDelivery.objects.filter(team=self.team).count(), 2)
+
+    def test_failed_step_leaves_no_delivery_record(self):
+        self.send('hola', message_id='m1')
+        with mock.patch('apps.flows.services.unit_of_work.UnitOfWork.flush', side_effect=DatabaseError('boom')):
+            self.post({'sender_id': '5215550000', 'message': 'Ana', 'message_id': 'm2'})
+        self.assertFalse(WebhookDelivery.objects.filter(external_id='m2').exists())
+
+        self.assertEqual(self.send('Ana', message_id='m2')['status'], 'success')
+        self.assertEqual(self.values(), {'nombre': 'Ana'})
+
+    def test_concurrent_duplicate_returns_the_committed_response(self):
+        self.send('hola', message_id='m1')
+        # Otro remitente confirmó el mismo message_id después de la lectura de este
+        committed = {'status': 'success', 'response': 'de otro worker'}
+        WebhookDelivery.objects.create(
+            team=self.team, flow=self.flow, sender_id='otro', external_id='m2', response=committed,
+        )
+        real_stored = dedup.stored_response
+        calls = []
+
+        def stored_response(team_id, external_id):
+            calls.append(external_id)
+            return None if len(calls) == 1 else real_stored(team_id, external_id)
+
+        with mock.patch.object(dedup, 'stored_response', side_effect=stored_response):
+            self.assertEqual(self.send('Ana', message_id='m2'), committed)
+        self.assertEqual(self.values(), {})
+        self.assertEqual(self.session().current_node_id, self.ask_name.id)
+
+    def test_purge_removes_old_delivery_records(self):
+        self.send('hola', message_id='m1')
+        self.send('Ana', message_id='m2')
+        WebhookDelivery.objects.filter(external_id='m1').update(created_at=timezone.now() - timedelta(days=30))
+
+        self.assertEqual(purge_webhook_deliveries(older_than_days=7, dry_run=True), 1)
+        self.assertEqual(purge_webhook_deliveries(older_than_days=0), 0)
+        self.assertEqual(purge_webhook_deliveries(older_than_days=7), 1)
+        self.assertEqual(list(WebhookDelivery.objects.values_list('external_id', flat=True)), ['m2'])
+
+
+class WebhookBatchTests(FlowFixtureMixin, TestCase):
+
+    def batch(self, messages):
+        response = self.post({'messages': messages}, 'batch/')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['results']
+
+    def test_processes_each_sender_in_order(self):
+        results = self.batch([
+            {'sender_id': 'a', 'message': 'hola'},
+            {'sender_id': 'b', 'message': 'hola'},
+            {'sender_id': 'a', 'message': 'Ana'},
+            {'message': 'sin remitente'},
+        ])
+        self.assertEqual(results[3], {'error': 'sender_id is required'})
+        self.assertEqual(self.values('a'), {'nombre': 'Ana'})
+        self.assertEqual(self.session('a').current_node_id, self.ask_color.id)
+        self.assertEqual(self.session('b').current_node_id, self.ask_name.id)
+
+    def test_failed_group_does_not_fail_the_batch(self):
+        from .services.unit_of_work import UnitOfWork
+
+        real_flush = UnitOfWork.flush
+        calls = []
+
+        def flush(uow):
+            calls.append(uow)
+            if len(calls) == 1:
+                raise DatabaseError('boom')
+            return real_flush(uow)
+
+        with mock.patch.object(UnitOfWork, 'flush', flush):
+            results = self.batch([
+                {'sender_id': 'a', 'message': 'hola', 'message_id': 'a1'},
+                {'sender_id': 'b', 'message': 'hola', 'message_id': 'b1'},
+            ])
+        self.assertEqual(results[0], {'error': 'boom'})
+        self.assertNotIn('error', results[1])
+        self.assertEqual(list(WebhookDelivery.objects.values_list('external_id', flat=True)), ['b1'])
+        self.assertFalse(Message.objects.filter(conversacion__sender_id='a').exists())
+        self.assertTrue(Message.objects.filter(conversacion__sender_id='b').exists())
+
+
+class AsyncQueueTests(FlowFixtureMixin, TestCase):
+
+    def test_async_mode_requires_webhook_token(self):
+        data = {'sender_id': '5215550000', 'message': 'hola'}
+        response = self.post(data, '?mode=async')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(InboundMessage.objects.exists())
+
+        response = self.post(data, f'?mode=async&token={self.flow.webhook_token}')
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(InboundMessage.objects.get().status, InboundStatus.PENDING)
+
+    def test_rejects_private_callback_urls(self):
+        for url in ('http://127.0.0.1:8000/hook', 'http://localhost/hook', 'http://169.254.169.254/latest', 'http://10.0.0.5/'):
+            with self.subTest(url=url), self.assertRaises(ValueError):
+                check_callback_url(self.flow, url)
+
+        response = self.post(
+            {'sender_id': '5215550000', 'message': 'hola', 'callback_url': 'http://127.0.0.1/hook'},
+            f'?mode=async&token={self.flow.webhook_token}',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(InboundMessage.objects.exists())
+
+    @override_settings(FLOWS_CALLBACK_ALLOW_PRIVATE=True)
+    def test_callback_host_allow_list(self):
+        self.flow.metadata = {'callback_hosts': ['hooks.example.com', '.example.org']}
+        check_callback_url(self.flow, 'https://hooks.example.com/cb')
+        check_callback_url(self.flow, 'https://api.example.org/cb')
+        with self.assertRaises(ValueError):
+            check_callback_url(self.flow, 'https://evil.example.net/cb')
+
+    def test_purge_removes_old_processed_messages(self):
+        old = timezone.now() - timedelta(days=30)
+        for status in (InboundStatus.DONE, InboundStatus.FAILED, InboundStatus.PENDING):
+            InboundMessage.objects.create(
+                flow=self.flow, team=self.team, sender_id='1', payload={}, status=status, processed_at=old,
+            )
+        InboundMessage.objects.create(
+            flow=self.flow, team=self.team, sender_id='1', payload={}, status=InboundStatus.DONE, processed_at=timezone.now(),
+        )
+
+        self.assertEqual(purge_inbound_messages(older_than_days=7, dry_run=True), 2)
+        self.assertEqual(purge_inbound_messages(older_than_days=7), 2)
+        self.assertEqual(InboundMessage.objects.count(), 2)
+        self.assertFalse(InboundMessage.objects.filter(status=InboundStatus.FAILED).exists())
+
+
+class TeamExtractorTests(SimpleTestCase):
+
+    def entity(self, id, type, options=None):
+        return SimpleNamespace(id=id, type=type, options=options or [], fuzzy_aliases=False)
+
+    def extract(self, entities, message, **kwargs):
+        return {entity.id: value for entity, value, _ in TeamExtractor(entities).extract(message, **kwargs)}
+
+    def test_each_match_fills_one_entity_in_order(self):
+        entities = [self.entity(1, 'PHONE'), self.entity(2, 'PHONE'), self.entity(3, 'EMAIL')]
+        self.assertEqual(self.extract(entities, 'mi cel 5512345678'), {1: '5512345678'})
+        self.assertEqual(
+            self.extract(entities, 'cel 5512345678, casa 5587654321, ana@example.com'),
+            {1: '5512345678', 2: '5587654321', 3: 'ana@example.com'},
+        )
+
+    def test_excluded_entities_leave_the_match_to_the_next_one(self):
+        entities = [self.entity(1, 'NUMBER'), self.entity(2, 'NUMBER')]
+        self.assertEqual(self.extract(entities, 'somos 4', exclude={1}), {2: '4'})
+        self.assertEqual(self.extract(entities, 'somos 4', exclude={1, 2}), {})
+
+    def test_whole_message_answer_is_not_extracted(self):
+        entities = [self.entity(1, 'NUMBER')]
+        self.assertEqual(self.extract(entities, '4', answer=True), {})
+        self.assertEqual(self.extract(entities, '4'), {1: '4'})
+
+
+class SegmentTests(FlowFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.edad = Entity.objects.create(team=self.team, name='Edad', slug='edad', type=EntityType.NUMBER)
+        for sender_id, edad, color in (('a', 20, 'Rojo'), ('b', 35, 'Azul'), ('c', 41, 'Rojo'), ('d', 50, None)):
+            EntityValue.objects.create(entity=self.edad, team=self.team, sender_id=sender_id, value={'processed': edad})
+            if color:
+                EntityValue.objects.create(entity=self.color, team=self.team, sender_id=sender_id, value={'processed': color})
+
+    def test_keyset_pages_cover_the_segment_once(self):
+        filters = [{'entity': 'edad', 'op': 'gte', 'value': 30}]
+        first = segment_page(self.team.id, filters, size=2)
+        self.assertEqual(first, {'results': ['b', 'c'], 'next': 'c'})
+        self.assertEqual(segment_page(self.team.id, filters, cursor=first['next'], size=2), {'results': ['d'], 'next': None})
+
+    def test_filters_are_combined_with_and(self):
+        filters = [{'entity': 'color', 'op': 'eq', 'value': 'rojo'}, {'entity': 'edad', 'op': 'lt', 'value': 30}]
+        self.assertEqual(segment_page(self.team.id, filters)['results'], ['a'])
+        filters = [{'entity': 'edad', 'op': 'exists'}, {'entity': 'color', 'op': 'missing'}]
+        self.assertEqual(segment_page(self.team.id, filters)['results'], ['d'])
+
+
+class SweeperTests(FlowFixtureMixin, TestCase):
+
+    def age(self, hours, sender_id='5215550000'):
+        ConversationSession.objects.filter(sender_id=sender_id).update(updated_at=timezone.now() - timedelta(hours=hours))
+
+    def test_finishes_sessions_past_the_flow_ttl(self):
+        self.send('hola')
+        self.age(100)
+        self.assertEqual(finish_stale_sessions(), {self.flow.id: 1})
+        session = self.session()
+        self.assertEqual(session.status, 'FINISHED')
+        self.assertIsNone(session.current_node_id)
+
+    def test_every_message_counts_as_activity(self):
+        self.send('hola')
+        self.send('Ana')
+        self.age(100)
+        # Opción no válida: no cambia el nodo ni las entidades
+        self.assertEqual(self.send('Verde')['status'], 'validation_error')
+        self.assertEqual(finish_stale_sessions(), {})
+        self.assertEqual(self.session().current_node_id, self.ask_color.id)
+
+
+class FlowDetailCacheTests(FlowFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        exports.clear_flow_detail_cache()
+
+    def test_etag_returns_not_modified(self):
+        response = self.client.get(self.url())
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(len(response.json()['nodes']), 4)
+
+        response = self.client.get(self.url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.ask_name.message_template = '¿Cuál es tu nombre completo?'
+        self.ask_name.save()
+        response = self.client.get(self.url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(FLOWS_EXPORT_CACHE_SIZE=2)
+    def test_cache_is_bounded(self):
+        flows = [self.flow] + [Flow.objects.create(team=self.team, name=f'Otro {i}') for i in range(3)]
+        for flow in flows:
+            exports.get_flow_detail(flow)
+        self.assertEqual([key[0] for key in exports._cache], [flows[2].id, flows[3].id])
+
+
+class InterceptTests(FlowFixtureMixin, TestCase):
+
+    def test_plain_node_title_is_an_ordinary_answer(self):
+        self.send('hola')
+        self.send('Pedir color')
+        self.assertEqual(self.values(), {'nombre': 'Pedir color'})
+
+    def test_marked_title_and_menu_keyword_jump_to_their_node(self):
+        menu = self.node(NodeType.QUESTION, 'Menú principal', 'Elige una opción')
+        self.node(NodeType.QUESTION, 'Hablar con un asesor', 'Te comunico', config={'intercept': True})
+        self.send('hola')
+
+        response = self.send('HABLAR con un asesor')
+        self.assertEqual(response['current_node']['title'], 'Hablar con un asesor')
+        response = self.send('menu principal')
+        self.assertEqual(response['current_node']['id'], menu.id)
+        self.assertEqual(self.values(), {})
+
+    def test_restart_keyword_clears_entities(self):
+        self.send('hola')
+        self.send('Ana')
+        response = self.send('Reiniciar historial')
+        self.assertEqual(response['status'], 'history_reset')
+        self.assertEqual(self.values(), {})
+        self.assertEqual(self.session().current_node_id, self.ask_name.id)
+
+
+class FlowProcessorTests(FlowFixtureMixin, TestCase):
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+
+        super().setUp()
+        self.user = get_user_model().objects.create(email='operador@example.com')
+
+    def process(self, message):
+        from rest_framework.test import APIRequestFactory, force_authenticate
+
+        request = APIRequestFactory().post(
+            '/', {'flow_id': self.flow.id, 'sender_id': '1', 'message': message}, format='json',
+        )
+        force_authenticate(request, user=self.user)
+        return FlowProcessorView.as_view()(request)
+
+    def test_deleted_current_node_is_not_an_error(self):
+        self.assertEqual(self.process('hola').data['next_node'], self.ask_name.id)
+        self.assertEqual(self.process('Ana').data['next_node'], self.ask_color.id)
+
+        self.ask_color.delete()
+        clear_flow_graph_cache()
+        response = self.process('Rojo')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'No current node'})
+
+
+class FlowGraphCacheTests(FlowFixtureMixin, TestCase):
+
+    def test_graph_is_compiled_once(self):
+        graph = get_flow_graph(self.flow)
+        with self.assertNumQueries(0):
+            self.assertIs(get_flow_graph(self.flow), graph)
+            node = graph.node(self.ask_color.id)
+            self.assertEqual(node.collect_entity.slug, 'color')
+            self.assertEqual([p.target_node_id for p in graph.node(self.ask_name.id).paths], [self.ask_color.id])
+        self.assertEqual(graph.start_node_id, self.start.id)
+
+    def test_edits_invalidate_the_live_graph(self):
+        graph = get_flow_graph(self.flow)
+        self.link(self.ask_name, self.end, condition=None, order=1)
+        edited = get_flow_graph(self.flow)
+        self.assertIsNot(edited, graph)
+        self.assertEqual(len(edited.node(self.ask_name.id).paths), 2)
+
+        self.color.options = [{'key': 'verde', 'label': 'Verde'}]
+        self.color.save()
+        self.assertEqual(get_flow_graph(self.flow).node(self.ask_color.id).collect_entity.options[0]['key'], 'verde')
+
+        self.team.flow_commands = {'restart': ['borrar todo']}
+        self.team.save()
+        self.assertEqual(get_flow_graph(self.flow).intercept('Borrar todo')[0], 'restart')
+
+    @override_settings(FLOWS_GRAPH_CACHE_SIZE=2)
+    def test_cache_is_bounded(self):
+        flows = [self.flow] + [Flow.objects.create(team=self.team, name=f'Otro {i}') for i in range(2)]
+        for flow in flows:
+            get_flow_graph(flow)
+        get_flow_graph(flows[1])
+        get_flow_graph(Flow.objects.create(team=self.team, name='Último'))
+        self.assertEqual(len(graph_cache._cache), 2)
+        self.assertIn(flows[1].id, [key[0] for key in graph_cache._cache])
+        self.assertNotIn(flows[2].id, [key[0] for key in graph_cache._cache])
+
+
+class ConditionTests(SimpleTestCase):
+
+    class Entities:
+        def __init__(self, values):
+            self.values = values
+
+        def has(self, entity_id):
+            return entity_id in self.values
+
+        def value(self, entity_id):
+            return self.values.get(entity_id)
+
+        def number(self, entity_id):
+            try:
+                return float(self.values[entity_id])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+    def evaluate(self, conditions, message='', logic='single', **values):
+        session = SimpleNamespace(entities=self.Entities({int(k[1:]): v for k, v in values.items()}))
+        condition = {'type': 'conditions', 'logic': logic, 'conditions': conditions}
+        return compile_condition(condition)(session, message)
+
+    def test_entity_conditions(self):
+        self.assertTrue(self.evaluate([{'type': 'entity_exists', 'entity_id': 1}], e1='x'))
+        self.assertFalse(self.evaluate([{'type': 'entity_exists', 'entity_id': 1}]))
+        self.assertTrue(self.evaluate([{'type': 'entity_equals', 'entity_id': 1, 'value': ' ROJO '}], e1='Rojo'))
+        self.assertTrue(self.evaluate([{'type': 'entity_contains', 'entity_id': 1, 'value': 'oj'}], e1='Rojo'))
+        self.assertTrue(self.evaluate([{'type': 'entity_greater', 'entity_id': 1, 'value': '18'}], e1='21'))
+        self.assertFalse(self.evaluate([{'type': 'entity_less', 'entity_id': 1, 'value': 18}], e1='21'))
+        self.assertTrue(self.evaluate([{'type': 'entity_is_any_of', 'entity_id': 1, 'values': ['Azul', 'rojo']}], e1='ROJO'))
+
+    def test_message_conditions(self):
+        self.assertTrue(self.evaluate([{'type': 'message_equals', 'value': 'Sí'}], ' sí '))
+        self.assertTrue(self.evaluate([{'type': 'message_starts_with', 'value': 'quiero'}], 'Quiero una cita'))
+        self.assertTrue(self.evaluate([{'type': 'message_ends_with', 'value': 'cita'}], 'Quiero una cita'))
+        self.assertTrue(self.evaluate([{'type': 'message_matches_regex', 'value': r'^\d{5}$'}], '12345'))
+        self.assertFalse(self.evaluate([{'type': 'message_matches_regex', 'value': '('}], '('))
+
+    def test_logic_and_invalid_conditions(self):
+        conditions = [{'type': 'message_contains', 'value': 'cita'}, {'type': 'entity_exists', 'entity_id': 1}]
+        self.assertFalse(self.evaluate(conditions, 'una cita'))
+        self.assertTrue(self.evaluate(conditions, 'una cita', logic='or'))
+        self.assertTrue(self.evaluate(conditions, 'una cita', e1='x'))
+        self.assertFalse(self.evaluate([{'type': 'desconocida'}], 'x'))
+        self.assertFalse(compile_condition(None)(SimpleNamespace(), 'x'))
+
+    def test_identical_conditions_share_the_compiled_function(self):
+        condition = {'type': 'conditions', 'conditions': [{'type': 'message_equals', 'value': 'si'}]}
+        self.assertIs(compile_condition(condition), compile_condition(json.loads(json.dumps(condition))))
+
+
+class ResolveParticipantsTests(FlowFixtureMixin, TestCase):
+
+    def sender(self, sender_id, **fields):
+        return dict({'sender_id': sender_id, 'platform': 'whatsapp', 'has_message': True}, **fields)
+
+    def resolve(self, *senders):
+        return resolve_participants(self.team, self.flow, self.start.id, list(senders))
+
+    def test_creates_and_reuses_participants(self):
+        from apps.leads.models import Lead
+
+        senders = [self.sender('1', sender_name='Ana'), self.sender('2'), self.sender('1', sender_phone='555')]
+        if supports_upsert(Lead):
+            # Lead, Conversacion y ConversationSession: una sentencia cada uno
+            with self.assertNumQueries(3):
+                first = self.resolve(*senders)
+        else:
+            first = self.resolve(*senders)
+        self.assertEqual(set(first), {'1', '2'})
+        lead, conversacion, session = first['1']
+        self.assertEqual((lead.nombre, lead.telefono), ('Ana', '555'))
+        self.assertEqual(session.current_node_id, self.start.id)
+        self.assertEqual(session.conversacion_id, conversacion.id)
+
+        again = self.resolve(self.sender(1, sender_name='Otro nombre', sender_email='ana@example.com'))['1']
+        self.assertEqual([obj.id for obj in again], [obj.id for obj in first['1']])
+        lead = Lead.objects.get(id=lead.id)
+        self.assertEqual((lead.nombre, lead.email), ('Ana', 'ana@example.com'))
+        self.assertEqual(Lead.objects.count(), 2)
+        self.assertEqual(ConversationSession.objects.count(), 2)
+
+
+class OptionMatcherTests(SimpleTestCase):
+
+    OPTIONS = [
+        {'key': 'limpieza', 'label': 'Limpieza dental', 'keywords': ['profilaxis']},
+        {'key': 'blanqueamiento', 'label': 'Blanqueamiento'},
+        {'key': 'ortodoncia', 'label': 'Ortodoncia', 'keywords': ['brackets']},
+    ]
+
+    def match(self, message, options=OPTIONS, fuzzy_aliases=None):
+        return OptionMatcher(options, fuzzy_aliases).match(message)[1]
+
+    def test_number_label_and_key(self):
+        self.assertEqual(self.match('2'), 1)
+        self.assertIsNone(self.match('7'))
+        self.assertEqual(self.match(' ORTODONCIA '), 2)
+        self.assertEqual(self.match('limpieza'), 0)
+
+    def test_containment_keywords_and_words(self):
+        self.assertEqual(self.match('quiero un blanqueamiento por favor'), 1)
+        self.assertEqual(self.match('blanq'), 1)
+        self.assertEqual(self.match('me pusieron brackets'), 2)
+        self.assertEqual(self.match('profilaxis'), 0)
+        self.assertEqual(self.match('algo dental'), 0)
+        self.assertIsNone(self.match('precio'))
+
+    def test_lowest_option_wins(self):
+        self.assertEqual(self.match('limpieza y ortodoncia'), 0)
+        self.assertEqual(self.match('ortodoncia y limpieza'), 0)
+
+
+class SenderLockTests(FlowFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        locks.stats.reset()
+
+    def hold(self, sender_id, seconds):
+        """Toma el lock del remitente en otro hilo (otra conexión) durante `seconds`"""
+        from django.db import connection
+
+        acquired = threading.Event()
+
+        def run():
+            try:
+                with sender_lock(self.team.id, sender_id):
+                    acquired.set()
+                    time.sleep(seconds)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        acquired.wait(2)
+        return thread
+
+    def test_same_sender_is_serialized(self):
+        events = []
+
+        def work(name):
+            with sender_lock(self.team.id, '1'):
+                events.append(f'{name}:in')
+                time.sleep(0.05)
+                events.append(f'{name}:out')
+
+        threads = [threading.Thread(target=work, args=(name,)) for name in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([e.split(':')[1] for e in events], ['in', 'out', 'in', 'out'])
+        self.assertEqual(locks.stats.snapshot()['acquired'], 2)
+        self.assertEqual(locks._local_locks, {})
+
+    def test_timeout_raises_and_other_senders_proceed(self):
+        thread = self.hold('1', 0.3)
+        with self.assertRaises(SenderLockTimeout):
+            with sender_lock(self.team.id, '1', timeout=0.05):
+                pass
+        with sender_lock(self.team.id, '2', timeout=0.05):
+            pass
+        thread.join()
+        self.assertEqual(locks.stats.snapshot()['timeouts'], 1)
+
+    @override_settings(FLOWS_SENDER_LOCK_TIMEOUT=0.05)
+    def test_busy_sender_gets_retry_after(self):
+        thread = self.hold('5215550000', 0.3)
+        response = self.post({'sender_id': '5215550000', 'message': 'hola'})
+        thread.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(ConversationSession.objects.exists())
+        self.send('hola')
+        self.assertTrue(ConversationSession.objects.exists())
+
+
+class FlowVersionTests(FlowFixtureMixin, TestCase):
+
+    def test_sessions_stay_on_their_published_version(self):
+        v1 = publish_flow(self.flow)
+        self.send('hola')
+        self.assertEqual(self.session().flow_version_id, v1.id)
+
+        self.ask_color.message_template = '{nombre}, elige un color'
+        self.ask_color.save()
+        self.flow.refresh_from_db()
+        v2 = publish_flow(self.flow)
+
+        self.assertTrue(self.send('Ana')['response'].startswith('Hola Ana, ¿qué color?'))
+        self.assertEqual(self.session().flow_version_id, v1.id)
+
+        self.send('hola', sender_id='otro')
+        self.assertTrue(self.send('Luis', sender_id='otro')['response'].startswith('Luis, elige un color'))
+        self.assertEqual(self.session('otro').flow_version_id, v2.id)
+
+        self.send('reiniciar historial')
+        self.assertEqual(self.session().flow_version_id, v2.id)
+
+    def test_deleted_node_still_works_for_pinned_sessions(self):
+        publish_flow(self.flow)
+        self.send('hola')
+        self.send('Ana')
+        self.ask_color.delete()
+        self.send('Rojo')
+        self.assertEqual(self.values(), {'nombre': 'Ana', 'color': 'Rojo'})
+        self.assertEqual(self.session().current_node_id, self.end.id)
+
+    def test_versions_are_scoped_to_their_flow(self):
+        version = publish_flow(self.flow)
+        other = Flow.objects.create(team=self.team, name='Otro')
+        with self.assertRaises(FlowVersion.DoesNotExist):
+            get_flow_graph(other, version_id=version.id)
+
+
+class TimerTests(FlowFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.delay = self.node(NodeType.DELAY, 'Esperar', '', config={'minutes': 5})
+        Path.objects.filter(node=self.ask_name).update(target_node=self.delay)
+        self.link(self.delay, self.ask_color)
+        self.send('hola')
+        self.send('Ana')
+        self.timer = FlowTimer.objects.get()
+
+    def make_due(self):
+        FlowTimer.objects.filter(pk=self.timer.pk).update(due_at=timezone.now() - timedelta(seconds=1))
+
+    def test_delay_seconds(self):
+        self.assertEqual(delay_seconds({'minutes': 1, 'seconds': 30}), 90)
+        self.assertEqual(delay_seconds({'hours': 'x', 'days': 1}), 86400)
+        self.assertEqual(delay_seconds(None), 0)
+
+    def test_due_timer_resumes_the_session(self):
+        self.assertEqual(self.session().current_node_id, self.delay.id)
+        self.assertEqual(claim_due(10), [])
+
+        self.make_due()
+        timers = claim_due(10)
+        self.assertEqual([t.id for t in timers], [self.timer.id])
+        self.assertEqual(claim_due(10), [])
+        self.assertEqual(fire_timers(timers), 1)
+
+        self.assertEqual(FlowTimer.objects.get().status, 'FIRED')
+        self.assertEqual(self.session().current_node_id, self.ask_color.id)
+        followup = Message.objects.filter(metadata__source='timer').get()
+        self.assertTrue(followup.content.startswith('Hola Ana, ¿qué color?'))
+
+    def test_reply_before_due_cancels_the_timer(self):
+        # El usuario escribe antes de vencer: la sesión sale del DELAY
+        self.send('Rojo')
+        self.make_due()
+        fire_timers(claim_due(10))
+        self.assertEqual(FlowTimer.objects.get().status, 'CANCELLED')
+        self.assertFalse(Message.objects.filter(metadata__source='timer').exists())
+
+    @override_settings(FLOWS_TIMER_STALE_SECONDS=60)
+    def test_stale_processing_timer_is_reclaimed(self):
+        self.make_due()
+        claim_due(10)
+        self.assertEqual(claim_due(10), [])
+        FlowTimer.objects.update(claimed_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual([t.id for t in claim_due(10)], [self.timer.id])
+
+
+class ScriptSandboxTests(SimpleTestCase):
+
+    def run_script(self, source, **variables):
+        return CompiledScript(source).evaluate(variables)
+
+    def test_evaluates_assignments_in_order(self):
+        result = self.run_script(
+            "total = precio * cantidad\n"
+            "descuento = total * 0.1 if total > 100 else 0\n"
+            "resumen = concat(upper(nombre), ': ', round(total - descuento, 2))\n"
+            "entrega = format_date(date_add('2026-01-30', 3))",
+            precio='60', cantidad=2, nombre='ana',
+        )
+        self.assertEqual(result, {
+            'total': 120, 'descuento': 12, 'resumen': 'ANA: 108.0', 'entrega': '02/02/2026',
+        })
+        self.assertEqual(CompiledScript('a = b + 1\nc = a + d').inputs, {'b', 'd'})
+
+    def test_rejects_unsupported_syntax(self):
+        for source in (
+            "x = ().__class__",
+            "import os",
+            "x = open('/etc/passwd')",
+            "x = (lambda: 1)()",
+            "x = [1][0]",
+            "x = round(1, ndigits=2)",
+            "x.y = 1",
+            "x = ",
+            "x = " + "(" * 500 + "1" + ")" * 500,
+            "\n".join(f"x{i} = {i}" for i in range(60)),
+        ):
+            with self.subTest(source=source[:40]), self.assertRaises(ScriptError):
+                self.run_script(source)
+
+    def test_step_and_time_budgets(self):
+        script = CompiledScript("x = " + " + ".join(['1'] * 50))
+        with self.assertRaises(ScriptBudgetExceeded):
+            script.evaluate({}, max_steps=10)
+        self.assertEqual(script.evaluate({}, max_steps=100), {'x': 50})
+        with self.assertRaises(ScriptBudgetExceeded):
+            script.evaluate({}, timeout=-1)
+
+    def test_value_limits(self):
+        for source in (
+            "x = 10 ** 200",
+            "x = 2 ** 99 * 2 ** 99 * 2 ** 99",
+            "x = 'a' * 100000",
+            "x = s + s",
+            "x = round(1.5, 10 ** 9)",
+            "x = n - 1",
+        ):
+            with self.subTest(source=source), self.assertRaises(ScriptError):
+                self.run_script(source, s='a' * 6000, n='9' * 5000)
+        with self.assertRaises(ScriptError):
+            self.run_script("x = y + 1")
+        with self.assertRaises(ZeroDivisionError):
+            self.run_script("x = 1 / 0")
+
+
+class FuzzyOptionTests(SimpleTestCase):
+
+    OPTIONS = OptionMatcherTests.OPTIONS + [{'key': 'vasectomia', 'label': 'Vasectomía'}]
+
+    def match(self, message, fuzzy_aliases=None):
+        return OptionMatcher(self.OPTIONS, fuzzy_aliases).match(message)[1]
+
+    def test_misspelled_options(self):
+        self.assertEqual(self.match('vasectomia'), 3)
+        self.assertEqual(self.match('blanquamiento'), 1)
+        self.assertEqual(self.match('quiero ortodonsia por favor'), 2)
+        self.assertIsNone(self.match('cirugía'))
+
+    def test_fuzzy_aliases(self):
+        self.assertIsNone(self.match('frenos'))
+        self.assertEqual(self.match('frenos', {'ortodoncia': ['frenos']}), 2)
+        self.assertEqual(self.match('frenoz', [{'key': 'ortodoncia', 'aliases': ['frenos']}]), 2)
+
+    @override_settings(FLOWS_FUZZY_MAX_RATIO=0)
+    def test_ratio_zero_disables_fuzzy_matching(self):
+        self.assertIsNone(self.match('blanquamiento'))
+
+    def test_edit_distance_matches_levenshtein(self):
+        def levenshtein(a, b):
+            row = list(range(len(b) + 1))
+            for i, x in enumerate(a, 1):
+                prev, row[0] = row[0], i
+                for j, y in enumerate(b, 1):
+                    prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (x != y))
+            return row[-1]
+
+        for a, b in (('', 'abc'), ('kitten', 'sitting'), ('ortodoncia', 'ortodonsia'), ('abc', 'abc'), ('flaw', 'lawn')):
+            with self.subTest(a=a, b=b):
+                self.assertEqual(edit_distance(a, b), levenshtein(a, b))
+
+
+class DateEntityTests(FlowFixtureMixin, TestCase):
+
+    def test_date_iso(self):
+        self.assertTrue(date_iso('2025-06-30').startswith('2025-06-30'))
+        self.assertEqual(date_iso('2025-06-30T17:00:00-06:00'), '2025-06-30T17:00:00-06:00')
+        self.assertTrue(date_iso('30/06/2025').startswith('2025-06-30'))
+        self.assertTrue(date_iso('el 5 de julio de 2027').startswith('2027-07-05'))
+        self.assertIsNone(date_iso('hola'))
+        self.assertIsNone(date_iso(''))
+
+        text = SimpleNamespace(type='TEXT')
+        self.assertEqual(with_date_iso(text, {'raw': '30/06/2025'}), {'raw': '30/06/2025'})
+
+    def test_captured_date_is_typed_and_queryable(self):
+        fecha = Entity.objects.create(team=self.team, name='Fecha', slug='fecha', type=EntityType.DATE)
+        Node.objects.filter(pk=self.ask_name.pk).update(collect_entity=fecha)
+        clear_flow_graph_cache()
+        self.send('hola')
+        self.send('30/06/2025')
+
+        stored = EntityValue.objects.get(entity=fecha)
+        self.assertEqual(stored.value['processed'], '30/06/2025')
+        self.assertTrue(stored.value['iso'].startswith('2025-06-30'))
+        self.assertEqual(stored.value_date.date().isoformat(), '2025-06-30')
+
+        before = [{'entity': 'fecha', 'op': 'before', 'value': '2025-07-01'}]
+        after = [{'entity': 'fecha', 'op': 'after', 'value': '2025-07-01'}]
+        self.assertEqual(segment_page(self.team.id, before)['results'], ['5215550000'])
+        self.assertEqual(segment_page(self.team.id, after)['results'], [])
+
+        session = self.session()
+        condition = {'type': 'conditions', 'conditions': [{'type': 'entity_less', 'entity_id': fecha.id, 'value': 'today'}]}
+        self.assertTrue(compile_condition(condition)(session, ''))
+
+
+class FunnelTests(FlowFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        analytics.counters.reset()
+
+    def step(self, message, sender_id='5215550000'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.send(message, sender_id=sender_id)
+
+    def node_stats(self):
+        analytics.counters.flush()
+        return {n['node_id']: n for n in analytics.funnel(self.flow)['nodes']}
+
+    def test_dwell_bins(self):
+        self.assertEqual(analytics.dwell_bin(None), analytics.NO_DWELL)
+        self.assertEqual(analytics.dwell_bin(0.5), 0)
+        self.assertEqual(analytics.dwell_bin(1), 1)
+        self.assertEqual(analytics.dwell_bin(10 * 86400), len(analytics.DWELL_BINS))
+
+    def test_counts_entries_exits_and_drops(self):
+        self.step('hola', 'a')
+        self.step('Ana', 'a')
+        self.step('hola', 'b')
+
+        stats = self.node_stats()
+        ask_name = stats[self.ask_name.id]
+        self.assertEqual((ask_name['entered'], ask_name['exited'], ask_name['dropped']), (2, 1, 1))
+        self.assertEqual(ask_name['paths'], [{'path_id': self.ask_name.paths.get().id, 'label': '->', 'exited': 1}])
+        self.assertIsNotNone(ask_name['avg_seconds'])
+        self.assertEqual(stats[self.ask_color.id]['entered'], 1)
+
+    def test_rolled_back_step_is_not_counted(self):
+        self.step('hola')
+        with mock.patch('apps.flows.services.unit_of_work.UnitOfWork.flush', side_effect=DatabaseError('boom')):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.post({'sender_id': '5215550000', 'message': 'Ana'})
+        self.assertNotIn(self.ask_color.id, self.node_stats())
+
+    def test_failed_flush_keeps_the_counters(self):
+        self.step('hola')
+        pending = analytics.counters.pending()
+        self.assertGreater(pending, 0)
+        with mock.patch('apps.flows.services.analytics._write', side_effect=DatabaseError('down')):
+            self.assertEqual(analytics.counters.flush(), 0)
+        self.assertEqual(analytics.counters.pending(), pending)
+        self.assertEqual(analytics.counters.flush(), pending)
+
+
+class GraphIOTests(FlowFixtureMixin, TestCase):
+
+    def graph(self):
+        return {
+            'nodes': [{'id': n.id} for n in (self.start, self.ask_name, self.ask_color, self.end)],
+            'paths': [{'id': p.id} for p in Path.objects.filter(node__flow=self.flow)],
+        }
+
+    def test_save_graph_creates_updates_and_deletes(self):
+        graph = self.graph()
+        graph['nodes'] = [n for n in graph['nodes'] if n['id'] != self.end.id]
+        graph['nodes'][1]['title'] = 'Nombre'
+        graph['nodes'].append({'id': 'tmp-1', 'type': NodeType.END, 'title': 'Adiós', 'collect_entity': 'tmp-e'})
+        graph['paths'] = [p for p in graph['paths'] if p['id'] != self.ask_color.paths.get().id]
+        graph['paths'].append({'id': 'tmp-p', 'node': self.ask_color.id, 'target_node': 'tmp-1', 'label': 'fin'})
+        graph['entities'] = [{'id': 'tmp-e', 'name': 'Comentario', 'type': EntityType.TEXT}]
+
+        result = save_graph(self.flow, graph)
+
+        self.assertEqual(result['created'], {'nodes': 1, 'paths': 1, 'entities': 1})
+        self.assertEqual(result['updated']['nodes'], 1)
+        self.assertEqual(result['deleted'], {'nodes': 1, 'paths': 1})
+        new_node = Node.objects.get(pk=result['id_map']['nodes']['tmp-1'])
+        self.assertEqual(new_node.collect_entity.slug, 'comentario')
+        self.assertEqual(self.ask_color.paths.get().target_node, new_node)
+        self.assertEqual(Node.objects.get(pk=self.ask_name.pk).title, 'Nombre')
+        self.assertFalse(Node.objects.filter(pk=self.end.pk).exists())
+        # bulk_create/bulk_update no emiten señales: el grafo en caché se invalida a mano
+        self.assertEqual(get_flow_graph(self.flow).node(self.ask_color.id).paths[0].target_node_id, new_node.id)
+
+    def test_invalid_graphs_change_nothing(self):
+        other_flow = Flow.objects.create(team=self.team, name='Otro')
+        foreign_node = Node.objects.create(flow=other_flow, type=NodeType.START, title='Ajeno')
+        foreign_entity = Entity.objects.create(
+            team=Team.objects.create(name='Otro team'), name='Ajena', slug='ajena', type=EntityType.TEXT,
+        )
+        cases = {
+            'unknown target': {'paths': [{'id': 'x', 'node': self.start.id, 'target_node': 'nope'}]},
+            'foreign node': {'nodes': [{'id': foreign_node.id}]},
+            'duplicated id': {'nodes': [{'id': 'a', 'type': NodeType.END, 'title': 'A'}] * 2},
+            'invalid type': {'nodes': [{'id': 'a', 'type': 'NOPE', 'title': 'A'}]},
+            'foreign entity': {'nodes': [{'id': 'a', 'type': NodeType.END, 'title': 'A', 'collect_entity': foreign_entity.id}]},
+            'bad id': {'nodes': [{'id': True, 'type': NodeType.END, 'title': 'A'}]},
+            'not a list': {'nodes': {'id': 1}},
+        }
+        for name, changes in cases.items():
+            graph = self.graph()
+            for key, items in changes.items():
+                graph[key] = items if not isinstance(items, list) else graph.get(key, []) + items
+            with self.subTest(name), self.assertRaises(GraphError):
+                save_graph(self.flow, graph)
+        self.assertEqual(Node.objects.filter(flow=self.flow).count(), 4)
+        self.assertEqual(Path.objects.filter(node__flow=self.flow).count(), 3)
+
+    def test_export_import_and_clone(self):
+        data = json.loads(json.dumps(export_flow(self.flow)))
+        other_team = Team.objects.create(name='Importador')
+        imported, result = import_flow(other_team, data)
+        self.assertEqual(result['created'], {'nodes': 4, 'paths': 3, 'entities': 2})
+        self.assertEqual(set(Entity.objects.filter(team=other_team).values_list('slug', flat=True)), {'nombre', 'color'})
+
+        clone, result = clone_flow(self.flow)
+        self.assertEqual(clone.name, 'Flujo (copia)')
+        self.assertEqual(result['created']['entities'], 0)
+        graph = get_flow_graph(clone)
+        color_node = next(n for n in graph.nodes if n.title == 'Pedir color')
+        self.assertEqual(color_node.collect_entity.id, self.color.id)
+        self.assertEqual(graph.node(graph.start_node_id).title, 'Inicio')
+
+        for bad in ({}, dict(data, format_version=99), dict(data, flow={'metadata': []})):
+            with self.assertRaises(GraphError):
+                import_flow(other_team, bad)
@@ -1,5 +1,5 @@
 from rest_framework import viewsets
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 import random
 import string
 from rest_framework.response import Response
@@ -12,17 +12,17 @@ from django.views import View
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from apps.teams.models import Team
-from apps.leads.models import Lead
 from apps.conversaciones.models import Conversacion, Message, MessageDirection
 import json
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
 from django.utils import timezone
-import unicodedata
-
-def normalize(text):
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', text)
-        if unicodedata.category(c) != 'Mn'
-    ).lower().strip()
+from .services.analytics import counters as funnel_counters
+from .services.commands import COMMAND_NODE, COMMAND_RESTART
+from .services.entities import with_date_iso
+from .services.extraction import auto_extract
+from .services.locks import SenderLockTimeout
+from .services.runtime import enter_node
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -34,8 +34,8 @@ class FlowWebhookView(View):
     
     def post(self, request, team_slug, flow_slug):
         try:
-            from .models import Flow, ConversationSession, EntityValue
-            
+            from .models import Flow
+
             # Obtener team y flow
             team = get_object_or_404(Team, slug=team_slug)
             flow = get_object_or_404(Flow, slug=flow_slug, team=team, is_active=True)
@@ -46,109 +46,175 @@ class FlowWebhookView(View):
             except json.JSONDecodeError:
                 return JsonResponse({'error': 'Invalid JSON'}, status=400)
             
-            # Extraer datos requeridos
-            sender_id = data.get('sender_id')
-            message = data.get('message', '')
-            platform = data.get('platform', 'unknown')
-            sender_name = data.get('sender_name', '')
-            sender_phone = data.get('sender_phone', '')
-            sender_email = data.get('sender_email', '')
-            
-            if not sender_id:
+            if not data.get('sender_id'):
                 return JsonResponse({'error': 'sender_id is required'}, status=400)
             
-            # Obtener o crear Lead
-            lead, lead_created = Lead.objects.get_or_create(
-                plataforma=platform,
-                plataforma_id=sender_id,
-                defaults={
-                    'nombre': sender_name,
-                    'telefono': sender_phone,
-                    'email': sender_email,
-                    'fuente': 'mensaje_directo',
-                    'asignado_a': team,
-                }
-            )
-            
-            # Si el lead existe, actualizar información si viene nueva
-            if not lead_created:
-                updated = False
-                if sender_name and not lead.nombre:
-                    lead.nombre = sender_name
-                    updated = True
-                if sender_phone and not lead.telefono:
-                    lead.telefono = sender_phone
-                    updated = True
-                if sender_email and not lead.email:
-                    lead.email = sender_email
-                    updated = True
-                if updated:
-                    lead.save()
-            
-            # Obtener o crear sesión de conversación
-            session, session_created = ConversationSession.objects.get_or_create(
-                sender_id=sender_id,
-                flow=flow,
-                team=team,
-                defaults={
-                    'current_node': flow.start_node,
-                    'lead': lead,
-                    'platform': platform,
-                    'platform_data': data.get('platform_data', {}),
-                }
-            )
-            
-            # Obtener o crear conversación
-            if not session.conversacion:
-                from apps.conversaciones.utils import get_or_create_conversation
-                conversacion, _ = get_or_create_conversation(
-                    sender_id=sender_id,
-                    team=team,
-                    platform=platform,
-                    lead=lead
-                )
-                session.conversacion = conversacion
-                session.save()
-            else:
-                conversacion = session.conversacion
-            
-            
-            # Después de obtener/crear session y conversacion
-            if message:  # Solo si hay mensaje del usuario
-                from apps.conversaciones.models import MessageDirection, MessageType
-                
-                Message.objects.create(
-                    conversacion=conversacion,
-                    direction=MessageDirection.INBOUND,  # Mensaje entrante
-                    type=MessageType.TEXT,
-                    content=message,
-                    sender_name=sender_name,
-                    metadata={
-                        'platform': platform,
-                        'is_automated': False,
-                        'source': 'webhook',
-                    },
-                    external_id=data.get('message_id'),  # Si viene un ID externo
-                )
-                
-                # Actualizar timestamp de la conversación
-                conversacion.last_message_at = timezone.now()
-                conversacion.save(update_fields=['last_message_at'])
-
-            # AHORA SÍ procesar el flujo
-            response_data = self._process_flow_message(session, message, data)
-
-            # Actualizar timestamps
-            lead.ultima_interaccion = timezone.now()
-            lead.save()
-            conversacion.fecha_actualizacion = timezone.now()
-            conversacion.save()
+            # Modo asíncrono (opt-in): se encola el payload y se responde de inmediato.
+            # Requiere el webhook_token: encolar guarda un callback_url que el worker llamará
+            if self._is_async(request, flow):
+                if not _has_webhook_token(request, flow):
+                    return JsonResponse({'error': 'invalid webhook token'}, status=403)
+                from .services.inbound import enqueue_message
+                try:
+                    inbound = enqueue_message(team, flow, data)
+                except ValueError as e:
+                    return JsonResponse({'error': str(e)}, status=400)
+                return JsonResponse({
+                    'status': 'queued',
+                    'message_id': inbound.id,
+                    'poll_url': f"{flow.webhook_url}messages/{inbound.id}/",
+                }, status=202)
             
-            return JsonResponse(response_data)
+            try:
+                return JsonResponse(self.handle_payload(team, flow, data))
+            except SenderLockTimeout as e:
+                return self._busy_response(e)
             
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
     
+    def _busy_response(self, error):
+        """Otro worker sigue procesando a este remitente: que la plataforma reintente"""
+        response = JsonResponse({'error': str(error)}, status=503)
+        response['Retry-After'] = '1'
+        return response
+    
+    def _is_async(self, request, flow):
+        """?mode=async en la URL o metadata {"webhook_mode": "async"} en el flujo"""
+        if request.GET.get('mode') == 'async':
+            return True
+        return isinstance(flow.metadata, dict) and flow.metadata.get('webhook_mode') == 'async'
+    
+    def handle_payload(self, team, flow, data):
+        """
+        Procesa un payload del webhook (ya validado, con sender_id) y retorna
+        el diccionario de respuesta. Lo usan la vista y el worker de la cola.
+        """
+        from .services.dedup import cached_response, stored_response
+        from .services.graph import get_flow_graph
+        from .services.locks import sender_lock
+
+        # Reintento de la plataforma ya visto por este proceso
+        external_id = data.get('message_id')
+        if external_id:
+            cached = cached_response(team.id, external_id)
+            if cached is not None:
+                return cached
+        
+        graph = get_flow_graph(flow)
+        sender = self._sender_data(data)
+        message = data.get('message', '')
+        
+        # Un solo request a la vez por remitente: desde leer el estado de la
+        # sesión (upsert) hasta confirmar la transacción del paso
+        with sender_lock(team.id, sender['sender_id']):
+            try:
+                response_data = self._process_payload(team, flow, graph, sender, message, data)
+            except IntegrityError:
+                # Otro remitente con el mismo message_id confirmó primero
+                stored = stored_response(team.id, external_id) if external_id else None
+                if stored is None:
+                    raise
+                return stored
+        funnel_counters.maybe_flush()
+        return response_data
+    
+    def _process_payload(self, team, flow, graph, sender, message, data):
+        """Paso del flujo de un payload, ya con el lock del remitente"""
+        from .services.dedup import delivery_record, remember_on_commit, stored_response
+        from .services.upserts import resolve_participants
+        from .services.unit_of_work import UnitOfWork
+
+        external_id = data.get('message_id')
+        # Todo el paso en una transacción: entidades, temporizadores,
+        # estado, mensajes y registro del reintento se confirman juntos
+        with transaction.atomic():
+            # Reintento ya procesado (por cualquier worker): respuesta original
+            if external_id:
+                stored = stored_response(team.id, external_id)
+                if stored is not None:
+                    return stored
+            
+            # Obtener o crear Lead, sesión y conversación (3 sentencias INSERT ... ON CONFLICT)
+            lead, conversacion, session = resolve_participants(
+                team, flow, graph.start_node_id, [sender]
+            )[sender['sender_id']]
+        
+            # AHORA SÍ procesar el flujo; lead, conversación y sesión se
+            # guardan una sola vez al final con los campos que cambiaron
+            uow = UnitOfWork()
+            uow.track(lead, conversacion, session)
+        
+            # Mensaje entrante, mensajes del flujo y respuesta del bot se
+            # insertan juntos en el flush
+            # (last_message_at y ultima_interaccion ya se actualizaron en el upsert)
+            if message:  # Solo si hay mensaje del usuario
+                uow.add(self._inbound_message(conversacion, data))
+            outbox = []
+            response_data = self._process_flow_message(session, message, data, outbox)
+            uow.add(*outbox)
+            uow.add(self._outbound_message(session, response_data))
+            # El registro del reintento se confirma junto con el paso del flujo
+            if external_id:
+                uow.add(delivery_record(team.id, flow.id, sender['sender_id'], external_id, response_data))
+            uow.flush()
+        
+            if external_id:
+                remember_on_commit(team.id, [(external_id, response_data)])
+        return response_data
+    
+    def _sender_data(self, data):
+        """Datos del remitente de un payload, en el formato de resolve_participants"""
+        return {
+            'sender_id': str(data.get('sender_id')),
+            'platform': data.get('platform', 'unknown'),
+            'sender_name': data.get('sender_name', ''),
+            'sender_phone': data.get('sender_phone', ''),
+            'sender_email': data.get('sender_email', ''),
+            'platform_data': data.get('platform_data', {}),
+            'has_message': bool(data.get('message', '')),
+        }
+    
+    def _inbound_message(self, conversacion, data):
+        """Message entrante (sin guardar) para el texto de un payload"""
+        from apps.conversaciones.models import MessageType
+        
+        return Message(
+            conversacion=conversacion,
+            direction=MessageDirection.INBOUND,  # Mensaje entrante
+            type=MessageType.TEXT,
+            content=data.get('message', ''),
+            sender_name=data.get('sender_name', ''),
+            metadata={
+                'platform': data.get('platform', 'unknown'),
+                'is_automated': False,
+                'source': 'webhook',
+            },
+            external_id=data.get('message_id'),  # Si viene un ID externo
+        )
+    
+    def _outbound_message(self, session, response_data):
+        """Message saliente (sin guardar) con la respuesta del bot, si la hay"""
+        from apps.conversaciones.models import MessageType
+        
+        content = response_data.get('response')
+        if not content:
+            return None
+        node = response_data.get('next_node') or response_data.get('current_node') or {}
+        return Message(
+            conversacion=session.conversacion,
+            direction=MessageDirection.OUTBOUND,
+            type=MessageType.TEXT,
+            content=content,
+            metadata={
+                'platform': session.platform,
+                'is_automated': True,
+                'source': 'flow',
+                'status': response_data.get('status'),
+                'node_id': node.get('id'),
+            },
+        )
+    
     def _match_multiple_choice_option(self, message, entity):
         """
         Intenta hacer match del mensaje del usuario con una opción de multiple choice
@@ -158,89 +224,53 @@ class FlowWebhookView(View):
         if not entity.options:
             return None, None
         
-        message_lower = message.strip().lower()
-        
-        # 1. Intentar match por número (1, 2, 3, etc.)
-        if message_lower.isdigit():
-            index = int(message_lower) - 1  # Convertir a índice base-0
-            if 0 <= index < len(entity.options):
-                return entity.options[index], index
-        
-        # 2. Intentar match usando las opciones
-        for idx, option in enumerate(entity.options):
-            # Obtener label y keywords
-            label = option.get('label', '').lower()
-            key = option.get('key', '').lower()
-            keywords = option.get('keywords', [])
-            
-            # Match exacto con label
-            if message_lower == label:
-                return option, idx
-            
-            # Match exacto con key
-            if message_lower == key:
-                return option, idx
-            
-            # Match si el mensaje contiene el label completo
-            if label and label in message_lower:
-                return option, idx
-            
-            # Match si el label contiene el mensaje (para respuestas cortas)
-            if label and message_lower in label and len(message_lower) >= 3:
-                return option, idx
-            
-            # Match por keywords
-            if keywords:
-                for keyword in keywords:
-                    keyword_lower = str(keyword).lower()
-                    if keyword_lower == message_lower:
-                        return option, idx
-                    if keyword_lower in message_lower or message_lower in keyword_lower:
-                        return option, idx
-            
-            # Match por palabras individuales en label (mínimo 3 caracteres)
-            if label:
-                label_words = set(word for word in label.split() if len(word) >= 3)
-                message_words = set(word for word in message_lower.split() if len(word) >= 3)
-                
-                # Si hay coincidencia de palabras significativas
-                if label_words and message_words:
-                    common_words = label_words & message_words
-                    if common_words:
-                        return option, idx
-        
-        return None, None
+        # Las entidades del grafo compilado traen el índice de opciones ya construido
+        matcher = getattr(entity, 'option_matcher', None)
+        if matcher is None:
+            from .services.options import OptionMatcher
+            matcher = OptionMatcher(entity.options, getattr(entity, 'fuzzy_aliases', None))
+        return matcher.match(message)
     
-    def _process_flow_message(self, session, message, original_data):
-        """Procesa un mensaje en el contexto del flujo"""
-        from .models import Node, EntityValue
+    def _process_flow_message(self, session, message, original_data, outbox=None):
+        """
+        Procesa un mensaje en el contexto del flujo. Los Message que genere
+        se agregan a `outbox` (si se recibe) para insertarlos en bloque.
+        """
+        from .models import EntityValue
         
-        current_node = session.current_node
+        # Todo mensaje cuenta como actividad para el TTL del sweeper, aunque
+        # no cambie ningún otro campo (p. ej. una opción no válida)
+        session.updated_at = timezone.now()
+        
+        graph = session.flow_graph
+        current_node = graph.node(session.current_node_id) if session.current_node_id else None
         
         # Si no hay nodo actual, reiniciar automáticamente
         if not current_node:
-            # Reiniciar sesión automáticamente
+            # Reiniciar sesión automáticamente, ya en la versión publicada actual
+            session.pin_flow_version()
+            graph = session.flow_graph
             EntityValue.objects.filter(
-                team=session.team,
+                team_id=session.team_id,
                 sender_id=session.sender_id
             ).delete()
+            session.entities.clear()
             
             session.context = {'collected_entities': {}}
-            session.current_node = session.flow.start_node
-            session.save()
+            session.reactivate()
+            session.set_current_node(graph.start_node)
             
             # Avanzar al siguiente nodo
             next_node = session.get_next_node("")
             if next_node:
-                session.current_node = next_node
-                session.save()
+                next_node = enter_node(session, next_node)
                 response_message = self._prepare_response_message(next_node, session)
                 
                 return {
                     'status': 'auto_restarted',
                     'session_id': session.id,
-                    'lead_id': session.lead.id,
-                    'conversation_id': session.conversacion.id,
+                    'lead_id': session.lead_id,
+                    'conversation_id': session.conversacion_id,
                     'current_node': {
                         'id': next_node.id,
                         'title': next_node.title,
@@ -253,22 +283,21 @@ class FlowWebhookView(View):
                 return {
                     'error': 'No se pudo reiniciar el flujo',
                     'session_id': session.id,
-                    'lead_id': session.lead.id,
-                    'conversation_id': session.conversacion.id,
+                    'lead_id': session.lead_id,
+                    'conversation_id': session.conversacion_id,
                 }
         
-        # --- Interceptar mensaje que coincida exactamente con título de nodo ---
-        try:
-            matching_node = Node.objects.get(flow=session.flow, title=message.strip())
-            session.current_node = matching_node
-            session.save()
+        # --- Interceptar comandos del team y títulos de nodo marcados (una búsqueda en el grafo) ---
+        command, matching_node = graph.intercept(message) or (None, None)
+        if command == COMMAND_NODE and matching_node:
+            matching_node = enter_node(session, matching_node, skip_known=False)
             
             response_message = self._prepare_response_message(matching_node, session)
             return {
                 'status': 'success',
                 'session_id': session.id,
-                'lead_id': session.lead.id,
-                'conversation_id': session.conversacion.id,
+                'lead_id': session.lead_id,
+                'conversation_id': session.conversacion_id,
                 'current_node': {
                     'id': matching_node.id,
                     'title': matching_node.title,
@@ -286,51 +315,17 @@ class FlowWebhookView(View):
                 'flow_completed': False,
                 'context': session.context,
             }
-        except Node.DoesNotExist:
-            pass
-            
-        # --- Interceptar mensaje "menu principal" ---
-        if normalize(message) == 'menu principal':
-            try:
-                menu_node = Node.objects.get(flow=session.flow, title__iexact='menu principal')
-                session.current_node = menu_node
-                session.save()
-                
-                response_message = self._prepare_response_message(menu_node, session)
-                return {
-                    'status': 'success',
-                    'session_id': session.id,
-                    'lead_id': session.lead.id,
-                    'conversation_id': session.conversacion.id,
-                    'current_node': {
-                        'id': menu_node.id,
-                        'title': menu_node.title,
-                        'type': menu_node.type,
-                    },
-                    'collected_entity': None,
-                    'next_node': {
-                        'id': menu_node.id,
-                        'title': menu_node.title,
-                        'type': menu_node.type,
-                        'collect_entity': menu_node.collect_entity.name if menu_node.collect_entity else None,
-                        'collect_mode': menu_node.collect_entity_mode,
-                    },
-                    'response': response_message,
-                    'flow_completed': False,
-                    'context': session.context,
-                }
-            except Node.DoesNotExist:
-                pass
 
-        # --- Interceptar mensaje "reiniciar historial" ---
-        if message.strip().lower() == 'reiniciar historial':
+        # --- Interceptar comando de reinicio ("reiniciar historial") ---
+        if command == COMMAND_RESTART:
             from .models import EntityValue
             
             # Borrar todas las entidades colectadas de este sender
             EntityValue.objects.filter(
-                team=session.team,
+                team_id=session.team_id,
                 sender_id=session.sender_id
             ).delete()
+            session.entities.clear()
             
             # Limpiar contexto
             session.context = {
@@ -338,27 +333,33 @@ class FlowWebhookView(View):
                 'reset_at': timezone.now().isoformat()
             }
             
-            # Reiniciar al nodo de inicio
-            start_node = session.flow.start_node
-            session.current_node = start_node
-            session.is_finished = False
-            session.save()
+            # Reiniciar al nodo de inicio de la versión publicada actual
+            session.pin_flow_version()
+            graph = session.flow_graph
+            start_node = graph.start_node
+            session.set_current_node(start_node)
+            session.reactivate()
             
-            # Agregar mensaje de reinicio a la conversación
-            from apps.conversaciones.utils import add_message_to_conversation
-            add_message_to_conversation(
+            # Agregar mensaje de reinicio a la conversación (se inserta con el resto del request)
+            from apps.conversaciones.models import MessageType
+            notice = Message(
                 conversacion=session.conversacion,
                 content="🔄 Historial reiniciado. Comenzando nueva conversación...",
-                direction='OUTBOUND',
-                message_type='TEXT'
+                direction=MessageDirection.OUTBOUND,
+                type=MessageType.TEXT,
+                metadata={'platform': session.platform, 'is_automated': True, 'source': 'flow'},
             )
+            session.conversacion.last_message_at = timezone.now()
+            if outbox is not None:
+                outbox.append(notice)
+            else:
+                notice.save()
             
             # Avanzar al siguiente nodo después del START
             next_node_after_start = session.get_next_node("")
             
             if next_node_after_start:
-                session.current_node = next_node_after_start
-                session.save()
+                next_node_after_start = enter_node(session, next_node_after_start)
                 response_message = self._prepare_response_message(next_node_after_start, session)
                 current_node_info = {
                     'id': next_node_after_start.id,
@@ -376,14 +377,18 @@ class FlowWebhookView(View):
             return {
                 'status': 'history_reset',
                 'session_id': session.id,
-                'lead_id': session.lead.id,
-                'conversation_id': session.conversacion.id,
+                'lead_id': session.lead_id,
+                'conversation_id': session.conversacion_id,
                 'current_node': current_node_info,
                 'response': response_message,
                 'message': 'Historial reiniciado exitosamente. Comenzando desde el inicio.'
             }
 
         
+        # Entidades auto_extract que el usuario ya mencionó (una pasada para todo el team)
+        if message.strip():
+            auto_extract(session, message, current_node)
+        
         # Si el nodo actual colecta una entidad, procesarla
         collected_value = None
         validation_error = None
@@ -414,8 +419,8 @@ class FlowWebhookView(View):
                     return {
                         'status': 'validation_error',
                         'session_id': session.id,
-                        'lead_id': session.lead.id,
-                        'conversation_id': session.conversacion.id,
+                        'lead_id': session.lead_id,
+                        'conversation_id': session.conversacion_id,
                         'current_node': {
                             'id': current_node.id,
                             'title': current_node.title,
@@ -432,44 +437,42 @@ class FlowWebhookView(View):
             
             # Guardar el valor validado
             if collected_value:
+                value = {
+                    'raw': message,
+                    'processed': collected_value,
+                    'node_id': current_node.id,
+                    'timestamp': timezone.now().isoformat(),
+                    'entity_type': entity.type,
+                }
+                with_date_iso(entity, value)
                 EntityValue.objects.update_or_create(
-                    entity=entity,
-                    team=session.team,
+                    entity_id=entity.id,
+                    team_id=session.team_id,
                     sender_id=session.sender_id,
-                    defaults={
-                        'value': {
-                            'raw': message,
-                            'processed': collected_value,
-                            'node_id': current_node.id,
-                            'timestamp': timezone.now().isoformat(),
-                            'entity_type': entity.type,
-                        }
-                    }
+                    defaults={'value': value}
                 )
+                session.entities.set(entity, value)
                 
                 # Actualizar contexto de la sesión
                 if 'collected_entities' not in session.context:
                     session.context['collected_entities'] = {}
                 session.context['collected_entities'][entity.slug] = collected_value
-                session.save()
         
         # Determinar siguiente nodo
         next_node = session.get_next_node(message)
         
-        # Actualizar sesión
-        session.current_node = next_node
-        session.updated_at = timezone.now()
+        # Actualizar sesión (un DELAY programa aquí su temporizador)
+        next_node = enter_node(session, next_node)
         
         if not next_node:
             # Fin del flujo
-            session.finish_session()
-            session.save()
+            session.finish_session(save=False)
             
             return {
                 'status': 'flow_completed',
                 'session_id': session.id,
-                'lead_id': session.lead.id,
-                'conversation_id': session.conversacion.id,
+                'lead_id': session.lead_id,
+                'conversation_id': session.conversacion_id,
                 'current_node': {
                     'id': current_node.id,
                     'title': current_node.title,
@@ -481,8 +484,6 @@ class FlowWebhookView(View):
                 'flow_completed': True,
             }
         else:
-            session.save()
-            
             # Preparar mensaje de respuesta con variables y opciones de multiple choice
             response_message = self._prepare_response_message(next_node, session)
             
@@ -515,8 +516,8 @@ class FlowWebhookView(View):
             return {
                 'status': 'success',
                 'session_id': session.id,
-                'lead_id': session.lead.id,
-                'conversation_id': session.conversacion.id,
+                'lead_id': session.lead_id,
+                'conversation_id': session.conversacion_id,
                 'current_node': {
                     'id': current_node.id,
                     'title': current_node.title,
@@ -541,76 +542,245 @@ class FlowWebhookView(View):
     
     def _prepare_response_message(self, node, session):
         """Prepara el mensaje de respuesta reemplazando variables y añadiendo opciones de multiple choice"""
-        from .models import EntityValue
+        # Los nodos del grafo compilado traen el template ya separado en segmentos
+        template = getattr(node, 'template', None)
+        if template is None:
+            from .services.templates import compile_template
+            template = compile_template(node)
+        return template.render(session)
+
+    def get(self, request, team_slug, flow_slug):
+        """
+        GET para obtener el flujo completo (con nodos y paths relevantes).
+        El JSON se renderiza una vez por (flujo, versión) hasta que se edita
+        y se sirve con ETag; If-None-Match con el mismo ETag responde 304.
+        """
+        from django.http import HttpResponse, HttpResponseNotModified
+        from .models import Flow
+        from .services.exports import etag_matches, get_flow_detail
         
-        message = node.message_template or f"Nodo: {node.title}"
+        flow = get_object_or_404(Flow.objects.only('id', 'team_id', 'version'), slug=flow_slug, team__slug=team_slug)
+        body, etag = get_flow_detail(flow)
+
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class FlowWebhookBatchView(FlowWebhookView):
+    """
+    Variante por lotes del webhook
+    URL: /webhook/{team_slug}/{flow_slug}/batch/
+    Body: {"messages": [{"sender_id": ..., "message": ..., "platform": ...}, ...]}
+    Responde {"results": [...]} en el mismo orden que los mensajes.
+    """
+    http_method_names = ['post']
+    
+    def post(self, request, team_slug, flow_slug):
+        try:
+            from .models import Flow
+            
+            team = get_object_or_404(Team, slug=team_slug)
+            flow = get_object_or_404(Flow, slug=flow_slug, team=team, is_active=True)
+            
+            try:
+                data = json.loads(request.body)
+            except json.JSONDecodeError:
+                return JsonResponse({'error': 'Invalid JSON'}, status=400)
+            
+            items = data.get('messages') if isinstance(data, dict) else data
+            if not isinstance(items, list):
+                return JsonResponse({'error': 'messages must be a list'}, status=400)
+            
+            max_items = getattr(settings, 'FLOWS_BATCH_MAX_ITEMS', 500)
+            if len(items) > max_items:
+                return JsonResponse({'error': f'at most {max_items} messages per batch'}, status=400)
+            
+            return JsonResponse({'results': self.handle_batch(team, flow, items)})
+            
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+    
+    def handle_batch(self, team, flow, items):
+        """
+        Procesa varios payloads con el grafo cargado una vez y participantes
+        resueltos en bloque. Los mensajes de un mismo remitente se procesan
+        en orden y se guardan en un solo flush (estado, Message y registros
+        de reintento en la misma transacción); remitentes distintos pueden
+        procesarse en paralelo.
+        """
+        from .services.dedup import stored_responses
+        from .services.graph import get_flow_graph
+        from .services.upserts import resolve_participants
         
-        # Reemplazar variables básicas
-        variables = {
-            'lead_name': session.lead.nombre or 'Usuario',
-            'lead_phone': session.lead.telefono or '',
-            'lead_email': session.lead.email or '',
-        }
+        results = [None] * len(items)
+        candidates = []
+        for idx, item in enumerate(items):
+            if isinstance(item, dict) and item.get('sender_id'):
+                candidates.append((idx, item))
+            else:
+                results[idx] = {'error': 'sender_id is required'}
         
-        # Agregar entidades colectadas desde EntityValue
-        entity_values = EntityValue.objects.filter(
-            team=session.team,
-            sender_id=session.sender_id
-        ).select_related('entity')
-        
-        for entity_value in entity_values:
-            entity_slug = entity_value.entity.slug
-            # Extraer el valor procesado o raw del JSON
-            value_data = entity_value.value
-            if isinstance(value_data, dict):
-                value = value_data.get('processed') or value_data.get('raw', '')
+        # Reintentos: message_id ya procesado o repetido dentro del lote.
+        # Esta lectura evita trabajo; la que decide se repite bajo el lock
+        # de cada remitente
+        stored = stored_responses(team.id, [item['message_id'] for _, item in candidates if item.get('message_id')])
+        first_seen = {}
+        repeated = []
+        valid = []
+        for idx, item in candidates:
+            external_id = str(item['message_id']) if item.get('message_id') else None
+            if external_id in stored:
+                results[idx] = stored[external_id]
+            elif external_id in first_seen:
+                repeated.append((idx, first_seen[external_id]))
             else:
-                value = value_data
-            variables[entity_slug] = value
+                if external_id:
+                    first_seen[external_id] = idx
+                valid.append((idx, item))
+        if not valid:
+            return results
+        
+        graph = get_flow_graph(flow)
+        participants = resolve_participants(
+            team, flow, graph.start_node_id, [self._sender_data(item) for _, item in valid]
+        )
         
-        # También mantener el contexto de sesión como fallback
-        if 'collected_entities' in session.context:
-            for entity_slug, value in session.context['collected_entities'].items():
-                if entity_slug not in variables:
-                    variables[entity_slug] = value
+        # Mensajes de cada item (entrante, del flujo y respuesta del bot);
+        # se insertan en el flush de su remitente
+        messages = {
+            idx: [self._inbound_message(participants[str(item['sender_id'])][1], item)]
+            if item.get('message', '') else []
+            for idx, item in valid
+        }
         
-        # Reemplazar variables en el mensaje
-        for var_name, var_value in variables.items():
-            message = message.replace(f'{{{var_name}}}', str(var_value))
-            message = message.replace(f'{{{{{var_name}}}}}', str(var_value))
+        groups = {}
+        for idx, item in valid:
+            groups.setdefault(str(item['sender_id']), []).append((idx, item))
         
-        # Si este nodo colecta una entidad de tipo multiple_choice, agregar las opciones
-        if node.collect_entity:
-            entity = node.collect_entity
+        failed = set()
+        workers = min(self._batch_workers(), len(groups))
+        if workers <= 1:
+            for sender_id, group in groups.items():
+                self._process_sender_group(participants[sender_id], group, results, failed, messages)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
             
-            # Verificar que sea MULTIPLE_CHOICE (mayúsculas como en EntityType.choices)
-            if entity.type == 'MULTIPLE_CHOICE' and entity.options:
-                # Verificar que options sea una lista con elementos
-                if isinstance(entity.options, list) and len(entity.options) > 0:
-                    message += "\n\n"
-                    for idx, option in enumerate(entity.options, 1):
-                        # Obtener el label de la opción, usar key si label está vacío
-                        if isinstance(option, dict):
-                            label = option.get('label', '').strip()
-                            if not label:  # Si label está vacío, usar key
-                                label = option.get('key', f'Opción {idx}')
-                        else:
-                            label = str(option)
-                        message += f"{idx}. {label}"
+            def run(sender_id):
+                try:
+                    self._process_sender_group(participants[sender_id], groups[sender_id], results, failed, messages)
+                finally:
+                    # Cada hilo abre su propia conexión
+                    connection.close()
+            
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, groups))
         
-        return message
-
-    def get(self, request, team_slug, flow_slug):
-        """GET para obtener el flujo completo (con nodos y paths relevantes)"""
-        from .models import Flow
-        from .serializers import FlowDetailSerializer
+        for idx, original_idx in repeated:
+            results[idx] = results[original_idx]
+        funnel_counters.maybe_flush()
+        return results
+    
+    def _batch_workers(self):
+        # SQLite admite un solo escritor: en paralelo solo se bloquearía
+        if connection.vendor == 'sqlite':
+            return 1
+        return getattr(settings, 'FLOWS_BATCH_WORKERS', 4)
+    
+    def _process_sender_group(self, participant, group, results, failed, messages):
+        """
+        Procesa en orden los mensajes de un remitente en una transacción y
+        guarda en un solo flush su estado, sus Message y los registros de
+        sus reintentos. Si el grupo falla (lock, flush) sus mensajes
+        responden con error sin afectar a los demás remitentes del lote
+        """
+        from .services.dedup import delivery_record, remember_on_commit, stored_responses
+        from .services.locks import sender_lock
+        from .services.unit_of_work import UnitOfWork
         
-        team = get_object_or_404(Team, slug=team_slug)
-        flow = get_object_or_404(Flow, slug=flow_slug, team=team)
+        lead, conversacion, session = participant
+        stored = {}
+        try:
+            with sender_lock(session.team_id, session.sender_id), transaction.atomic():
+                # Otro request pudo procesar estos message_id antes del lock
+                stored = stored_responses(
+                    session.team_id, [item['message_id'] for _, item in group if item.get('message_id')]
+                )
+                # El upsert del lote leyó la sesión antes de tomar el lock
+                session.refresh_from_db(fields=[
+                    'current_node', 'status', 'context', 'finished_at', 'node_entered_at', 'flow_version',
+                ])
+                uow = UnitOfWork()
+                uow.track(lead, conversacion, session)
+                delivered = []
+                for idx, item in group:
+                    external_id = str(item['message_id']) if item.get('message_id') else None
+                    if external_id in stored:
+                        results[idx] = stored[external_id]
+                        continue
+                    try:
+                        # Un savepoint por mensaje: si falla se deshacen solo sus escrituras
+                        with transaction.atomic():
+                            outbox = []
+                            results[idx] = self._process_flow_message(session, item.get('message', ''), item, outbox)
+                            outbox.append(self._outbound_message(session, results[idx]))
+                            messages[idx].extend(m for m in outbox if m is not None)
+                    except Exception as e:
+                        results[idx] = {'error': str(e)}
+                        failed.add(idx)
+                    uow.add(*messages[idx])
+                    if external_id and idx not in failed:
+                        uow.add(delivery_record(
+                            session.team_id, session.flow_id, session.sender_id, external_id, results[idx]
+                        ))
+                        delivered.append((external_id, results[idx]))
+                uow.flush()
+                remember_on_commit(session.team_id, delivered)
+        except SenderLockTimeout as e:
+            for idx, _ in group:
+                results[idx] = {'error': str(e)}
+                failed.add(idx)
+        except Exception as e:
+            # La transacción del grupo se deshizo completa: solo las respuestas
+            # ya guardadas de reintentos siguen siendo válidas
+            print(f"❌ Error procesando el lote del remitente {session.sender_id}: {e}")
+            for idx, item in group:
+                if item.get('message_id') and str(item['message_id']) in stored:
+                    continue
+                results[idx] = {'error': str(e)}
+                failed.add(idx)
 
-        serializer = FlowDetailSerializer(flow, context={"request": request})
 
-        return JsonResponse(serializer.data, safe=False)
+def _has_webhook_token(request, flow):
+    """webhook_token del flujo en el header X-Webhook-Token o en ?token="""
+    from django.utils.crypto import constant_time_compare
+    
+    token = request.headers.get('X-Webhook-Token') or request.GET.get('token') or ''
+    return flow.webhook_token is not None and constant_time_compare(token, str(flow.webhook_token))
+
+
+class FlowWebhookMessageView(View):
+    """
+    Consulta de un mensaje encolado por el webhook en modo asíncrono
+    URL: /webhook/{team_slug}/{flow_slug}/messages/{message_id}/
+    Requiere el webhook_token del flujo en el header X-Webhook-Token o en ?token=
+    """
+    
+    def get(self, request, team_slug, flow_slug, message_id):
+        from .models import Flow, InboundMessage
+        from .services.inbound import serialize_inbound
+        
+        flow = get_object_or_404(Flow.objects.only('id', 'webhook_token'), slug=flow_slug, team__slug=team_slug)
+        if not _has_webhook_token(request, flow):
+            return JsonResponse({'error': 'invalid webhook token'}, status=403)
+        
+        inbound = get_object_or_404(InboundMessage, id=message_id, flow_id=flow.id)
+        return JsonResponse(serialize_inbound(inbound))
 
 
 class FlowProcessorView(APIView):
@@ -619,6 +789,7 @@ class FlowProcessorView(APIView):
 
     def post(self, request, *args, **kwargs):
         from .models import Flow, ConversationSession, EntityValue
+        from .services.graph import get_flow_graph
         
         flow_id = request.data.get("flow_id")
         sender_id = request.data.get("sender_id")
@@ -634,10 +805,12 @@ class FlowProcessorView(APIView):
             sender_id=sender_id,
             flow=flow,
             team=flow.team,
-            defaults={"current_node": flow.start_node}
+            defaults={"current_node_id": get_flow_graph(flow).start_node_id}
         )
 
-        node = session.current_node
+        # El nodo se resuelve en el grafo compilado: current_node no tiene
+        # constraint y puede apuntar a un nodo ya borrado del grafo vivo
+        node = session.flow_graph.node(session.current_node_id) if session.current_node_id else None
 
         if not node:
             return Response({"error": "No current node"}, status=400)
@@ -650,17 +823,17 @@ class FlowProcessorView(APIView):
 
             if message is not None:
                 EntityValue.objects.update_or_create(
-                    entity=entity,
-                    team=flow.team,
+                    entity_id=entity.id,
+                    team_id=flow.team_id,
                     sender_id=sender_id,
-                    defaults={"value": {"raw": message}}
+                    defaults={"value": with_date_iso(entity, {"raw": message})}
                 )
 
         # Buscar siguiente nodo por paths
         next_node = session.get_next_node(message)
 
         # Actualizar sesión
-        session.current_node = next_node
+        session.set_current_node(next_node)
         session.save()
 
         response_message = None
@@ -702,6 +875,133 @@ class FlowViewSet(viewsets.ModelViewSet):
             'is_active': flow.is_active,
         })
 
+    @action(detail=True, methods=['post'])
+    def publish(self, request, pk=None):
+        """Publica el grafo actual del flujo como una nueva versión inmutable"""
+        from .services.versions import publish_flow
+        
+        flow = self.get_object()
+        snapshot = publish_flow(flow, user=request.user)
+        return Response({
+            'id': snapshot.id,
+            'version': snapshot.version,
+            'published_at': snapshot.published_at,
+            'nodes': len(snapshot.graph['nodes']),
+        }, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def versions(self, request, pk=None):
+        """Versiones publicadas del flujo"""
+        flow = self.get_object()
+        return Response([
+            {
+                'id': v.id,
+                'version': v.version,
+                'published_at': v.published_at,
+                'published_by': v.published_by_id,
+                'is_current': v.id == flow.published_version_id,
+            }
+            for v in flow.versions.only('id', 'version', 'published_at', 'published_by')
+        ])
+
+    @action(detail=False, methods=['get'], url_path='lock-stats', permission_classes=[IsAdminUser])
+    def lock_stats(self, request):
+        """Contención de los locks por remitente del webhook en este proceso (de todos los teams: solo staff)"""
+        from .services.locks import stats
+        return Response(stats.snapshot())
+
+    @action(detail=True, methods=['get'])
+    def funnel(self, request, pk=None):
+        """
+        Embudo del flujo por nodo (entradas, salidas, abandonos, tiempo en
+        nodo y salidas por path) desde los contadores ya agregados.
+        Parámetros: ?since=&until= (ISO, por defecto últimos 7 días), ?version=
+        """
+        from .services.analytics import funnel
+        from .services.entities import parse_iso
+
+        flow = self.get_object()
+        bounds = {}
+        for name in ('since', 'until'):
+            raw = request.query_params.get(name)
+            if raw:
+                bounds[name] = parse_iso(raw)
+                if bounds[name] is None:
+                    return Response({'error': f'{name} must be an ISO date'}, status=status.HTTP_400_BAD_REQUEST)
+        version = request.query_params.get('version')
+        if version is not None:
+            try:
+                version = int(version)
+            except ValueError:
+                return Response({'error': 'version must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(funnel(flow, version=version, **bounds))
+
+    @action(detail=True, methods=['get', 'put'])
+    def graph(self, request, pk=None):
+        """
+        GET: grafo completo del flujo para el editor (nodos con posición,
+        paths y entidades). PUT: guarda el grafo completo en una sola
+        transacción; los objetos nuevos llevan un id temporal (string) y la
+        respuesta incluye id_map con los ids reales.
+        """
+        from .services.graph_io import GraphError, export_flow, save_graph
+
+        flow = self.get_object()
+        if request.method == 'GET':
+            return Response(export_flow(flow))
+        try:
+            result = save_graph(flow, request.data)
+        except GraphError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """JSON portable del flujo, para importarlo en otro team con POST /flows/import/"""
+        from .services.graph_io import export_flow
+
+        flow = self.get_object()
+        response = Response(export_flow(flow))
+        response['Content-Disposition'] = f'attachment; filename="{flow.slug}.json"'
+        return response
+
+    @action(detail=True, methods=['post'])
+    def clone(self, request, pk=None):
+        """Copia profunda del flujo (sin publicar). Body opcional: {"name": "..."}"""
+        from .services.graph_io import GraphError, clone_flow
+
+        try:
+            flow, result = clone_flow(self.get_object(), name=request.data.get('name'), user=request.user)
+        except GraphError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'id': flow.id, 'slug': flow.slug, **result}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_graph(self, request):
+        """
+        Crea un flujo a partir de un export.
+        Body: {"team": id, "name": "opcional", "graph": {...export...}}
+        """
+        from .services.graph_io import GraphError, import_flow
+
+        team = Team.objects.filter(id=request.data.get('team'), members__user=request.user).first()
+        if team is None:
+            return Response({'error': 'team not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            flow, result = import_flow(team, request.data.get('graph'), name=request.data.get('name'), user=request.user)
+        except GraphError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'id': flow.id, 'slug': flow.slug, **result}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'], url_path='webhook-stats', permission_classes=[IsAdminUser])
+    def webhook_stats(self, request):
+        """
+        Llamadas, errores, caché y latencia por host de los nodos WEBHOOK en
+        este proceso. Incluye los hosts de todos los teams: solo staff.
+        """
+        from .services.webhooks import stats
+        return Response(stats.snapshot())
+
 
 class NodeViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
@@ -775,6 +1075,32 @@ class EntityViewSet(viewsets.ModelViewSet):
     def _generate_suffix(self, length=4):
         return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
+    @action(detail=False, methods=['post'])
+    def segment(self, request):
+        """
+        sender_id que cumplen todos los filtros, por páginas.
+        Body: {"team": id, "filters": [{"entity": "presupuesto", "op": "gt", "value": 5000}],
+               "cursor": null, "page_size": 500, "count": false}
+        Operadores: exists, missing, eq, contains, in, gt, gte, lt, lte,
+        between, before, after, date_between.
+        """
+        from .services.segments import SegmentError, page_size, segment_page, segment_queryset
+
+        team_id = request.data.get('team')
+        if not team_id or not request.user.teams.filter(team_id=team_id).exists():
+            return Response({'error': 'team not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        filters = request.data.get('filters')
+        try:
+            page = segment_page(
+                team_id, filters, cursor=request.data.get('cursor'), size=page_size(request.data.get('page_size'))
+            )
+            if request.data.get('count'):
+                page['count'] = segment_queryset(team_id, filters).count()
+        except SegmentError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page)
+
     def perform_create(self, serializer):
         from .models import Entity
         
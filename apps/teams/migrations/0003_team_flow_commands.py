@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-16 20:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teams', '0002_team_slug'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='flow_commands',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -8,6 +8,8 @@ class Team(models.Model):
     description = models.TextField(blank=True, null=True)
     slug = models.SlugField(unique=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Palabras clave que los flujos interceptan, p. ej. {"menu": ["menu principal"], "restart": ["reiniciar historial"]}
+    flow_commands = models.JSONField(default=dict, blank=True)
     
     def save(self, *args, **kwargs):
         # Solo generar el slug si no existe (al crear)
@@ -16,7 +16,7 @@ class UserSerializer(serializers.ModelSerializer):
 class TeamSerializer(serializers.ModelSerializer):
     class Meta:
         model = Team
-        fields = ('id', 'name', 'slug', 'description', 'created_at')
+        fields = ('id', 'name', 'slug', 'description', 'flow_commands', 'created_at')
         read_only_fields = ('created_at', 'slug')
 
 class TeamMemberSerializer(serializers.ModelSerializer):
@@ -10,6 +10,41 @@ module.exports = {
           DJANGO_SETTINGS_MODULE: "myproject.settings.production",
           PYTHONPATH: "/root/general-backend-django"
         }
+      },
+      {
+        name: "flow-queue-worker",
+        script: "manage.py",
+        interpreter: "/root/general-backend-django/venv/bin/python",
+        args: "process_flow_queue --workers 4",
+        cwd: "/root/general-backend-django",
+        env: {
+          DJANGO_SETTINGS_MODULE: "myproject.settings.production",
+          PYTHONPATH: "/root/general-backend-django"
+        }
+      },
+      {
+        name: "flow-timer-worker",
+        script: "manage.py",
+        interpreter: "/root/general-backend-django/venv/bin/python",
+        args: "run_flow_timers",
+        cwd: "/root/general-backend-django",
+        env: {
+          DJANGO_SETTINGS_MODULE: "myproject.settings.production",
+          PYTHONPATH: "/root/general-backend-django"
+        }
+      },
+      {
+        name: "flow-session-sweeper",
+        script: "manage.py",
+        interpreter: "/root/general-backend-django/venv/bin/python",
+        args: "sweep_flow_sessions",
+        cwd: "/root/general-backend-django",
+        cron_restart: "15 * * * *",
+        autorestart: false,
+        env: {
+          DJANGO_SETTINGS_MODULE: "myproject.settings.production",
+          PYTHONPATH: "/root/general-backend-django"
+        }
       }
     ]
   }
\ No newline at end of file
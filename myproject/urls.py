@@ -9,7 +9,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny
 from apps.usuarios.views import CustomTokenObtainPairView
-from apps.flows.views import FlowWebhookView
+from apps.flows.views import FlowWebhookView, FlowWebhookBatchView, FlowWebhookMessageView
 from apps.citas.views import ProcesarChatView
 
 class HealthCheckView(APIView):
@@ -52,6 +52,8 @@ urlpatterns = [
 
     path('health/', HealthCheckView.as_view(), name='health_check'),
     path('webhook/<slug:team_slug>/<slug:flow_slug>/', FlowWebhookView.as_view(), name='flow-webhook'),
+    path('webhook/<slug:team_slug>/<slug:flow_slug>/batch/', FlowWebhookBatchView.as_view(), name='flow-webhook-batch'),
+    path('webhook/<slug:team_slug>/<slug:flow_slug>/messages/<int:message_id>/', FlowWebhookMessageView.as_view(), name='flow-webhook-message'),
     path('procesar-chat/', ProcesarChatView.as_view(), name='procesar-chat'),
 
 ]